@@ -4,7 +4,12 @@ def get_derivative_softmax(fc2_output, label_vec):
     '''
     fc2_output: (3095,1)
     return (3095,1)
+    batch: fc2_output: (N, classes), label_vec: one-hot, or (N,) integer class ids (只在目标类别减1)
     '''
+    if np.issubdtype(np.asarray(label_vec).dtype, np.integer):
+        output = fc2_output.copy()
+        output[np.arange(len(label_vec)), label_vec] -= 1
+        return output
     return fc2_output - label_vec
 
 def get_derivative_fcout(input_vec, fc_weights, fc_bias, bp_gradient):
@@ -12,23 +17,32 @@ def get_derivative_fcout(input_vec, fc_weights, fc_bias, bp_gradient):
     y = Wx + b
     bp_gradient: 从后续layer传来的梯度 (n, 1)
     fc2: input_vec: (256,) bp_gradient: (3095,), fc_weights:(256,3095)
+    batch: input_vec: (N,256) bp_gradient: (N,3095) -> dw, db summed over the batch, dx: (N,256)
     '''
-    dw = np.matmul(input_vec[:,None],bp_gradient[:,None].transpose())
+    if len(input_vec.shape) == 2:
+        dw = np.matmul(input_vec.transpose(), bp_gradient)
+        db = np.sum(bp_gradient, axis=0)[:,None]
+        dx = np.matmul(bp_gradient, fc_weights.transpose())
+    else:
+        dw = np.matmul(input_vec[:,None],bp_gradient[:,None].transpose())
+        db = bp_gradient
+        db = db[:,None]
+        dx = np.matmul(fc_weights, bp_gradient[:,None])
     assert dw.shape == fc_weights.shape
-    db = bp_gradient
-    db = db[:,None]
     assert db.shape == fc_bias[:,None].shape
-    dx = np.matmul(fc_weights, bp_gradient[:,None])
     return dw,db,dx
 
-def get_derivate_mfm_fc1(location, bp_gradient):
+def get_derivate_mfm_fc1(switch, bp_gradient):
     '''
-    input_vec: (512,)
+    switch: (256,) 前向传播时记录的mfm_fc的开关，True表示后一半取到最大值
     bp_gradient: (256,1)
+    batch: switch: (N,256) bp_gradient: (N,256) -> (N,512)
     '''
-    tmp = np.vstack((bp_gradient,bp_gradient))
-    assert tmp.shape[0] == 512
-    output = tmp * location[:,None].astype(int) 
+    if len(switch.shape) == 2:
+        output = get_derivative_mfm(switch, bp_gradient)
+        assert output.shape == (switch.shape[0],512)
+        return output
+    output = get_derivative_mfm(switch, bp_gradient[:,0])[:,None]
     assert output.shape == (512,1)
     return output
 
@@ -37,15 +51,33 @@ def get_derivative_fc(input_vec, fc_weights, fc_bias, bp_gradient):
     y = Wx + b
     bp_gradient: 从后续layer传来的梯度 (n, 1)
     fc1: input_vec: (8*8*128,) bp_gradient: (512,1), fc_weights:(8*8*128,512)
+    batch: input_vec: (N,8*8*128) bp_gradient: (N,512) -> dw, db summed over the batch, dx: (N,8*8*128)
     '''
-    dw = np.matmul(input_vec[:,None],bp_gradient.transpose())
+    if len(input_vec.shape) == 2:
+        dw = np.matmul(input_vec.transpose(), bp_gradient)
+        db = np.sum(bp_gradient, axis=0)[:,None]
+        dx = np.matmul(bp_gradient, fc_weights.transpose())
+        assert dx.shape == (input_vec.shape[0],8*8*128)
+    else:
+        dw = np.matmul(input_vec[:,None],bp_gradient.transpose())
+        db = bp_gradient
+        dx = np.matmul(fc_weights, bp_gradient)
+        assert dx.shape == (8*8*128,1)
     assert dw.shape == fc_weights.shape
-    db = bp_gradient
     assert db.shape == fc_bias[:,None].shape
-    dx = np.matmul(fc_weights, bp_gradient)
-    assert dx.shape == (8*8*128,1)
     return dw,db,dx
     
+def get_derivative_fc_nobias(input_vec, fc_weights, bp_gradient):
+    '''
+    y = Wx, 没有bias的fc层 (低秩分解后fc的第一个因子, 见lowrank.py)
+    batch: input_vec: (N, w) bp_gradient: (N, node_num) -> dw summed over the batch (w, node_num), dx: (N, w)
+    '''
+    dw = np.matmul(input_vec.transpose(), bp_gradient)
+    dx = np.matmul(bp_gradient, fc_weights.transpose())
+    assert dw.shape == fc_weights.shape
+    assert dx.shape == input_vec.shape
+    return dw,dx
+
 def rot180(conv_filters):
     '''
     将卷积核旋转180度
@@ -54,26 +86,50 @@ def rot180(conv_filters):
     rot180_filters = np.flip(np.flip(conv_filters, 0), 1)
     return rot180_filters
 
+def get_derivative_conv_batch_w(input_img, bp_gradient, filter_shape):
+    '''
+    对一个batch的卷积核求导，结果在batch上求和
+    对卷积核的每个位置(i, j)，dw[i,j] 等于 input_img 对应平移的区域与 bp_gradient 在 (N, l, w) 上的内积
+    input_img: (N, l, w, h), bp_gradient: (N, l-fl+1, w-fw+1, n) -> (fl, fw, h, n)
+    '''
+    filter_len, filter_width, filter_height, filter_num = filter_shape
+    feature_len, feature_width = bp_gradient.shape[1:3]
+    dw = np.zeros(filter_shape, dtype=input_img.dtype)
+    for i in range(filter_len):
+        for j in range(filter_width):
+            window = input_img[:, i:i+feature_len, j:j+feature_width, :]
+            dw[i,j] = np.tensordot(window, bp_gradient, axes=([0,1,2],[0,1,2]))
+    return dw
+
 def get_derivative_conv(input_img, filter, filter_bias, bp_gradient, conv_output):
     '''
     对w求导的原理是：将bp_gradient的每一层[:,:,i]作为新的filter 对input_img的每一层[:,:,j]进行卷积
     input_img: the input of convolution layer
     filter, filter_bias: the w and b of current convolution layer 
     bp_gradient: 从后续层传来的梯度
-    conv_output: the output feature map of current convolution layer 
-    '''
+    conv_output: the output feature map of current convolution layer (only read for a single image)
+    一个batch的输入为 (N, l, w, h)，dw 和 db 在batch上求和，dx 为 (N, l, w, h)，conv_output 可以为 None
+    '''
+    if len(input_img.shape) == 4:
+        dw = get_derivative_conv_batch_w(input_img, bp_gradient, filter.shape)
+        dx = get_derivative_conv2pool(input_img, filter, filter_bias, bp_gradient)
+        db = np.sum(bp_gradient, axis=(0,1,2))
+        assert db.shape == filter_bias.shape
+        return dw,db,dx
+
     # 记录必要的参数
     filter_size = filter.shape[0]
     input_img_size= input_img.shape[0]
     input_img_channal = input_img.shape[2] 
     output_channal = conv_output.shape[-1]
 
-    dw = np.zeros(filter.shape)            
+    dw = np.zeros(filter.shape, dtype=filter.dtype)            
     bp_gradient_filter_size = bp_gradient.shape[0]
     feature_size = input_img_size - bp_gradient_filter_size + 1
 
     # img2col技术，将要做卷积的区域reshape成一个向量
-    input_img2col = np.lib.stride_tricks.as_strided(input_img, shape=(feature_size, feature_size, input_img_channal, bp_gradient_filter_size, bp_gradient_filter_size), strides=(8*input_img_channal*input_img_size, 8*input_img_channal, 8, 8*input_img_channal*input_img_size, 8*input_img_channal))
+    len_stride, width_stride, channal_stride = input_img.strides
+    input_img2col = np.lib.stride_tricks.as_strided(input_img, shape=(feature_size, feature_size, input_img_channal, bp_gradient_filter_size, bp_gradient_filter_size), strides=(len_stride, width_stride, channal_stride, len_stride, width_stride))
     input_img2col = np.reshape(input_img2col, (feature_size, feature_size, input_img_channal,bp_gradient_filter_size*bp_gradient_filter_size))
     # 对filter reshape, 将其reshape成一个向量
     bp_gradient_filter = bp_gradient.reshape(( bp_gradient_filter_size* bp_gradient_filter_size, bp_gradient.shape[-1]))
@@ -82,7 +138,7 @@ def get_derivative_conv(input_img, filter, filter_bias, bp_gradient, conv_output
     
     assert dw.shape == filter.shape
 
-    tmp_bias = np.zeros(input_img.shape[-1])
+    tmp_bias = np.zeros(input_img.shape[-1], dtype=filter.dtype)
     # 对filter做180度翻转
     rot_filter = rot180(filter).swapaxes(-2,-1)
     if filter.shape[0]!= 1:
@@ -98,10 +154,10 @@ def get_derivative_conv2pool(input_img, filter, filter_bias, bp_gradient):
     '''
     针对pool的输出跳过一层卷积直接接到第二层卷积的残差结构的求导    
     '''
-    tmp_bias = np.zeros(input_img.shape[-1])
+    tmp_bias = np.zeros(input_img.shape[-1], dtype=filter.dtype)
     rot_filter = rot180(filter).swapaxes(-2,-1)
     if filter.shape[0]!= 1:
-        dx = conv(padding(bp_gradient,filter.shape[0]-1), rot_filter, tmp_bias)[1:-1,1:-1,:]
+        dx = conv(padding(bp_gradient,filter.shape[0]-1), rot_filter, tmp_bias)[...,1:-1,1:-1,:]
     else:
         dx = conv(bp_gradient, rot_filter, tmp_bias)
 
@@ -110,16 +166,24 @@ def get_derivative_conv2pool(input_img, filter, filter_bias, bp_gradient):
 def get_derivative_conv1(input_img, filter, filter_bias, bp_gradient, conv_output):
     '''
     针对第一层卷积层的反向传播
+    一个batch的输入为 (N, l, w, 1)，dw 和 db 在batch上求和，conv_output 可以为 None
     '''
+    if len(input_img.shape) == 4:
+        dw = get_derivative_conv_batch_w(input_img, bp_gradient, filter.shape)
+        db = np.sum(bp_gradient, axis=(0,1,2))
+        assert db.shape == filter_bias.shape
+        return dw,db
+
     filter_size = filter.shape[0]
     input_img_size= input_img.shape[0]
     input_img_channal = 1 # input image 只有1个channel
     output_channal = conv_output.shape[-1]
 
-    dw = np.zeros(filter.shape)            
+    dw = np.zeros(filter.shape, dtype=filter.dtype)            
     bp_gradient_filter_size = bp_gradient.shape[0]
     feature_size = input_img_size - bp_gradient_filter_size + 1
-    input_img2col = np.lib.stride_tricks.as_strided(input_img, shape=(feature_size, feature_size, 1, bp_gradient_filter_size, bp_gradient_filter_size), strides=(8*input_img_channal*input_img_size, 8*input_img_channal, 8, 8*input_img_channal*input_img_size, 8*input_img_channal))
+    len_stride, width_stride = input_img.strides
+    input_img2col = np.lib.stride_tricks.as_strided(input_img, shape=(feature_size, feature_size, 1, bp_gradient_filter_size, bp_gradient_filter_size), strides=(len_stride, width_stride, width_stride, len_stride, width_stride))
     input_img2col = np.reshape(input_img2col, (feature_size, feature_size, 1,bp_gradient_filter_size*bp_gradient_filter_size))
     bp_gradient_filter = bp_gradient.reshape(( bp_gradient_filter_size* bp_gradient_filter_size, bp_gradient.shape[-1]))
     dw = np.matmul(input_img2col,bp_gradient_filter)
@@ -129,19 +193,25 @@ def get_derivative_conv1(input_img, filter, filter_bias, bp_gradient, conv_outpu
     assert db.shape == filter_bias.shape
     return dw,db  
 
-def get_derivative_pool(location, bp_gradient,pool_output):
+def get_derivative_pool(switch, bp_gradient,pool_output):
     '''
-    location: 前向传播时记录的pooling最大值的位置，为一个多维array
+    switch: 前向传播时记录的pooling最大值在2*2窗口中的位置(0-3)，与pool_output形状相同
+    梯度只传给每个窗口中取到最大值的位置
     '''
     bp_gradient = bp_gradient.reshape(pool_output.shape)
-    bp_gradient = bp_gradient.repeat(2,axis=0).repeat(2,axis=1)
-    output = bp_gradient * location
+    output_shape = pool_output.shape[:-3]+(pool_output.shape[-3]*2, pool_output.shape[-2]*2, pool_output.shape[-1])
+    output = np.empty(output_shape, dtype=bp_gradient.dtype)
+    for cell, (i, j) in enumerate(((0,0), (0,1), (1,0), (1,1))):
+        np.multiply(bp_gradient, switch == cell, out=output[...,i::2,j::2,:])
     return output
 
-def get_derivative_mfm(location, bp_gradient):
+def get_derivative_mfm(switch, bp_gradient):
     '''
-    location: 前向传播时记录的mfm最大值的位置，为一个多维array
+    switch: 前向传播时记录的mfm开关，与mfm输出形状相同，True表示后一半通道取到最大值
+    梯度只传给取到最大值的一半
     '''
-    tmp = np.concatenate((bp_gradient,bp_gradient),axis=-1)
-    output = tmp * location.astype(int) 
-    return output
\ No newline at end of file
+    half = bp_gradient.shape[-1]
+    output = np.empty(bp_gradient.shape[:-1]+(half*2,), dtype=bp_gradient.dtype)
+    np.multiply(bp_gradient, ~switch, out=output[...,:half])
+    np.multiply(bp_gradient, switch, out=output[...,half:])
+    return output
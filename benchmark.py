@@ -0,0 +1,335 @@
+import numpy as np
+import argparse
+import functools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import optimizer as optim
+from forward_layers import mfm, mfm_fc, pool, mfm_inference, pool_inference
+from main import LightCNN_9, NUM_CLASSES
+from conv_autotune import enable_conv_autotuning
+from profiler import patch_layer_functions
+
+# Input shape of every mfm/pool layer in LightCNN_9.forward for one image
+MFM_SHAPES = [('mfm1', (128, 128, 96)), ('mfm2a', (64, 64, 96)), ('mfm2', (64, 64, 192)),
+              ('mfm3a', (32, 32, 192)), ('mfm3', (32, 32, 384)), ('mfm4a', (16, 16, 384)),
+              ('mfm4', (16, 16, 256)), ('mfm5a', (16, 16, 256)), ('mfm5', (16, 16, 256))]
+POOL_SHAPES = [('pool1', (128, 128, 48)), ('pool2', (64, 64, 96)), ('pool3', (32, 32, 192)), ('pool4', (16, 16, 128))]
+MFM_FC_SHAPES = [('mfm_fc1', (512,))]
+
+# Layer functions timed by benchmark_suite at every call site of backprob
+LAYER_FUNCTIONS = ['conv', 'mfm', 'pool', 'padding', 'fc', 'mfm_fc', 'softmax',
+                   'get_derivative_softmax', 'get_derivative_fcout', 'get_derivate_mfm_fc1', 'get_derivative_fc',
+                   'get_derivative_conv', 'get_derivative_conv2pool', 'get_derivative_conv_batch_w',
+                   'get_derivative_conv1', 'get_derivative_pool', 'get_derivative_mfm']
+
+
+def relative_error(reference, value):
+    '''
+    norm of the difference relative to the norm of the reference
+    '''
+    reference = np.asarray(reference, dtype=np.double)
+    value = np.asarray(value, dtype=np.double)
+    return np.linalg.norm(reference - value) / max(np.linalg.norm(reference), 1e-30)
+
+def time_call(func, *args, repeat=5):
+    '''
+    best wall time of repeat calls, in seconds
+    '''
+    best = np.inf
+    for i in range(repeat):
+        time1 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - time1)
+    return best
+
+def peak_memory(func, *args):
+    '''
+    peak bytes allocated during one call, as seen by tracemalloc
+    '''
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def capture_layer_calls(model, images, labels):
+    '''
+    Run backprob once and record every call of a LAYER_FUNCTIONS function with its arguments,
+    so each call site can be timed alone at the exact shapes (and data) LightCNN-9 uses.
+    -> list of (site, function, args), site is 'name#k' for the k-th call of name
+    The functions are wrapped where they are looked up: the globals of graph and backward_layers
+    (get_derivative_conv calls get_derivative_conv2pool and get_derivative_conv_batch_w).
+    Array arguments (and out= arrays) are copied, since the graph's arena reuses their memory later
+    in the pass.
+    '''
+    calls = []
+    counts = {}
+
+    def recorder(name, func):
+        def record(*args, **kwargs):
+            saved = tuple(np.array(arg) if isinstance(arg, np.ndarray) else arg for arg in args)
+            saved_kwargs = {key: np.array(value) if isinstance(value, np.ndarray) else value for key, value in kwargs.items()}
+            calls.append((f'{name}#{counts.get(name, 0)}', functools.partial(func, **saved_kwargs), saved))
+            counts[name] = counts.get(name, 0) + 1
+            return func(*args, **kwargs)
+        return record
+
+    restore = patch_layer_functions(recorder, LAYER_FUNCTIONS)
+    try:
+        model.backprob(images, labels)
+    finally:
+        restore()
+    return calls
+
+def shapes_of(args):
+    return [list(arg.shape) for arg in args if isinstance(arg, np.ndarray)]
+
+def benchmark_suite(model, batch_sizes=(1, 8), repeat=5, end_to_end_repeat=3, seed=0):
+    '''
+    Best wall time (seconds) of every layer call site of backprob (see capture_layer_calls) and of
+    end-to-end forward (forward_batch for batch sizes > 1), backprob and update_batch, per batch size.
+    -> {'meta': ..., 'results': {'batch<N>/<site>': {'seconds', 'shapes'}}}, JSON-serializable
+    '''
+    rng = np.random.default_rng(seed)
+    results = {}
+    for batch_size in batch_sizes:
+        images = rng.random((batch_size, 128, 128)).astype(model.dtype)
+        labels = rng.integers(0, model.num_classes, batch_size)
+
+        for site, func, args in capture_layer_calls(model, images, labels):
+            results[f'batch{batch_size}/{site}'] = {'seconds': time_call(func, *args, repeat=repeat), 'shapes': shapes_of(args)}
+
+        if batch_size == 1:
+            forward_time = time_call(model.forward, images[0], repeat=end_to_end_repeat)
+        else:
+            forward_time = time_call(model.forward_batch, images, batch_size, repeat=end_to_end_repeat)
+        sgd = optim.SGD(model.parameters(), lr=0.0)   # lr 0: every update runs but the weights stay put
+        end_to_end = {
+            'forward': forward_time,
+            'backprob': time_call(model.backprob, images, labels, repeat=end_to_end_repeat),
+            'update_batch': time_call(model.update_batch, images, labels, sgd, repeat=end_to_end_repeat),
+            'update_batch_sampled': time_call(model.update_batch, images, labels, sgd, None, 64, repeat=end_to_end_repeat),
+        }
+        for name, seconds in end_to_end.items():
+            results[f'batch{batch_size}/{name}'] = {'seconds': seconds, 'shapes': [list(images.shape)]}
+
+    meta = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'dtype': model.dtype.name,
+        'batch_sizes': list(batch_sizes),
+        'numpy': np.__version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+    }
+    return {'meta': meta, 'results': results}
+
+def compare_results(results, baseline, tolerance=0.1, min_delta=50e-6):
+    '''
+    Compare a benchmark_suite result with a stored baseline.
+    A case regresses when it is slower by more than tolerance (relative) and min_delta seconds,
+    so timer noise on microsecond kernels is not flagged.
+    -> rows (key, baseline seconds, seconds, ratio, regressed) for the cases in both
+    '''
+    rows = []
+    for key, base in baseline['results'].items():
+        if key in results['results']:
+            seconds = results['results'][key]['seconds']
+            regressed = seconds > base['seconds'] * (1 + tolerance) and seconds - base['seconds'] > min_delta
+            rows.append((key, base['seconds'], seconds, seconds / base['seconds'], regressed))
+    return rows
+
+def print_comparison(rows):
+    for key, base, seconds, ratio, regressed in rows:
+        print(f"{key:40s} {base*1e3:10.3f}ms -> {seconds*1e3:10.3f}ms  x{ratio:5.2f}{'  REGRESSION' if regressed else ''}")
+    print(f"{sum(row[4] for row in rows)} regressions in {len(rows)} cases")
+    return
+
+def benchmark_inference(model, batch_size=1, repeat=5, dtype=None):
+    '''
+    Compare the training kernels (mfm, pool, mfm_fc, which also build the switches for
+    backprop) with the inference kernels used by forward (mfm_inference, pool_inference) at every
+    mfm/pool layer of LightCNN-9, and time forward itself.
+    The saving of forward per image is the sum of the per-layer differences.
+    '''
+    dtype = model.dtype if dtype == None else np.dtype(dtype)
+    rows = []
+    kernels = [(name, shape, mfm, mfm_inference) for name, shape in MFM_SHAPES] + \
+              [(name, shape, pool, pool_inference) for name, shape in POOL_SHAPES] + \
+              [(name, shape, mfm_fc, mfm_inference) for name, shape in MFM_FC_SHAPES]
+    for name, shape, train_kernel, inference_kernel in kernels:
+        data = np.random.randn(*((batch_size,) + shape if batch_size > 1 else shape)).astype(dtype)
+        rows.append({
+            'layer': name,
+            'shape': shape,
+            'train_time': time_call(train_kernel, data, repeat=repeat) / batch_size,
+            'inference_time': time_call(inference_kernel, data, repeat=repeat) / batch_size,
+            'train_peak': peak_memory(train_kernel, data) / batch_size,
+            'inference_peak': peak_memory(inference_kernel, data) / batch_size,
+        })
+
+    images = np.random.rand(batch_size, 128, 128)
+    if batch_size > 1:
+        forward_time = time_call(model.forward_batch, images, batch_size, repeat=repeat) / batch_size
+        forward_peak = peak_memory(model.forward_batch, images, batch_size) / batch_size
+    else:
+        forward_time = time_call(model.forward, images[0], repeat=repeat)
+        forward_peak = peak_memory(model.forward, images[0])
+    saved_time = sum(row['train_time'] - row['inference_time'] for row in rows)
+    return {
+        'layers': rows,
+        'forward_time': forward_time,
+        'forward_peak': forward_peak,
+        'saved_time': saved_time,
+        'saved_time_ratio': saved_time / (forward_time + saved_time),
+        'saved_bytes': sum(row['train_peak'] - row['inference_peak'] for row in rows),
+    }
+
+def benchmark_data_parallel(model, batch_size=16, workers=(1, 2, 4), repeat=3):
+    '''
+    Gradient throughput (images/s) of one process (param_gradients) and of DataParallelTrainer
+    with each number of workers, on the same mini-batch.
+    Run with OMP_NUM_THREADS=1 (or the BLAS equivalent) so the workers do not oversubscribe the cores.
+    '''
+    from parallel import DataParallelTrainer
+    import optimizer as optim
+
+    images = np.random.rand(batch_size, 128, 128).astype(model.dtype)
+    labels = np.random.randint(0, model.num_classes, batch_size)
+    sgd = optim.SGD(model.parameters(), lr=0.0)
+
+    def single_process():
+        gradients, loss = model.param_gradients(images, labels)
+        sgd.zero_grad()
+        sgd.accumulate(gradients)
+
+    result = {'single_process': batch_size / time_call(single_process, repeat=repeat)}
+    for worker_num in workers:
+        with DataParallelTrainer(model, worker_num, max_batch_size=batch_size) as trainer:
+            sgd.rebind(model.parameters())
+            trainer.compute_gradients(images, labels, sgd)  # warm up the workers
+            result[f'workers_{worker_num}'] = batch_size / time_call(trainer.compute_gradients, images, labels, sgd, repeat=repeat)
+        sgd.rebind(model.parameters())
+    return result
+
+def compare_precision(model, images, labels, dtype=np.float32, rtol=1e-4, grad_rtol=1e-2):
+    '''
+    Run forward_batch and backprob with model (float64) and a copy cast to dtype,
+    check the results agree within rtol (features, loss) and grad_rtol (gradients,
+    which also move when a near tie in mfm/pool flips) and report the speedup
+    '''
+    low_model = model.astype(dtype)
+
+    time1 = time.time()
+    feature = model.forward_batch(images)
+    time2 = time.time()
+    low_feature = low_model.forward_batch(images)
+    time3 = time.time()
+
+    grads = model.backprob(images, labels)
+    time4 = time.time()
+    low_grads = low_model.backprob(images, labels)
+    time5 = time.time()
+
+    feature_error = relative_error(feature, low_feature)
+    grad_error = max(relative_error(g, low_g) for g, low_g in zip(grads[0]+grads[2], low_grads[0]+low_grads[2]))
+    loss_error = relative_error(grads[4], low_grads[4])
+    report = {
+        'dtype': np.dtype(dtype).name,
+        'feature_error': feature_error,
+        'grad_error': grad_error,
+        'loss_error': loss_error,
+        'forward_time': time2 - time1,
+        'low_forward_time': time3 - time2,
+        'backprob_time': time4 - time3,
+        'low_backprob_time': time5 - time4,
+        'weight_bytes': sum(getattr(model, name).nbytes for name in model.param_names),
+        'low_weight_bytes': sum(getattr(low_model, name).nbytes for name in low_model.param_names),
+    }
+    assert feature_error < rtol, f"{report['dtype']} features differ from float64 by {feature_error}"
+    assert grad_error < grad_rtol, f"{report['dtype']} gradients differ from float64 by {grad_error}"
+    assert loss_error < rtol, f"{report['dtype']} loss differs from float64 by {loss_error}"
+    return report
+
+
+def precision_and_inference_report():
+    np.random.seed(0)
+    batch_size = 8
+    images = np.random.rand(batch_size, 128, 128)
+    labels = np.random.randint(0, NUM_CLASSES, batch_size)
+
+    model = LightCNN_9()
+    for key, value in compare_precision(model, images, labels).items():
+        print(key, value)
+
+    report = benchmark_inference(model)
+    for row in report.pop('layers'):
+        print(f"{row['layer']:8s} time {row['train_time']*1e3:7.3f}ms -> {row['inference_time']*1e3:7.3f}ms  "
+              f"peak {row['train_peak']/2**20:7.2f}MB -> {row['inference_peak']/2**20:7.2f}MB")
+    for key, value in report.items():
+        print(key, value)
+
+    for key, value in benchmark_data_parallel(model.astype(np.float32)).items():
+        print(f"{key}: {value:.2f} images/s")
+
+
+def main(argv=None):
+    '''
+    python benchmark.py                                  precision, inference kernel and data-parallel report
+    python benchmark.py suite out.json [--baseline base.json] [--batch-sizes 1,8] [--dtype float32] [--autotune]
+    python benchmark.py compare new.json base.json       exit status 1 when a case regressed
+    -> exit status
+    '''
+    argv = sys.argv[1:] if argv == None else argv
+    if len(argv) == 0:
+        precision_and_inference_report()
+        return 0
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    suite = subparsers.add_parser('suite')
+    suite.add_argument('out')
+    suite.add_argument('--baseline')
+    suite.add_argument('--batch-sizes', default='1,8')
+    suite.add_argument('--dtype', default='float64')
+    suite.add_argument('--model')
+    suite.add_argument('--tolerance', type=float, default=0.1)
+    suite.add_argument('--autotune', action='store_true', help='use (and tune) the fastest conv algorithms, see conv_autotune.py')
+    compare = subparsers.add_parser('compare')
+    compare.add_argument('new')
+    compare.add_argument('baseline')
+    compare.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.command == 'suite':
+        if args.autotune:
+            enable_conv_autotuning()
+        np.random.seed(0)
+        model = LightCNN_9(args.model, dtype=np.dtype(args.dtype))
+        results = benchmark_suite(model, [int(size) for size in args.batch_sizes.split(',')])
+        file = open(args.out, 'w')
+        json.dump(results, file, indent=1)
+        file.close()
+        baseline_path = args.baseline
+    else:
+        file = open(args.new)
+        results = json.load(file)
+        file.close()
+        baseline_path = args.baseline
+    if baseline_path != None:
+        file = open(baseline_path)
+        baseline = json.load(file)
+        file.close()
+        rows = compare_results(results, baseline, args.tolerance)
+        print_comparison(rows)
+        return 1 if any(row[4] for row in rows) else 0
+    for key, value in results['results'].items():
+        print(f"{key:40s} {value['seconds']*1e3:10.3f}ms  {value['shapes']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
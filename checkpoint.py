@@ -0,0 +1,129 @@
+import numpy as np
+import glob
+import os
+import re
+import threading
+
+from model_format import save_weights, load_weights
+
+'''
+A checkpoint is one weight file (see model_format.py) holding the model parameters, the
+optimizer's state buffers ('optimizer/<buffer>/<param name>') and the numpy global RNG keys,
+with the training position (epoch, batch), loss so far and optimizer scalars in its attributes.
+It is written to a temp file and renamed, so a checkpoint on disk is always complete.
+'''
+CHECKPOINT_DIR = 'checkpoints'
+CHECKPOINT_PATTERN = re.compile(r'ckpt-(\d+)-(\d+)\.bin$')
+
+
+def checkpoint_name(epoch, batch):
+    return f'ckpt-{epoch:04d}-{batch:06d}.bin'
+
+def list_checkpoints(directory=CHECKPOINT_DIR):
+    '''
+    Checkpoint paths in directory, oldest (smallest (epoch, batch)) first
+    '''
+    found = []
+    for path in glob.glob(os.path.join(directory, 'ckpt-*.bin')):
+        match = CHECKPOINT_PATTERN.search(path)
+        if match:
+            found.append(((int(match.group(1)), int(match.group(2))), path))
+    return [path for position, path in sorted(found)]
+
+def latest_checkpoint(directory=CHECKPOINT_DIR):
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1] if checkpoints else None
+
+def load_checkpoint(path, model, optimizer=None):
+    '''
+    Copy the checkpoint's parameters (and optimizer state) into model and optimizer in place and
+    restore the numpy global RNG -> the training state dict: epoch, batch, loss_sum
+    '''
+    tensors, attributes = load_weights(path, 'r')
+    for name, param in model.parameters():
+        param[...] = tensors[name]
+    if optimizer != None:
+        state = dict(attributes['optimizer'])
+        assert state['names'] == optimizer.names
+        for key in optimizer.state_buffers():
+            state[key] = [tensors[f'optimizer/{key}/{name}'] for name in optimizer.names]
+        optimizer.load_state_dict(state)
+    rng = attributes['rng']
+    np.random.set_state((rng['name'], tensors['rng_keys'], rng['pos'], rng['has_gauss'], rng['cached_gaussian']))
+    return attributes['train']
+
+
+class Checkpointer(object):
+    '''
+    Writes checkpoints from a background thread.
+    save() copies the parameters and optimizer buffers into preallocated snapshot arrays and returns;
+    the thread writes the snapshot and then deletes all but the newest `keep` checkpoints.
+    At most one write is in flight: save() waits for the previous one before overwriting the snapshot.
+    An error in the writer is raised by the next save() or close().
+    '''
+    def __init__(self, model, optimizer, directory=CHECKPOINT_DIR, keep=3):
+        self.model = model
+        self.optimizer = optimizer
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self.names = [name for name, param in model.parameters()]
+        for key in optimizer.state_buffers():
+            self.names += [f'optimizer/{key}/{name}' for name in optimizer.names]
+        self.snapshot = [np.empty_like(array) for array in self.arrays()]
+        self.thread = None
+        self.error = None
+        return
+
+    def arrays(self):
+        '''
+        Live arrays in the order of self.names; looked up on every save since the
+        model's parameters can be rebound (e.g. moved to shared memory)
+        '''
+        arrays = [param for name, param in self.model.parameters()]
+        for key in self.optimizer.state_buffers():
+            arrays += getattr(self.optimizer, key)
+        return arrays
+
+    def save(self, epoch, batch, loss_sum=0.0):
+        '''
+        Checkpoint the training position: `batch` batches of epoch `epoch` are done
+        '''
+        self.wait()
+        for snapshot, array in zip(self.snapshot, self.arrays()):
+            np.copyto(snapshot, array)
+        name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        optimizer_state = {'names': self.optimizer.names, 'lr': self.optimizer.lr,
+                           'epoch': self.optimizer.epoch, 'step_num': self.optimizer.step_num}
+        attributes = {
+            'sim_thr': float(self.model.sim_thr),
+            'train': {'epoch': epoch, 'batch': batch, 'loss_sum': float(loss_sum)},
+            'optimizer': optimizer_state,
+            'rng': {'name': name, 'pos': int(pos), 'has_gauss': int(has_gauss), 'cached_gaussian': float(cached_gaussian)},
+        }
+        tensors = list(zip(self.names, self.snapshot)) + [('rng_keys', keys)]
+        path = os.path.join(self.directory, checkpoint_name(epoch, batch))
+        self.thread = threading.Thread(target=self.write, args=(path, tensors, attributes), daemon=True)
+        self.thread.start()
+        return path
+
+    def write(self, path, tensors, attributes):
+        try:
+            save_weights(path, tensors, attributes)
+            for old in list_checkpoints(self.directory)[:-self.keep]:
+                os.remove(old)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+        if self.error != None:
+            error, self.error = self.error, None
+            raise error
+        return
+
+    def close(self):
+        self.wait()
+        return
@@ -0,0 +1,170 @@
+import time
+START = time.perf_counter()
+
+import argparse
+import sys
+
+'''
+Command-line entry point:
+    python cli.py train    --images './train_image/*/*/*.jpg' [--model LightCNN9_model.bin] [--epochs 20] ...
+    python cli.py embed    MODEL IMAGE... --out embeddings.npy
+    python cli.py verify   MODEL IMAGE1 IMAGE2 [IMAGE1 IMAGE2 ...] [--threshold T] [--timing]
+    python cli.py evaluate MODEL PAIRS [MISMATCH_PAIRS] [--out result.txt]
+    python cli.py bench    [suite out.json ... | compare new.json base.json]   (see benchmark.py)
+Each command imports only what it uses: the model code when it loads a model, scikit-image when images
+are decoded (utils.load_image), pandas and the training code only for train. The model is loaded once
+per invocation, memory-mapped, and serves every pair or image of the command.
+Convolutions use the algorithms already tuned in conv_autotune.json; train (or --autotune) tunes new shapes.
+MODEL is a weight file of LightCNN_9 or of its int8 version (quantize.py).
+'''
+
+
+def log_time(args, phase):
+    if args.timing:
+        print(f"{phase:12s} {(time.perf_counter() - START)*1e3:8.1f}ms", file=sys.stderr)
+    return
+
+def load(args):
+    from quantize import load_model
+    log_time(args, 'imports')
+    model = load_model(args.model)
+    log_time(args, 'model')
+    return model
+
+def embed_images(args, model, paths):
+    '''
+    Features of image files, through the embedding cache when --cache-dir is given
+    '''
+    import numpy as np
+    from utils import load_images
+    if args.cache_dir != None and hasattr(model, 'embed_files'):
+        return model.embed_files(paths, args.cache_dir, args.batch_size, args.workers)
+    images = np.array(list(load_images(paths, args.workers)), dtype=model.dtype)
+    log_time(args, 'decode')
+    return model.forward_batch(images, args.batch_size)
+
+def train(args):
+    import numpy as np
+    from main import LightCNN_9
+    from utils import build_traindata_cache, traindata_cache_loader, traindata_class_count
+    build_traindata_cache(args.images, args.train_cache, np.dtype(args.dtype), args.workers)
+    data, labels = traindata_cache_loader(args.train_cache)
+    num_classes = args.num_classes if args.num_classes != None else traindata_class_count(args.train_cache)
+    model = LightCNN_9(args.init, dtype=np.dtype(args.dtype), num_classes=num_classes)
+    model.train(data, labels, epoch=args.epochs, min_batch_size=args.batch_size, eta=args.eta, seed=args.seed,
+                workers=args.train_workers, resume=args.resume, checkpoint_every=args.checkpoint_every,
+                num_sampled=args.num_sampled, save_path=args.model)
+    return 0
+
+def embed(args):
+    import numpy as np
+    model = load(args)
+    features = embed_images(args, model, args.images)
+    np.save(args.out, features)
+    log_time(args, 'total')
+    print(f"{len(features)} embeddings -> {args.out}")
+    return 0
+
+def verify(args):
+    from evaluation import pearson_scores
+    if len(args.images) % 2 != 0:
+        print("verify takes pairs of images", file=sys.stderr)
+        return 2
+    model = load(args)
+    sim_thr = model.sim_thr if args.threshold == None else args.threshold
+    features = embed_images(args, model, args.images)
+    log_time(args, 'forward')
+    for score in pearson_scores(features[0::2], features[1::2]):
+        print(f"{int(score >= sim_thr)} {score:.6f}")
+    log_time(args, 'total')
+    return 0
+
+def evaluate(args):
+    from pairs import PairScorer
+    model = load(args)
+    sim_thr = model.sim_thr if args.threshold == None else args.threshold
+    with PairScorer(model, args.cache_dir, args.batch_size, args.workers) as scorer:
+        if args.mismatch == None:   # one protocol, labels (if any) from the manifest
+            counts = scorer.run(args.pairs, args.out, sim_thr, with_scores=True)
+            for key, value in counts.items():
+                print(f"{key}: {value}")
+            return 0
+        from evaluation import evaluate as evaluate_scores
+        match_scores = scorer.scores(args.pairs)
+        mismatch_scores = scorer.scores(args.mismatch, len(match_scores))
+    for key, value in evaluate_scores(match_scores, mismatch_scores, sim_thr).items():
+        print(f"{key}: {value}")
+    return 0
+
+def bench(args):
+    import benchmark
+    return benchmark.main(args.arguments)
+
+def parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description='LightCNN-9 face verification')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    command = subparsers.add_parser('train', help='train a model on a directory of face images')
+    command.add_argument('--images', default='./train_image/*/*/*.jpg', help='glob of the training images')
+    command.add_argument('--model', default='LightCNN9_model.bin', help='where the trained weights are saved')
+    command.add_argument('--init', help='weight file to start from, a new model by default')
+    command.add_argument('--epochs', type=int, default=20)
+    command.add_argument('--batch-size', type=int, default=64)
+    command.add_argument('--eta', type=float, default=0.0005)
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--dtype', default='float32')
+    command.add_argument('--train-cache', default='train_cache')
+    command.add_argument('--workers', type=int, help='image decoding processes, all cores by default')
+    command.add_argument('--train-workers', type=int, help='data-parallel gradient processes')
+    command.add_argument('--resume', action='store_true', help='continue from the latest checkpoint')
+    command.add_argument('--checkpoint-every', type=int)
+    command.add_argument('--num-classes', type=int, help='identities of the output layer, those of the training images by default')
+    command.add_argument('--num-sampled', type=int, help='train the output layer with a sampled softmax')
+    command.set_defaults(run=train, autotune=True)
+
+    command = subparsers.add_parser('embed', help='write the embeddings of images to a .npy file')
+    command.add_argument('model')
+    command.add_argument('images', nargs='+')
+    command.add_argument('--out', default='embeddings.npy')
+    command.set_defaults(run=embed)
+
+    command = subparsers.add_parser('verify', help='decide whether pairs of images show the same person')
+    command.add_argument('model')
+    command.add_argument('images', nargs='+', help='IMAGE1 IMAGE2 of each pair')
+    command.add_argument('--threshold', type=float, help="the model's sim_thr by default")
+    command.set_defaults(run=verify)
+
+    command = subparsers.add_parser('evaluate', help='score a pair protocol (see pairs.py)')
+    command.add_argument('model')
+    command.add_argument('pairs', help='directory of pair directories or CSV manifest')
+    command.add_argument('mismatch', nargs='?', help='mismatch pairs, PAIRS are then the match pairs')
+    command.add_argument('--out', default='result.txt', help='decision,score of every pair of a single protocol')
+    command.add_argument('--threshold', type=float, help="the model's sim_thr by default")
+    command.set_defaults(run=evaluate)
+
+    command = subparsers.add_parser('bench', help='benchmark suite, arguments of benchmark.py')
+    command.add_argument('arguments', nargs=argparse.REMAINDER)
+    command.set_defaults(run=bench)
+
+    for name in ('embed', 'verify', 'evaluate'):
+        command = subparsers.choices[name]
+        command.add_argument('--batch-size', type=int, default=64)
+        command.add_argument('--workers', type=int, default=1, help='image decoding processes')
+        command.add_argument('--cache-dir', help='embedding cache directory, none by default')
+        command.add_argument('--autotune', action='store_true',
+                             help='time the conv algorithms of shapes not tuned yet, by default they use img2col/direct1x1')
+    for command in subparsers.choices.values():
+        command.add_argument('--timing', action='store_true', help='print the time of each phase to stderr')
+    return parser
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    if args.command != 'bench':
+        from conv_autotune import enable_conv_autotuning
+        # tuned conv algorithms from conv_autotune.json; only train (and --autotune) times new shapes
+        enable_conv_autotuning(tune=args.autotune)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
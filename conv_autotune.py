@@ -0,0 +1,137 @@
+import numpy as np
+import json
+import os
+import platform
+import threading
+import time
+
+import forward_layers
+from forward_layers import CONV_ALGORITHMS, conv_algorithms_for, conv_img2col, default_conv_algorithm
+
+# One file per checkout, wherever the process runs from
+CONV_AUTOTUNE_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conv_autotune.json')
+
+
+def machine_signature():
+    '''
+    What the timings depend on; a cache written on another machine or numpy is not reused
+    '''
+    return {'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'numpy': np.__version__}
+
+def batch_bucket(batch_size):
+    '''
+    The power of two >= batch_size: shapes are tuned once per bucket, not per batch size
+    '''
+    return 1 << (batch_size - 1).bit_length()
+
+
+class ConvAutotuner(object):
+    '''
+    Chooses the conv algorithm (forward_layers.CONV_ALGORITHMS) for each (input shape, filter shape, dtype),
+    the batch size rounded up to a power of two (batch_bucket).
+    With tune, the first time a shape is seen every applicable algorithm runs on random data of that shape;
+    algorithms whose result differs from img2col by more than rtol are dropped and the fastest of
+    the rest (best of repeat) wins. Without tune, shapes not in the cache use default_conv_algorithm,
+    so nothing is timed inside a request. Choices are kept in a JSON file at path, shared by every
+    process, so each shape is tuned once per machine.
+    forward and backward both go through forward_layers.conv, so the backward convolutions
+    (get_derivative_conv2pool) use the choices of their own shapes.
+    '''
+    def __init__(self, path=CONV_AUTOTUNE_CACHE, tune=True, repeat=3, rtol=1e-4):
+        self.path = path
+        self.tune_missing = tune
+        self.repeat = repeat
+        self.rtol = rtol
+        self.lock = threading.Lock()
+        self.choices = self.load()
+        return
+
+    def load(self):
+        if self.path == None or not os.path.exists(self.path):
+            return {}
+        file = open(self.path)
+        data = json.load(file)
+        file.close()
+        if data.get('signature') != machine_signature():
+            return {}
+        return data['choices']
+
+    def save(self):
+        '''
+        Merge the choices into the file (other processes may have added shapes) and replace it atomically
+        '''
+        if self.path == None:
+            return
+        choices = dict(self.load())
+        choices.update(self.choices)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        file = open(tmp_path, 'w')
+        json.dump({'signature': machine_signature(), 'choices': choices}, file, indent=1)
+        file.close()
+        os.replace(tmp_path, self.path)
+        return
+
+    @staticmethod
+    def key(data_shape, filter_shape, dtype):
+        data_shape = (batch_bucket(data_shape[0]),) + tuple(data_shape[1:])
+        return f"{'x'.join(map(str, data_shape))}|{'x'.join(map(str, filter_shape))}|{np.dtype(dtype).name}"
+
+    def select(self, data_shape, filter_shape, dtype):
+        choice = self.choices.get(self.key(data_shape, filter_shape, dtype))
+        if choice == None:
+            if not self.tune_missing:
+                return default_conv_algorithm(data_shape, filter_shape, dtype)
+            choice = self.tune(data_shape, filter_shape, dtype)
+        return choice['algorithm']
+
+    def tune(self, data_shape, filter_shape, dtype):
+        key = self.key(data_shape, filter_shape, dtype)
+        data_shape = (batch_bucket(data_shape[0]),) + tuple(data_shape[1:])
+        with self.lock:
+            if key in self.choices:
+                return self.choices[key]
+            rng = np.random.default_rng(0)
+            data = rng.standard_normal(data_shape).astype(dtype)
+            filter = rng.standard_normal(filter_shape).astype(dtype)
+            bias = np.zeros(filter_shape[3], dtype=dtype)
+            reference = conv_img2col(data, filter, bias)
+            out = np.empty_like(reference)
+            seconds = {}
+            for name in conv_algorithms_for(filter_shape):
+                algorithm = CONV_ALGORITHMS[name]
+                result = algorithm(data, filter, bias, out)
+                error = np.linalg.norm(result - reference) / max(np.linalg.norm(reference), 1e-30)
+                if error > self.rtol:
+                    continue
+                best = np.inf
+                for i in range(self.repeat):
+                    start = time.perf_counter()
+                    algorithm(data, filter, bias, out)
+                    best = min(best, time.perf_counter() - start)
+                seconds[name] = best
+            choice = {'algorithm': min(seconds, key=seconds.get), 'seconds': seconds}
+            self.choices[key] = choice
+            self.save()
+        return choice
+
+
+def enable_conv_autotuning(path=CONV_AUTOTUNE_CACHE, tune=True):
+    '''
+    Make forward_layers.conv pick its algorithm with a ConvAutotuner caching to path -> the autotuner
+    tune: time the shapes not in the cache when first seen, else use default_conv_algorithm for them
+    '''
+    autotuner = ConvAutotuner(path, tune)
+    forward_layers.conv_algorithm_selector = autotuner.select
+    return autotuner
+
+def disable_conv_autotuning():
+    forward_layers.conv_algorithm_selector = default_conv_algorithm
+    return
+
+
+if __name__ == "__main__":
+    # python conv_autotune.py: print the cached choices
+    autotuner = ConvAutotuner()
+    for key, choice in autotuner.choices.items():
+        print(f"{key:45s} {choice['algorithm']:10s} " + ' '.join(f"{name} {seconds*1e3:.2f}ms" for name, seconds in choice['seconds'].items()))
@@ -0,0 +1,113 @@
+import numpy as np
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+EMBEDDING_CACHE_DIR = 'embedding_cache'
+
+
+def content_hash(data):
+    '''
+    hash of raw bytes (an image file or model weights)
+    '''
+    return hashlib.sha1(data).hexdigest()
+
+class EmbeddingCache(object):
+    '''
+    On-disk embedding store keyed by (image content hash, model weights hash, preprocessing version).
+    Embeddings live in a memory-mapped (capacity, dim) array, the key -> row index in a pickled
+    OrderedDict kept in least-recently-used order. When the store is full the least recently used
+    entry is evicted.
+    '''
+    def __init__(self, path=EMBEDDING_CACHE_DIR, capacity=50000, dim=256):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.capacity = capacity
+        self.dim = dim
+        self.array_path = os.path.join(path, 'embeddings.npy')
+        self.index_path = os.path.join(path, 'index.pkl')
+
+        old_embeddings = None
+        self.index = OrderedDict()
+        if os.path.exists(self.array_path) and os.path.exists(self.index_path):
+            file = open(self.index_path, 'rb')
+            self.index = pickle.loads(file.read())
+            file.close()
+            old_embeddings = np.load(self.array_path, mmap_mode='r+')
+        if old_embeddings is not None and old_embeddings.shape == (capacity, dim):
+            self.embeddings = old_embeddings
+        else:   # New store, or capacity/dim changed: keep the most recently used entries that fit
+            old_index = self.index if old_embeddings is not None and old_embeddings.shape[1] == dim else OrderedDict()
+            old_data = {key: np.array(old_embeddings[slot]) for key, slot in list(old_index.items())[-capacity:]}
+            del old_embeddings
+            self.embeddings = np.lib.format.open_memmap(self.array_path, mode='w+', dtype=np.double, shape=(capacity, dim))
+            self.index = OrderedDict()
+            for slot, (key, embedding) in enumerate(old_data.items()):
+                self.embeddings[slot] = embedding
+                self.index[key] = slot
+        used = set(self.index.values())
+        self.free_slots = [slot for slot in range(capacity-1, -1, -1) if slot not in used]
+        return
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, key):
+        '''
+        Return a copy of the stored embedding, or None
+        '''
+        slot = self.index.get(key)
+        if slot is None:
+            return None
+        self.index.move_to_end(key)
+        return np.array(self.embeddings[slot])
+
+    def put(self, key, embedding):
+        assert embedding.shape == (self.dim,)
+        if key in self.index:
+            slot = self.index[key]
+            self.index.move_to_end(key)
+        else:
+            if len(self.free_slots) == 0:  # Evict the least recently used entry
+                _, slot = self.index.popitem(last=False)
+            else:
+                slot = self.free_slots.pop()
+            self.index[key] = slot
+        self.embeddings[slot] = embedding
+        return
+
+    def invalidate(self, weights_hash):
+        '''
+        Drop every entry computed with weights other than weights_hash
+        '''
+        for key in [key for key in self.index if key[1] != weights_hash]:
+            self.free_slots.append(self.index.pop(key))
+        return
+
+    def flush(self):
+        '''
+        Write embeddings and index to disk; the index is replaced atomically
+        '''
+        self.embeddings.flush()
+        tmp_path = self.index_path + '.tmp'
+        file = open(tmp_path, 'wb')
+        file.write(pickle.dumps(self.index))
+        file.close()
+        os.replace(tmp_path, self.index_path)
+        return
+
+def invalidate_embedding_cache(weights_hash, path=EMBEDDING_CACHE_DIR):
+    '''
+    Drop stale entries from the store at path, if there is one
+    '''
+    if not os.path.exists(os.path.join(path, 'index.pkl')) or not os.path.exists(os.path.join(path, 'embeddings.npy')):
+        return
+    capacity, dim = np.load(os.path.join(path, 'embeddings.npy'), mmap_mode='r').shape
+    cache = EmbeddingCache(path, capacity=capacity, dim=dim)
+    cache.invalidate(weights_hash)
+    cache.flush()
+    return
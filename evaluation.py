@@ -0,0 +1,125 @@
+import numpy as np
+import sys
+
+
+def pearson_scores(features1, features2):
+    '''
+    Pearson correlation of each row pair, same as np.corrcoef(features1[i], features2[i])[0,1]
+    (n, d), (n, d) -> (n)
+    '''
+    features1 = normalize_features(features1)
+    features2 = normalize_features(features2)
+    return np.sum(features1 * features2, axis=-1)
+
+def normalize_features(features):
+    '''
+    Center each feature vector and scale it to unit norm, so Pearson correlation is a dot product
+    (n, d) -> (n, d)
+    '''
+    features = np.asarray(features, dtype=np.double)
+    centered = features - np.mean(features, axis=-1, keepdims=True)
+    norm = np.linalg.norm(centered, axis=-1, keepdims=True)
+    return centered / np.maximum(norm, 1e-12)
+
+def threshold_sweep(match_scores, mismatch_scores):
+    '''
+    Confusion counts and metrics for every distinct threshold in one pass.
+    A pair is predicted "match" when its score >= threshold.
+    Scores are sorted once (descending); the counts at each distinct score are cumulative sums.
+    Returns a dict of arrays indexed like 'thresholds' (descending).
+    '''
+    match_scores = np.asarray(match_scores, dtype=np.double).ravel()
+    mismatch_scores = np.asarray(mismatch_scores, dtype=np.double).ravel()
+    scores = np.concatenate((match_scores, mismatch_scores))
+    is_match = np.concatenate((np.ones(len(match_scores), dtype=bool), np.zeros(len(mismatch_scores), dtype=bool)))
+
+    order = np.argsort(-scores, kind='stable')
+    scores = scores[order]
+    is_match = is_match[order]
+    tp = np.cumsum(is_match)
+    fp = np.cumsum(~is_match)
+    # Last position of each run of equal scores: everything up to it is >= that score
+    last = np.r_[np.nonzero(np.diff(scores))[0], len(scores) - 1]
+    tp = tp[last]
+    fp = fp[last]
+    fn = len(match_scores) - tp
+    tn = len(mismatch_scores) - fp
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = tp / max(len(match_scores), 1)
+        f1 = np.where(tp > 0, 2 * tp / (2 * tp + fp + fn), 0.0)
+        fpr = fp / max(len(mismatch_scores), 1)
+    return {
+        'thresholds': scores[last],
+        'tp': tp,
+        'fp': fp,
+        'fn': fn,
+        'tn': tn,
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+        'tpr': recall,
+        'fpr': fpr,
+    }
+
+def best_threshold(match_scores, mismatch_scores):
+    '''
+    Threshold with the best F1 score -> (threshold, F1)
+    '''
+    sweep = threshold_sweep(match_scores, mismatch_scores)
+    i = np.argmax(sweep['f1'])
+    return float(sweep['thresholds'][i]), float(sweep['f1'][i])
+
+def roc_curve(match_scores, mismatch_scores):
+    '''
+    (fpr, tpr, thresholds) with fpr increasing
+    '''
+    sweep = threshold_sweep(match_scores, mismatch_scores)
+    return sweep['fpr'], sweep['tpr'], sweep['thresholds']
+
+def tar_at_far(match_scores, mismatch_scores, far=(1e-3, 1e-2, 1e-1)):
+    '''
+    True accept rate at each target false accept rate -> {far: (tar, threshold)}
+    '''
+    sweep = threshold_sweep(match_scores, mismatch_scores)
+    result = {}
+    for target in far:
+        allowed = np.nonzero(sweep['fpr'] <= target)[0]
+        if len(allowed) == 0:
+            result[target] = (0.0, np.inf)
+        else:   # tpr grows as the threshold drops, so the last allowed threshold is the best
+            result[target] = (sweep['tpr'][allowed[-1]], sweep['thresholds'][allowed[-1]])
+    return result
+
+def evaluate(match_scores, mismatch_scores, sim_thr=None):
+    '''
+    Precision/recall/F1 at sim_thr (default: the best threshold) plus TAR@FAR
+    '''
+    threshold, best_f1 = best_threshold(match_scores, mismatch_scores)
+    if sim_thr == None:
+        sim_thr = threshold
+    match_scores = np.asarray(match_scores)
+    mismatch_scores = np.asarray(mismatch_scores)
+    TP = np.count_nonzero(match_scores >= sim_thr)
+    FP = np.count_nonzero(mismatch_scores >= sim_thr)
+    FN = len(match_scores) - TP
+    precision = TP / (TP + FP) if TP + FP > 0 else 0.0
+    recall = TP / (TP + FN) if TP + FN > 0 else 0.0
+    return {
+        'sim_thr': sim_thr,
+        'precision': precision,
+        'recall': recall,
+        'F1': 2 * TP / (2 * TP + FP + FN) if TP > 0 else 0.0,
+        'best_thr': threshold,
+        'best_F1': best_f1,
+        'tar_at_far': tar_at_far(match_scores, mismatch_scores),
+    }
+
+
+if __name__ == "__main__":
+    # python evaluation.py match_scores.txt mismatch_scores.txt, one similarity score per line
+    match = np.loadtxt(sys.argv[1], ndmin=1)
+    mismatch = np.loadtxt(sys.argv[2], ndmin=1)
+    for key, value in evaluate(match, mismatch).items():
+        print(key, value)
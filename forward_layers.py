@@ -1,122 +1,327 @@
 import numpy as np
-from skimage import measure
 
-def conv(data_in, filter, filter_bias):
+def conv(data_in, filter, filter_bias, out=None, algorithm=None):
     '''
       Convolve with stride=1 and padding=0
       (l, w, h), (fl, fw, h, n), (n) -> (l-fl+1, w-fw+1, n)
+      (N, l, w, h), (fl, fw, h, n), (n) -> (N, l-fl+1, w-fw+1, n) for a batch
+      out: optional C-contiguous output array
+      algorithm: one of CONV_ALGORITHMS, by default chosen by conv_algorithm_selector for the shapes
     '''
-    assert len(data_in.shape) == 3 and len(filter.shape) == 4 and len(filter_bias.shape) == 1
-    assert data_in.shape[2] == filter.shape[2]    # must share the same height
+    if algorithm == None:
+        algorithm = conv_algorithm_selector(data_in.shape, filter.shape, data_in.dtype)
+    return CONV_ALGORITHMS[algorithm](data_in, filter, filter_bias, out)
+
+def conv_img2col(data_in, filter, filter_bias, out=None):
+    '''
+      conv with img2col: every filter-sized window of data_in becomes a row, then one matmul
+    '''
+    assert len(data_in.shape) in (3, 4) and len(filter.shape) == 4 and len(filter_bias.shape) == 1
+    assert data_in.shape[-1] == filter.shape[2]    # must share the same height
     assert filter.shape[3] == filter_bias.shape[0]  # each conv kernel has a bias
-    input_len, input_width, input_height = data_in.shape
+    batch_shape = data_in.shape[:-3]
+    input_len, input_width, input_height = data_in.shape[-3:]
     filter_len, filter_width, filter_height, filter_num = filter.shape
     feature_len = input_len - filter_len + 1
     feature_width = input_width - filter_width + 1
     feature_height = filter_num
-    img2col = np.lib.stride_tricks.as_strided(data_in, shape=(feature_len, feature_width, filter_len, filter_width, filter_height), strides=(8*input_height*input_width, 8*input_height, 8*input_height*input_width, 8*input_height, 8))
-    img2col = np.reshape(img2col, (feature_len, feature_width, filter_len*filter_width*filter_height))
+    batch_strides = data_in.strides[:-3]
+    len_stride, width_stride, height_stride = data_in.strides[-3:]
+    img2col = np.lib.stride_tricks.as_strided(data_in, shape=batch_shape+(feature_len, feature_width, filter_len, filter_width, filter_height), strides=batch_strides+(len_stride, width_stride, len_stride, width_stride, height_stride))
+    img2col = np.reshape(img2col, batch_shape+(feature_len, feature_width, filter_len*filter_width*filter_height))
     filter = np.reshape(filter, (filter_len*filter_width*filter_height, filter_num))
-    output = np.add(np.matmul(img2col, filter), filter_bias)
-    assert output.shape == (feature_len, feature_width, feature_height)
+    output = np.matmul(img2col, filter, out=out)
+    output += filter_bias
+    assert output.shape == batch_shape+(feature_len, feature_width, feature_height)
+    return output
+
+def conv_1x1(data_in, filter, filter_bias, out=None):
+    '''
+      conv with a 1*1 filter: a matmul over the channels, no img2col copy
+    '''
+    assert filter.shape[0] == 1 and filter.shape[1] == 1
+    assert data_in.shape[-1] == filter.shape[2]
+    output = np.matmul(data_in, filter.reshape(filter.shape[2], filter.shape[3]), out=out)
+    output += filter_bias
     return output
 
-def mfm(data_in):
+# Winograd F(2x2, 3x3): Y = A^T [(G g G^T) * (B^T d B)] A for each 4*4 input tile d and 3*3 filter g
+WINOGRAD_G = np.array([[1, 0, 0], [0.5, 0.5, 0.5], [0.5, -0.5, 0.5], [0, 0, 1]])
+
+def conv_winograd(data_in, filter, filter_bias, out=None):
+    '''
+      conv with a 3*3 filter by Winograd F(2x2, 3x3): the output is computed in 2*2 tiles from
+      overlapping 4*4 input tiles, with 16 matmuls over the channels instead of 36 multiplies per tile.
+      The transformed input is 4x the input, img2col would be 9x.
+    '''
+    assert filter.shape[0] == 3 and filter.shape[1] == 3
+    assert data_in.shape[-1] == filter.shape[2]
+    single = len(data_in.shape) == 3
+    data = data_in[None] if single else data_in
+    batch_num, input_len, input_width, channel = data.shape
+    filter_num = filter.shape[3]
+    feature_len, feature_width = input_len - 2, input_width - 2
+    tile_len, tile_width = (feature_len + 1) // 2, (feature_width + 1) // 2
+    if feature_len % 2 or feature_width % 2:   # odd output: pad to whole tiles, crop at the end
+        data = np.pad(data, ((0, 0), (0, feature_len % 2), (0, feature_width % 2), (0, 0)))
+
+    # Input transform B^T d B, laid out as 16 (tiles, channel) matrices
+    batch_stride, len_stride, width_stride, channel_stride = data.strides
+    tiles = np.lib.stride_tricks.as_strided(data, shape=(batch_num, tile_len, tile_width, 4, 4, channel),
+        strides=(batch_stride, 2*len_stride, 2*width_stride, len_stride, width_stride, channel_stride))
+    rows = np.empty((4, batch_num, tile_len, tile_width, 4, channel), dtype=data.dtype)
+    np.subtract(tiles[:,:,:,0], tiles[:,:,:,2], out=rows[0])
+    np.add(tiles[:,:,:,1], tiles[:,:,:,2], out=rows[1])
+    np.subtract(tiles[:,:,:,2], tiles[:,:,:,1], out=rows[2])
+    np.subtract(tiles[:,:,:,1], tiles[:,:,:,3], out=rows[3])
+    transformed = np.empty((4, 4, batch_num, tile_len, tile_width, channel), dtype=data.dtype)
+    np.subtract(rows[...,0,:], rows[...,2,:], out=transformed[:,0])
+    np.add(rows[...,1,:], rows[...,2,:], out=transformed[:,1])
+    np.subtract(rows[...,2,:], rows[...,1,:], out=transformed[:,2])
+    np.subtract(rows[...,1,:], rows[...,3,:], out=transformed[:,3])
+    del rows
+
+    # Filter transform G g G^T and the 16 matmuls
+    g = WINOGRAD_G.astype(filter.dtype)
+    filter_transformed = np.einsum('ai,ijck,bj->abck', g, filter, g).reshape(16, channel, filter_num)
+    product = np.matmul(transformed.reshape(16, -1, channel), filter_transformed)
+    product = product.reshape(4, 4, batch_num, tile_len, tile_width, filter_num)
+    del transformed
+
+    # Output transform A^T m A, A^T = [[1, 1, 1, 0], [0, 1, -1, -1]]
+    half = np.empty((2, 4) + product.shape[2:], dtype=product.dtype)
+    np.add(product[0], product[1], out=half[0])
+    half[0] += product[2]
+    np.subtract(product[1], product[2], out=half[1])
+    half[1] -= product[3]
+    output_shape = (batch_num, 2*tile_len, 2*tile_width, filter_num)
+    cropped = output_shape[1:3] != (feature_len, feature_width)
+    if out is None or cropped or single:
+        output = np.empty(output_shape, dtype=product.dtype)
+    else:
+        output = out
+    tiled = output.reshape(batch_num, tile_len, 2, tile_width, 2, filter_num)
+    for a in range(2):
+        np.add(half[a,0], half[a,1], out=tiled[:,:,a,:,0])
+        tiled[:,:,a,:,0] += half[a,2]
+        np.subtract(half[a,1], half[a,2], out=tiled[:,:,a,:,1])
+        tiled[:,:,a,:,1] -= half[a,3]
+    output = output[:, :feature_len, :feature_width]
+    if single:
+        output = output[0]
+    if out is not None and output is not out:
+        out[...] = output
+        output = out
+    output += filter_bias
+    return output
+
+def conv_fft(data_in, filter, filter_bias, out=None, chunk_size=8):
+    '''
+      conv by FFT: the correlation of each input channel with a filter is a pointwise product of
+      their 2D real FFTs (the filter's conjugated), summed over channels with a matmul per frequency.
+      The batch is transformed chunk_size images at a time to bound the memory of the spectra.
+    '''
+    assert data_in.shape[-1] == filter.shape[2]
+    single = len(data_in.shape) == 3
+    data = data_in[None] if single else data_in
+    batch_num, input_len, input_width, channel = data.shape
+    filter_len, filter_width, filter_height, filter_num = filter.shape
+    feature_len, feature_width = input_len - filter_len + 1, input_width - filter_width + 1
+    if out is None:
+        output = np.empty((batch_num, feature_len, feature_width, filter_num), dtype=data.dtype)
+    else:
+        output = out[None] if single else out
+
+    # (input_len, input_width//2+1, channel, filter_num)
+    filter_spectrum = np.conj(np.fft.rfft2(filter, s=(input_len, input_width), axes=(0, 1)))
+    for k in range(0, batch_num, chunk_size):
+        spectrum = np.fft.rfft2(data[k:k+chunk_size], axes=(1, 2))
+        product = np.matmul(spectrum.transpose(1, 2, 0, 3), filter_spectrum)
+        result = np.fft.irfft2(product.transpose(2, 0, 1, 3), s=(input_len, input_width), axes=(1, 2))
+        output[k:k+chunk_size] = result[:, :feature_len, :feature_width]
+    output += filter_bias
+    return output[0] if single and out is None else (out if out is not None else output)
+
+CONV_ALGORITHMS = {
+    'img2col': conv_img2col,
+    'direct1x1': conv_1x1,
+    'winograd': conv_winograd,
+    'fft': conv_fft,
+}
+
+def conv_algorithms_for(filter_shape):
+    '''
+    names of the CONV_ALGORITHMS that can run a filter of this shape
+    '''
+    names = ['img2col']
+    if filter_shape[0] == 1 and filter_shape[1] == 1:
+        names.append('direct1x1')
+    if filter_shape[0] == 3 and filter_shape[1] == 3:
+        names.append('winograd')
+    if filter_shape[0] >= 5 or filter_shape[1] >= 5:   # FFT only pays off for large filters
+        names.append('fft')
+    return names
+
+def default_conv_algorithm(data_shape, filter_shape, dtype):
+    '''
+    conv algorithm without autotuning: direct1x1 for 1*1 filters, img2col otherwise
+    '''
+    if filter_shape[0] == 1 and filter_shape[1] == 1:
+        return 'direct1x1'
+    return 'img2col'
+
+# (data shape, filter shape, dtype) -> name in CONV_ALGORITHMS, used by conv; see conv_autotune.py
+conv_algorithm_selector = default_conv_algorithm
+
+def mfm(data_in, out=None, switch=None):
     '''
     max-feature-map 2/1
     (l, w, h) -> (l, w, h/2)  
+    (N, l, w, h) -> (N, l, w, h/2) for a batch
+    also returns the switch for backprop, one bool per output: True where the second half won
+    out, switch: optional output arrays
     '''
-    assert len(data_in.shape) == 3
-    assert data_in.shape[2]%2 == 0
-    input_len, input_width, input_height = data_in.shape
-    split = np.zeros((2,input_len, input_width, input_height//2), dtype=np.double)
-    split[0] = data_in[:,:,:input_height//2]
-    split[1] = data_in[:,:,input_height//2:]
-    output = np.amax(split, axis=0)
-    repmax = np.zeros(data_in.shape, dtype=np.double)
-    repmax[:,:,:input_height//2] = repmax[:,:,input_height//2:] = output
-    location = (repmax == data_in)
-    assert output.shape == (input_len, input_width, input_height//2)
-    assert location.shape == data_in.shape
-    return output, location
-
-def pool(data_in):
+    assert len(data_in.shape) in (3, 4)
+    assert data_in.shape[-1]%2 == 0
+    input_height = data_in.shape[-1]
+    first = data_in[...,:input_height//2]
+    second = data_in[...,input_height//2:]
+    switch = np.greater(second, first, out=switch)
+    output = np.maximum(first, second, out=out)
+    assert output.shape == data_in.shape[:-1]+(input_height//2,)
+    assert switch.shape == output.shape
+    return output, switch
+
+def mfm_inference(data_in, out=None):
+    '''
+    max-feature-map 2/1 for inference: no switch for backprop,
+    one np.maximum over two views of data_in
+    (..., h) -> (..., h/2), for conv feature maps and fully-connected outputs
+    '''
+    assert data_in.shape[-1]%2 == 0
+    half = data_in.shape[-1]//2
+    return np.maximum(data_in[...,:half], data_in[...,half:], out=out)
+
+def pool(data_in, out=None, switch=None):
     '''
     max-pooling with 2*2 filter size and stride=2
     (l, w, h) -> (l/2, w/2, h)
+    (N, l, w, h) -> (N, l/2, w/2, h) for a batch
+    also returns the switch for backprop, one uint8 per output: which cell of the 2*2 window won,
+    0: (0,0), 1: (0,1), 2: (1,0), 3: (1,1)
+    out, switch: optional output arrays
     '''
-    assert len(data_in.shape) == 3
-    assert data_in.shape[0]%2 == 0 and data_in.shape[1]%2 == 0 
-    output = measure.block_reduce(data_in, (2,2,1), func=np.max)
-    repmax = np.repeat(np.repeat(output, 2, axis=0), 2, axis=1)
-    location = (repmax == data_in)
-    assert output.shape == (data_in.shape[0]//2, data_in.shape[1]//2, data_in.shape[2])
-    assert location.shape == data_in.shape
-    return output, location
+    assert len(data_in.shape) in (3, 4)
+    assert data_in.shape[-3]%2 == 0 and data_in.shape[-2]%2 == 0 
+    output = pool_inference(data_in, out)
+    # first cell holding the maximum, with arithmetic instead of masked writes
+    if switch is None:
+        switch = np.zeros(output.shape, dtype=np.uint8)
+    else:
+        switch.fill(0)
+    found = np.zeros(output.shape, dtype=bool)
+    for cell, (i, j) in enumerate(((0,0), (0,1), (1,0), (1,1))):
+        winner = (data_in[...,i::2,j::2,:] == output) & ~found
+        switch += winner * np.uint8(cell)
+        found |= winner
+    assert output.shape == data_in.shape[:-3]+(data_in.shape[-3]//2, data_in.shape[-2]//2, data_in.shape[-1])
+    return output, switch
+
+def pool_inference(data_in, out=None):
+    '''
+    max-pooling with 2*2 filter size and stride=2 for inference: no switch for backprop,
+    in-place maximum over the four strided views of data_in
+    (l, w, h) -> (l/2, w/2, h), (N, l, w, h) -> (N, l/2, w/2, h)
+    '''
+    assert len(data_in.shape) in (3, 4)
+    assert data_in.shape[-3]%2 == 0 and data_in.shape[-2]%2 == 0 
+    output = np.maximum(data_in[...,0::2,0::2,:], data_in[...,0::2,1::2,:], out=out)
+    np.maximum(output, data_in[...,1::2,0::2,:], out=output)
+    np.maximum(output, data_in[...,1::2,1::2,:], out=output)
+    return output
 
 def padding(data_in, pad_size):
     '''
     pad the first 2 dimension of data_in
      (l, w, h), n -> (n+l+n, n+w+n, h)
+    a 4D input is a batch and gets its 2nd and 3rd dimension padded
+     (N, l, w, h), n -> (N, n+l+n, n+w+n, h)
     '''
-    assert len(data_in.shape) == 2 or len(data_in.shape) == 3
+    assert len(data_in.shape) in (2, 3, 4)
     assert pad_size > 0
     if len(data_in.shape) == 2: # 2D padding
-        output = np.zeros((data_in.shape[0]+pad_size*2, data_in.shape[1]+pad_size*2), dtype=np.double)
+        output = np.zeros((data_in.shape[0]+pad_size*2, data_in.shape[1]+pad_size*2), dtype=data_in.dtype)
         output[pad_size:-pad_size,pad_size:-pad_size] = data_in
-    else: # 3D padiing
-        output = np.zeros((data_in.shape[0]+pad_size*2, data_in.shape[1]+pad_size*2, data_in.shape[2]), dtype=np.double)
+    elif len(data_in.shape) == 3: # 3D padiing
+        output = np.zeros((data_in.shape[0]+pad_size*2, data_in.shape[1]+pad_size*2, data_in.shape[2]), dtype=data_in.dtype)
         output[pad_size:-pad_size,pad_size:-pad_size,:] = data_in
+    else: # batch of 3D padding
+        output = np.zeros((data_in.shape[0], data_in.shape[1]+pad_size*2, data_in.shape[2]+pad_size*2, data_in.shape[3]), dtype=data_in.dtype)
+        output[:,pad_size:-pad_size,pad_size:-pad_size,:] = data_in
     return output
 
-def fc(data_in, weights, bias):
+def fc(data_in, weights, bias, out=None):
     '''
     fully-connected layer
     ndarray, (w, node_num), (node_num) -> (node_num)
+    a 2D input is a batch of flattened samples
+    (N, w), (w, node_num), (node_num) -> (N, node_num)
+    out: optional output array
+    bias: None for a layer without bias (the first factor of a low-rank fc, see lowrank.py)
     '''
-    data = data_in.flatten()
-    assert data.shape[0] == weights.shape[0]
-    assert weights.shape[1] == bias.shape[0]
+    if len(data_in.shape) == 2:
+        data = data_in
+    else:
+        data = data_in.flatten()
+    assert data.shape[-1] == weights.shape[0]
+    assert bias is None or weights.shape[1] == bias.shape[0]
     weight_num, node_num = weights.shape
-    output = np.matmul(data, weights) + bias
-    assert output.shape == (node_num,)
+    output = np.matmul(data, weights, out=out)
+    if bias is not None:
+        output += bias
+    assert output.shape == data.shape[:-1]+(node_num,)
     return output
 
-def mfm_fc(data_in):
+def mfm_fc(data_in, out=None, switch=None):
     '''
     max-feature-map for fully-connected layer, 2/1
     (node_num) -> (node_num/2)
+    (N, node_num) -> (N, node_num/2) for a batch
+    also returns the switch for backprop, one bool per output: True where the second half won
+    out, switch: optional output arrays
     '''
-    assert len(data_in.shape) == 1
-    assert data_in.shape[0]%2 == 0
-    node_num = data_in.shape[0]
-    split = np.zeros((2, node_num//2), dtype=np.double)
-    split[0] = data_in[:node_num//2]
-    split[1] = data_in[node_num//2:]
-    output = np.amax(split, axis=0)
-    repmax = np.zeros(data_in.shape, dtype=np.double)
-    repmax[:node_num//2] = repmax[node_num//2:] = output
-    location = (repmax == data_in)
-    assert output.shape == (node_num//2,)
-    assert location.shape == data_in.shape
-    return output, location
-
-def softmax(data_in):
+    assert len(data_in.shape) in (1, 2)
+    assert data_in.shape[-1]%2 == 0
+    node_num = data_in.shape[-1]
+    first = data_in[...,:node_num//2]
+    second = data_in[...,node_num//2:]
+    switch = np.greater(second, first, out=switch)
+    output = np.maximum(first, second, out=out)
+    assert output.shape == data_in.shape[:-1]+(node_num//2,)
+    return output, switch
+
+def softmax(data_in, out=None):
     '''
     softmax layer
     (3095) -> (3095)
+    (N, 3095) -> (N, 3095) for a batch
+    out: optional output array
     '''
-    m = np.amax(data_in)
+    m = np.amax(data_in, axis=-1, keepdims=True)
     data_in -=m
-    e = np.exp(data_in)
-    s = np.sum(e)
-    output = e/s
+    e = np.exp(data_in, out=out)
+    s = np.sum(e, axis=-1, keepdims=True)
+    output = np.divide(e, s, out=e)
     return output 
 
 def cross_entropy(data_in, label_vec):
     '''
     cross entropy as loss function. 
     (3095) -> 1
+    (N, 3095) -> 1, summed over the batch
+    label_vec: one-hot, or (N,) integer class ids: only the probability of each target class is read
     '''
+    if np.issubdtype(np.asarray(label_vec).dtype, np.integer):
+        return -np.sum(np.log(data_in[np.arange(len(label_vec)), label_vec]))
     l = np.log(data_in)
-    return -np.dot(l, label_vec)
\ No newline at end of file
+    return -np.sum(l * label_vec)
\ No newline at end of file
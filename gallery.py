@@ -0,0 +1,172 @@
+import numpy as np
+import os
+import pickle
+
+from evaluation import normalize_features
+
+
+class GalleryIndex(object):
+    '''
+    1:N identification index over enrolled face features (the 256-d output of forward).
+    Features are stored centered and unit-normalized (see normalize_features), so the Pearson
+    similarity of a probe and an enrolled face is a dot product and top-k search is a chunked
+    matrix multiply. After train_ivf, search can probe only the nprobe closest partitions of a
+    coarse (IVF style) quantizer instead of scanning the whole gallery.
+    '''
+    def __init__(self, dim=256, chunk_size=65536):
+        self.dim = dim
+        self.chunk_size = chunk_size
+        self.size = 0
+        self.embeddings = np.zeros((1024, dim), dtype=np.double)
+        self.labels = []
+        self.centroids = None   # (nlist, dim) partition centers after train_ivf
+        self.assign = np.zeros(1024, dtype=np.int64)   # partition of each row
+        self.lists = None   # rows of each partition
+        return
+
+    def __len__(self):
+        return self.size
+
+    def enroll(self, labels, features):
+        '''
+        Add features of faces with the given identity labels, (n), (n, dim)
+        A label can be enrolled with several faces.
+        '''
+        features = normalize_features(np.atleast_2d(features))
+        assert features.shape == (len(labels), self.dim)
+        if self.size + len(labels) > len(self.embeddings):   # Grow geometrically, no rebuild
+            capacity = max(2*len(self.embeddings), self.size + len(labels))
+            embeddings = np.zeros((capacity, self.dim), dtype=np.double)
+            embeddings[:self.size] = self.embeddings[:self.size]
+            assign = np.zeros(capacity, dtype=np.int64)
+            assign[:self.size] = self.assign[:self.size]
+            self.embeddings, self.assign = embeddings, assign
+        self.embeddings[self.size:self.size+len(labels)] = features
+        if self.centroids is not None:
+            self.assign[self.size:self.size+len(labels)] = self.nearest_centroid(features)
+            for row in range(self.size, self.size+len(labels)):
+                self.lists[self.assign[row]].append(row)
+        self.labels += list(labels)
+        self.size += len(labels)
+        return
+
+    def remove(self, label):
+        '''
+        Remove every face enrolled with label; freed rows are filled with the last rows
+        '''
+        rows = [row for row in range(self.size) if self.labels[row] == label]
+        for row in reversed(rows):
+            last = self.size - 1
+            if self.lists is not None:
+                self.lists[self.assign[row]].remove(row)
+                if last != row:
+                    self.lists[self.assign[last]][self.lists[self.assign[last]].index(last)] = row
+            self.embeddings[row] = self.embeddings[last]
+            self.assign[row] = self.assign[last]
+            self.labels[row] = self.labels[last]
+            self.labels.pop()
+            self.size -= 1
+        return len(rows)
+
+    def train_ivf(self, nlist, iterations=10, seed=0):
+        '''
+        Partition the enrolled features into nlist clusters with spherical k-means.
+        Faces enrolled later are assigned to their nearest existing partition.
+        '''
+        assert self.size >= nlist
+        data = self.embeddings[:self.size]
+        rng = np.random.default_rng(seed)
+        self.centroids = data[rng.choice(self.size, nlist, replace=False)].copy()
+        for i in range(iterations):
+            assign = self.nearest_centroid(data)
+            for c in range(nlist):
+                members = data[assign == c]
+                if len(members) > 0:   # Empty partitions keep their old center
+                    center = np.sum(members, axis=0)
+                    self.centroids[c] = center / max(np.linalg.norm(center), 1e-12)
+        self.assign[:self.size] = self.nearest_centroid(data)
+        self.build_lists()
+        return
+
+    def build_lists(self):
+        self.lists = [[] for c in range(len(self.centroids))]
+        for row, c in enumerate(self.assign[:self.size]):
+            self.lists[c].append(row)
+        return
+
+    def nearest_centroid(self, features):
+        assign = np.zeros(len(features), dtype=np.int64)
+        for k in range(0, len(features), self.chunk_size):
+            assign[k:k+self.chunk_size] = np.argmax(np.matmul(features[k:k+self.chunk_size], self.centroids.T), axis=1)
+        return assign
+
+    def search(self, features, k=5, nprobe=None):
+        '''
+        Top-k enrolled faces for each probe feature, (q, dim) -> labels (q lists of k), scores (q, k)
+        nprobe: after train_ivf, only search the nprobe partitions closest to each probe
+        '''
+        queries = normalize_features(np.atleast_2d(features))
+        k = min(k, self.size)
+        if nprobe == None or self.centroids is None:
+            best_scores, best_rows = self.scan(queries, np.arange(self.size), k)
+        else:
+            probes = np.argsort(-np.matmul(queries, self.centroids.T), axis=1)[:, :nprobe]
+            best_scores = np.full((len(queries), k), -np.inf)
+            best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+            for i in range(len(queries)):
+                rows = np.concatenate([np.array(self.lists[c], dtype=np.int64) for c in probes[i]])
+                scores, found = self.scan(queries[i:i+1], rows, k)
+                best_scores[i, :scores.shape[1]] = scores[0]
+                best_rows[i, :found.shape[1]] = found[0]
+        labels = [[self.labels[row] for row in rows if row >= 0] for rows in best_rows]
+        return labels, best_scores
+
+    def scan(self, queries, rows, k):
+        '''
+        Exact top-k over the given rows, chunk_size rows per matrix multiply
+        '''
+        k = min(k, len(rows))
+        best_scores = np.full((len(queries), 0), -np.inf)
+        best_rows = np.full((len(queries), 0), -1, dtype=np.int64)
+        for start in range(0, len(rows), self.chunk_size):
+            chunk = rows[start:start+self.chunk_size]
+            scores = np.concatenate((best_scores, np.matmul(queries, self.embeddings[chunk].T)), axis=1)
+            candidates = np.concatenate((best_rows, np.broadcast_to(chunk, (len(queries), len(chunk)))), axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k-1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                candidates = np.take_along_axis(candidates, top, axis=1)
+            best_scores, best_rows = scores, candidates
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+
+    def save(self, path):
+        data = {
+            'dim': self.dim,
+            'chunk_size': self.chunk_size,
+            'embeddings': self.embeddings[:self.size],
+            'labels': self.labels,
+            'centroids': self.centroids,
+            'assign': self.assign[:self.size],
+        }
+        tmp_path = path + '.tmp'
+        file = open(tmp_path, 'wb')
+        file.write(pickle.dumps(data))
+        file.close()
+        os.replace(tmp_path, path)
+        return
+
+    @classmethod
+    def load(cls, path):
+        file = open(path, 'rb')
+        data = pickle.loads(file.read())
+        file.close()
+        gallery = cls(data['dim'], data['chunk_size'])
+        gallery.size = len(data['labels'])
+        gallery.embeddings = np.array(data['embeddings'])
+        gallery.labels = list(data['labels'])
+        gallery.centroids = data['centroids']
+        gallery.assign = np.array(data['assign'])
+        if gallery.centroids is not None:
+            gallery.build_lists()
+        return gallery
@@ -0,0 +1,419 @@
+import numpy as np
+import collections
+import copy
+import threading
+import weakref
+
+from forward_layers import conv, mfm, mfm_inference, mfm_fc, pool, pool_inference, fc, softmax, cross_entropy
+from backward_layers import get_derivative_softmax, get_derivative_fcout, get_derivate_mfm_fc1, get_derivative_fc, \
+    get_derivative_fc_nobias, get_derivative_conv, get_derivative_conv1, get_derivative_pool, get_derivative_mfm
+from optimizer import ColumnGradient
+
+'''
+A network is a list of Layer: the layer's output tensor is called `name`, it reads the tensor `input`
+('input' is the image batch, (N, l, w, 1)), a conv reads it zero-padded by `pad`, and `params` are
+the model attributes holding its weights (an fc layer with only weights has no bias).
+ops: conv, mfm (conv feature maps and fc outputs), pool, fc (flattens its input), softmax
+'''
+Layer = collections.namedtuple('Layer', ['name', 'op', 'input', 'pad', 'params'], defaults=(0, ()))
+
+def conv_layer(name, input, pad=0):
+    return Layer(name, 'conv', input, pad, (name + '_kernel', name + '_bias'))
+
+LIGHTCNN9_LAYERS = [
+    conv_layer('conv1', 'input', 2),
+    Layer('mfm1', 'mfm', 'conv1'),
+    Layer('pool1', 'pool', 'mfm1'),
+    conv_layer('conv2a', 'pool1'),
+    Layer('mfm2a', 'mfm', 'conv2a'),
+    conv_layer('conv2', 'mfm2a', 1),
+    Layer('mfm2', 'mfm', 'conv2'),
+    Layer('pool2', 'pool', 'mfm2'),
+    conv_layer('conv3a', 'pool2'),
+    Layer('mfm3a', 'mfm', 'conv3a'),
+    conv_layer('conv3', 'mfm3a', 1),
+    Layer('mfm3', 'mfm', 'conv3'),
+    Layer('pool3', 'pool', 'mfm3'),
+    conv_layer('conv4a', 'pool3'),
+    Layer('mfm4a', 'mfm', 'conv4a'),
+    conv_layer('conv4', 'mfm4a', 1),
+    Layer('mfm4', 'mfm', 'conv4'),
+    conv_layer('conv5a', 'mfm4'),
+    Layer('mfm5a', 'mfm', 'conv5a'),
+    conv_layer('conv5', 'mfm5a', 1),
+    Layer('mfm5', 'mfm', 'conv5'),
+    Layer('pool4', 'pool', 'mfm5'),
+    Layer('fc1', 'fc', 'pool4', 0, ('fc_weights', 'fc_bias')),
+    Layer('mfm_fc1', 'mfm', 'fc1'),
+    Layer('fcout', 'fc', 'mfm_fc1', 0, ('fcout_weights', 'fcout_bias')),
+    Layer('softmax', 'softmax', 'fcout'),
+]
+
+
+def factorize_fc_layers(layers, factored):
+    '''
+    The layer list with every fc layer whose weights are in factored split in two: `<name>_u` with weights
+    `<weights>_u` and no bias, then `<name>` with weights `<weights>_v` and the bias, y = (x U) V + b
+    '''
+    result = []
+    for layer in layers:
+        if layer.op == 'fc' and layer.params[0] in factored:
+            weights, bias = layer.params
+            result.append(Layer(layer.name + '_u', 'fc', layer.input, 0, (weights + '_u',)))
+            result.append(layer._replace(input=layer.name + '_u', params=(weights + '_v', bias)))
+        else:
+            result.append(layer)
+    return result
+
+
+def sample_classes(labels, num_classes, num_sampled):
+    '''
+    Candidate classes of a sampled softmax: every target class in labels plus num_sampled other classes
+    drawn uniformly without replacement (np.random, so a checkpoint restores the draws)
+    -> (sorted classes, log correction of each class's logit)
+    The correction log(negatives/num_sampled) of a sampled class is minus the log of its probability of
+    being drawn, which makes the sum over the candidates an unbiased estimate of the softmax denominator.
+    '''
+    targets = np.unique(labels)
+    negatives = num_classes - len(targets)
+    num_sampled = min(num_sampled, negatives)
+    drawn = np.random.choice(negatives, num_sampled, replace=False)
+    # the drawn-th class that is not a target
+    sampled = drawn + np.searchsorted(targets - np.arange(len(targets)), drawn, side='right')
+    classes = np.concatenate([targets, sampled])
+    correction = np.zeros(len(classes))
+    correction[len(targets):] = np.log(negatives / max(num_sampled, 1))
+    order = np.argsort(classes)
+    return classes[order], correction[order]
+
+
+def align_up(size, align):
+    return (size + align - 1) // align * align
+
+def assign_offsets(buffers, align=64):
+    '''
+    Greedy static memory planning: buffers (dicts with 'nbytes', 'first', 'last' step) are placed,
+    largest first, at the lowest offset free of every placed buffer whose lifetime overlaps.
+    Sets each buffer's 'offset' -> arena size in bytes
+    '''
+    placed = []
+    size = 0
+    for buffer in sorted(buffers, key=lambda buffer: -buffer['nbytes']):
+        conflicts = sorted((other['offset'], other['offset'] + other['nbytes']) for other in placed
+                           if other['first'] <= buffer['last'] and buffer['first'] <= other['last'])
+        offset = 0
+        for start, end in conflicts:
+            if offset + buffer['nbytes'] <= start:
+                break
+            offset = max(offset, align_up(end, align))
+        buffer['offset'] = offset
+        placed.append(buffer)
+        size = max(size, offset + buffer['nbytes'])
+    return size
+
+
+class Plan(object):
+    '''
+    Static activation memory of one pass (inference or training) at one input shape and dtype.
+    Every tensor of the pass (layer outputs, mfm/pool switches in training, zero-padded conv
+    inputs) is a view on one preallocated arena. A tensor read by a conv with padding lives in the
+    interior of its padded buffer, so its producer writes the padded input directly.
+    Tensors share arena bytes when their lifetimes do not overlap. Lifetimes run over the steps of the
+    pass: layer i runs forward at step i and, in training, backward at step 2L-1-i, where it reads
+    its conv input, switches, pool output or fc input. Conv outputs are only read by their mfm.
+    '''
+    def __init__(self, layers, model, input_shape, dtype, train, align=64):
+        '''
+        input_shape: shape of the image batch, (N, l, w)
+        '''
+        self.layers = layers
+        self.train = train
+        batch_size = input_shape[0]
+        dtype = np.dtype(dtype)
+        steps = 2 * len(layers)
+        backward = lambda i: steps - 1 - i
+
+        shapes = {'input': tuple(input_shape) + (1,)}
+        dtypes = {'input': dtype}
+        first = {'input': -1}
+        uses = collections.defaultdict(list)
+        self.pads = {}
+        for i, layer in enumerate(layers):
+            input_shape = shapes[layer.input]
+            if layer.op == 'conv':
+                kernel = getattr(model, layer.params[0])
+                shape = (batch_size, input_shape[1] + 2*layer.pad - kernel.shape[0] + 1,
+                         input_shape[2] + 2*layer.pad - kernel.shape[1] + 1, kernel.shape[3])
+            elif layer.op == 'mfm':
+                shape = input_shape[:-1] + (input_shape[-1]//2,)
+            elif layer.op == 'pool':
+                shape = input_shape[:-3] + (input_shape[-3]//2, input_shape[-2]//2, input_shape[-1])
+            elif layer.op == 'fc':
+                shape = (batch_size, getattr(model, layer.params[0]).shape[1])
+            elif layer.op == 'softmax':
+                shape = input_shape
+            else:
+                raise ValueError(f'unknown op {layer.op}')
+            shapes[layer.name] = shape
+            dtypes[layer.name] = dtype
+            first[layer.name] = i
+            uses[layer.input].append(i)
+            if layer.pad > 0:
+                assert self.pads.get(layer.input, layer.pad) == layer.pad, f'{layer.input} is padded twice'
+                self.pads[layer.input] = layer.pad
+            if train:
+                if layer.op in ('mfm', 'pool'):
+                    switch = layer.name + '.switch'
+                    shapes[switch] = shape
+                    dtypes[switch] = np.dtype(bool) if layer.op == 'mfm' else np.dtype(np.uint8)
+                    first[switch] = i
+                    uses[switch].append(backward(i))
+                if layer.op in ('conv', 'fc'):
+                    uses[layer.input].append(backward(i))
+                if layer.op in ('pool', 'softmax'):
+                    uses[layer.name].append(backward(i))
+        uses[layers[-1].name].append(steps)   # the result is read after the pass
+
+        buffers = {}
+        for name, shape in shapes.items():
+            pad = self.pads.get(name, 0)
+            buffer_shape = shape[:1] + (shape[1] + 2*pad, shape[2] + 2*pad) + shape[3:] if pad else shape
+            nbytes = int(np.prod(buffer_shape)) * dtypes[name].itemsize
+            buffers[name] = {'name': name, 'shape': buffer_shape, 'dtype': dtypes[name], 'nbytes': nbytes,
+                             'first': first[name], 'last': max(uses[name] + [first[name]])}
+        self.size = assign_offsets(list(buffers.values()), align)
+        self.unplanned_size = sum(buffer['nbytes'] for buffer in buffers.values())
+
+        memory = np.empty(self.size + align, dtype=np.uint8)
+        start = -memory.ctypes.data % align
+        self.arena = memory[start:start + self.size]
+        self.padded = {}   # name -> the whole zero-padded buffer
+        self.tensors = {}
+        for name, buffer in buffers.items():
+            view = self.arena[buffer['offset']:buffer['offset'] + buffer['nbytes']].view(buffer['dtype']).reshape(buffer['shape'])
+            pad = self.pads.get(name, 0)
+            if pad:
+                self.padded[name] = view
+                view = view[:, pad:-pad, pad:-pad]
+            self.tensors[name] = view
+        self.batches = {}   # batch size -> plan on the leading rows of the tensors, see batch
+        return
+
+    def batch(self, batch_size):
+        '''
+        The plan for the first batch_size images of the batch, on the same arena: every tensor's
+        leading axis is the batch, so each tensor is the first batch_size rows of this plan's
+        '''
+        if batch_size == len(self.tensors['input']):
+            return self
+        if batch_size not in self.batches:
+            plan = copy.copy(self)
+            plan.padded = {name: buffer[:batch_size] for name, buffer in self.padded.items()}
+            plan.tensors = {name: tensor[:batch_size] for name, tensor in self.tensors.items()}
+            self.batches[batch_size] = plan
+        return self.batches[batch_size]
+
+    def conv_input(self, layer):
+        return self.padded[layer.input] if layer.pad else self.tensors[layer.input]
+
+    def clear_border(self, name):
+        '''
+        Zero the border of name's padded buffer; the arena bytes may have held other tensors
+        '''
+        if name in self.padded:
+            buffer = self.padded[name]
+            pad = self.pads[name]
+            buffer[:, :pad] = 0
+            buffer[:, -pad:] = 0
+            buffer[:, pad:-pad, :pad] = 0
+            buffer[:, pad:-pad, -pad:] = 0
+        return
+
+
+PLAN_CACHE_BYTES = 2**31
+
+
+class LayerGraph(object):
+    '''
+    Runs a layer list with one engine, for inference up to the `feature` tensor and for training
+    (forward through the whole list, then backward). Plans (see Plan) are built per thread for each
+    (image shape, dtype, train, weight shapes) at the largest batch size seen, smaller batches (the last
+    batch of an epoch, the remainder of forward_batch) run on the leading rows of its arena.
+    Each thread keeps its most recently used plans up to cache_bytes of arena (at least the last one),
+    so repeated calls allocate no activations; clear() releases them all. Results returned by
+    forward are views on the arena, valid until the next call on the same thread.
+    '''
+    def __init__(self, layers, feature, cache_bytes=PLAN_CACHE_BYTES):
+        self.layers = layers
+        self.feature = feature
+        self.inference_layers = layers[:[layer.name for layer in layers].index(feature) + 1]
+        # training with a sampled softmax: the head (fc and softmax) runs outside the plan
+        self.body_layers = layers[:-2]
+        self.cache_bytes = cache_bytes
+        self.caches = weakref.WeakKeyDictionary()   # thread -> OrderedDict of its plans, least recently used first
+        self.lock = threading.Lock()
+        return
+
+    def pass_layers(self, train, sampled=False):
+        return (self.body_layers if sampled else self.layers) if train else self.inference_layers
+
+    def plan(self, model, input_shape, train, sampled=False):
+        # weight shapes too: models sharing the graph may differ in the rank of their factored fc layers
+        layers = self.pass_layers(train, sampled)
+        weight_shapes = tuple(getattr(model, layer.params[0]).shape for layer in layers if layer.params)
+        key = (tuple(input_shape[1:]), model.dtype, train, sampled, weight_shapes)
+        batch_size = input_shape[0]
+        with self.lock:
+            plans = self.caches.setdefault(threading.current_thread(), collections.OrderedDict())
+            plan = plans.get(key)
+            if plan != None and len(plan.tensors['input']) >= batch_size:
+                plans.move_to_end(key)
+                return plan.batch(batch_size)
+            plans.pop(key, None)   # a larger batch replaces the plan
+        plan = Plan(layers, model, input_shape, model.dtype, train)
+        with self.lock:
+            plans[key] = plan
+            while len(plans) > 1 and sum(cached.size for cached in plans.values()) > self.cache_bytes:
+                plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        '''
+        Release the plans (and their arenas) of every thread; the next call builds them again
+        '''
+        with self.lock:
+            for plans in self.caches.values():
+                plans.clear()
+        return
+
+    def run_forward(self, model, images, train, sampled=False):
+        '''
+        Forward pass of a batch of images (N, l, w) -> the plan holding every tensor
+        sampled: training without the head (fc and softmax), see sampled_head
+        '''
+        plan = self.plan(model, images.shape, train, sampled)
+        tensors = plan.tensors
+        plan.clear_border('input')
+        tensors['input'][..., 0] = images
+        for layer in plan.layers:
+            plan.clear_border(layer.name)
+            data = tensors[layer.input]
+            out = tensors[layer.name]
+            if layer.op == 'conv':
+                conv(plan.conv_input(layer), getattr(model, layer.params[0]), getattr(model, layer.params[1]), out=out)
+            elif layer.op == 'mfm':
+                if not train:
+                    mfm_inference(data, out=out)
+                elif len(data.shape) == 2:
+                    mfm_fc(data, out=out, switch=tensors[layer.name + '.switch'])
+                else:
+                    mfm(data, out=out, switch=tensors[layer.name + '.switch'])
+            elif layer.op == 'pool':
+                if train:
+                    pool(data, out=out, switch=tensors[layer.name + '.switch'])
+                else:
+                    pool_inference(data, out=out)
+            elif layer.op == 'fc':
+                bias = getattr(model, layer.params[1]) if len(layer.params) > 1 else None
+                fc(data.reshape(len(data), -1), getattr(model, layer.params[0]), bias, out=out)
+            elif layer.op == 'softmax':
+                softmax(data, out=out)
+        return plan
+
+    def forward(self, model, images):
+        '''
+        (N, l, w) -> the feature tensor (N, ...), a view on the arena
+        '''
+        return self.run_forward(model, images, train=False).tensors[self.feature]
+
+    def backprob(self, model, images, labels, sampled=None):
+        '''
+        Forward and backward pass of a mini-batch, the last layers must be fc and softmax (cross entropy loss)
+        (N, l, w), labels -> ({param name: gradient summed over the batch}, loss summed over the batch)
+        labels: (N,) integer class ids (sparse cross entropy and softmax gradient) or (N, classes) one-hot
+        sampled: (classes, log correction) from sample_classes to train with a sampled softmax
+        '''
+        plan = self.run_forward(model, images, train=True, sampled=sampled is not None)
+        tensors = plan.tensors
+        gradients = {}
+        if sampled is None:
+            loss = cross_entropy(tensors[plan.layers[-1].name], labels)
+            grad = None
+        else:
+            loss, grad = self.sampled_head(model, tensors, labels, sampled, gradients)
+        for layer in reversed(plan.layers):
+            if layer.op == 'softmax':
+                grad = get_derivative_softmax(tensors[layer.name], labels)
+            elif layer.op == 'fc':
+                data = tensors[layer.input]
+                weights = getattr(model, layer.params[0])
+                if len(layer.params) == 1:
+                    gradients[layer.params[0]], dx = get_derivative_fc_nobias(data.reshape(len(data), -1), weights, grad)
+                    grad = dx.reshape(data.shape)
+                    continue
+                bias = getattr(model, layer.params[1])
+                if len(data.shape) == 2:
+                    dw, db, dx = get_derivative_fcout(data, weights, bias, grad)
+                else:
+                    dw, db, dx = get_derivative_fc(data.reshape(len(data), -1), weights, bias, grad)
+                gradients[layer.params[0]], gradients[layer.params[1]] = dw, db
+                grad = dx.reshape(data.shape)
+            elif layer.op == 'mfm':
+                switch = tensors[layer.name + '.switch']
+                grad = get_derivate_mfm_fc1(switch, grad) if len(switch.shape) == 2 else get_derivative_mfm(switch, grad)
+            elif layer.op == 'pool':
+                grad = get_derivative_pool(tensors[layer.name + '.switch'], grad, tensors[layer.name])
+            elif layer.op == 'conv':
+                kernel, bias = getattr(model, layer.params[0]), getattr(model, layer.params[1])
+                if layer.input == 'input':   # no gradient for the images
+                    dw, db = get_derivative_conv1(plan.conv_input(layer), kernel, bias, grad, None)
+                else:
+                    dw, db, grad = get_derivative_conv(plan.conv_input(layer), kernel, bias, grad, None)
+                    assert grad.shape == tensors[layer.input].shape
+                gradients[layer.params[0]], gradients[layer.params[1]] = dw, db
+        return gradients, loss
+
+    def sampled_head(self, model, tensors, labels, sampled, gradients):
+        '''
+        Forward and backward of the head (fc and softmax) over the sampled classes only, so it costs
+        N x candidates instead of N x classes; the other classes' weights get zero gradient.
+        The head's gradients go into gradients as optimizer.ColumnGradient of the sampled columns, so
+        the optimizer only touches those columns too -> (loss, gradient of the head's input)
+        '''
+        assert np.issubdtype(np.asarray(labels).dtype, np.integer), 'a sampled softmax needs integer labels'
+        head = self.layers[-2]
+        classes, correction = sampled
+        data = tensors[head.input]
+        weights, bias = getattr(model, head.params[0]), getattr(model, head.params[1])
+        sampled_weights = weights[:, classes]
+        sampled_bias = bias[classes]
+        logits = fc(data, sampled_weights, sampled_bias)
+        logits += correction
+        probability = softmax(logits)
+        targets = np.searchsorted(classes, labels)
+        loss = cross_entropy(probability, targets)
+        dw, db, dx = get_derivative_fcout(data, sampled_weights, sampled_bias, get_derivative_softmax(probability, targets))
+        gradients[head.params[0]] = ColumnGradient(classes, dw)
+        gradients[head.params[1]] = ColumnGradient(classes, db)
+        return loss, dx
+
+    def activation_bytes(self, model, input_shape, train):
+        '''
+        -> (arena bytes of the plan for an image batch of input_shape, bytes if every tensor had its own buffer)
+        '''
+        plan = Plan(self.pass_layers(train), model, input_shape, model.dtype, train)
+        return plan.size, plan.unplanned_size
+
+
+LIGHTCNN9_GRAPH = LayerGraph(LIGHTCNN9_LAYERS, feature='mfm_fc1')
+LIGHTCNN9_GRAPHS = {(): LIGHTCNN9_GRAPH}
+
+def lightcnn9_graph(factored=()):
+    '''
+    The LightCNN-9 graph with the fc layers whose weights are in factored low-rank (see factorize_fc_layers),
+    one LayerGraph (and plan cache) per set of factored layers
+    '''
+    key = tuple(sorted(factored))
+    if key not in LIGHTCNN9_GRAPHS:
+        LIGHTCNN9_GRAPHS[key] = LayerGraph(factorize_fc_layers(LIGHTCNN9_LAYERS, key), feature='mfm_fc1')
+    return LIGHTCNN9_GRAPHS[key]
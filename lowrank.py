@@ -0,0 +1,140 @@
+import numpy as np
+import sys
+import time
+
+from main import LightCNN_9
+from pairs import pair_files
+from utils import load_images
+from evaluation import pearson_scores, evaluate
+
+'''
+Low-rank factorization of the fc layers of LightCNN-9.
+A (m, n) weight matrix W is replaced by the rank r truncated SVD, W ~ U V with U (m, r) and V (r, n)
+(the singular values split evenly, U = u sqrt(s), V = sqrt(s) v), so the layer costs r(m+n) instead
+of mn multiply-adds per image: for fc (8192x512) any rank below 496 is cheaper.
+The factored model is an ordinary LightCNN_9 whose param_names hold <weights>_u and <weights>_v:
+its graph runs each factored fc as two fc layers, and it trains, checkpoints and saves as usual.
+'''
+
+
+def rank_for_energy(singular_values, energy):
+    '''
+    The smallest rank keeping `energy` (0-1) of the squared singular values
+    '''
+    cumulative = np.cumsum(singular_values**2) / np.sum(singular_values**2)
+    return int(min(np.searchsorted(cumulative, energy) + 1, len(singular_values)))
+
+def factorize_weights(weights, rank=None, energy=None):
+    '''
+    (m, n) -> U (m, r), V (r, n) of the truncated SVD, r given by rank or by energy
+    '''
+    u, s, vt = np.linalg.svd(np.asarray(weights, dtype=np.double), full_matrices=False)
+    if rank == None:
+        rank = rank_for_energy(s, energy)
+    rank = min(rank, len(s))
+    root = np.sqrt(s[:rank])
+    return (u[:, :rank] * root).astype(weights.dtype), (root[:, None] * vt[:rank]).astype(weights.dtype)
+
+def factorize_model(model, ranks):
+    '''
+    A copy of model with fc layers factored (no weights shared with model, both can be trained).
+    ranks: {fc weights name ('fc_weights', 'fcout_weights'): rank (int) or energy to keep (float < 1)}
+    '''
+    factored = model.astype(model.dtype)
+    for name, rank in ranks.items():
+        assert name in model.param_names, f'{name} is not a full fc weight matrix of the model'
+        if isinstance(rank, float) and rank < 1:
+            u, v = factorize_weights(getattr(model, name), energy=rank)
+        else:
+            u, v = factorize_weights(getattr(model, name), rank=int(rank))
+        delattr(factored, name)
+        setattr(factored, name + '_u', u)
+        setattr(factored, name + '_v', v)
+    factored.param_names = LightCNN_9.factored_param_names(model.factored + list(ranks))
+    factored.build_param_lists()
+    return factored
+
+def ranks_of(model):
+    return {name: getattr(model, name + '_u').shape[1] for name in model.factored}
+
+def model_bytes(model):
+    return sum(param.nbytes for name, param in model.parameters())
+
+def fc_seconds(model, batch_size=64, repeat=5):
+    '''
+    Best time of the fc1 layer (full or factored) on a batch of random pool4 outputs
+    '''
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((batch_size, 8*8*128)).astype(model.dtype)
+    best = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        if 'fc_weights' in model.factored:
+            np.matmul(np.matmul(data, model.fc_weights_u), model.fc_weights_v) + model.fc_bias
+        else:
+            np.matmul(data, model.fc_weights) + model.fc_bias
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def forward_seconds(model, images, batch_size=64, repeat=3):
+    best = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        model.forward_batch(images, batch_size)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def rank_sweep(model, ranks, match_images, mismatch_images, layer='fc_weights', batch_size=64):
+    '''
+    Factor `layer` of model at each rank and compare with the full model (first row, rank None):
+    parameter bytes, fc1 and whole-forward latency per image, the mean Pearson similarity of the
+    embeddings to the full model's, and the F1 at the model's sim_thr and at the best threshold
+    match_images, mismatch_images: [pair0 image0, pair0 image1, ...]
+    -> list of dicts, one per rank
+    '''
+    images = np.concatenate([match_images, mismatch_images])
+    reference = model.forward_batch(images, batch_size)
+    rows = []
+    for rank in [None] + list(ranks):
+        net = model if rank == None else factorize_model(model, {layer: rank})
+        features = net.forward_batch(images, batch_size)
+        match, mismatch = features[:len(match_images)], features[len(match_images):]
+        result = evaluate(pearson_scores(match[0::2], match[1::2]), pearson_scores(mismatch[0::2], mismatch[1::2]), model.sim_thr)
+        rows.append({
+            'rank': ranks_of(net).get(layer),
+            'bytes': model_bytes(net),
+            'fc_ms_per_image': fc_seconds(net, batch_size) / batch_size * 1e3,
+            'forward_ms_per_image': forward_seconds(net, images, batch_size) / len(images) * 1e3,
+            'similarity': float(np.mean(pearson_scores(reference, features))),
+            'F1': result['F1'],
+            'best_F1': result['best_F1'],
+        })
+    return rows
+
+def print_sweep(rows):
+    print(f"{'rank':>6s} {'MB':>8s} {'fc ms/img':>10s} {'fwd ms/img':>11s} {'similarity':>11s} {'F1':>7s} {'best F1':>8s}")
+    for row in rows:
+        rank = 'full' if row['rank'] == None else str(row['rank'])
+        print(f"{rank:>6s} {row['bytes']/2**20:8.2f} {row['fc_ms_per_image']:10.4f} {row['forward_ms_per_image']:11.3f} "
+              f"{row['similarity']:11.6f} {row['F1']:7.4f} {row['best_F1']:8.4f}")
+    return
+
+
+if __name__ == "__main__":
+    # python lowrank.py factorize LightCNN9_model.bin LightCNN9_lowrank.bin fc_weights=128 [fcout_weights=0.95]
+    # python lowrank.py sweep LightCNN9_model.bin ./test_dataset/match_pairs ./test_dataset/mismatch_pairs [ranks...]
+    model = LightCNN_9(sys.argv[2])
+    if sys.argv[1] == 'factorize':
+        ranks = {}
+        for arg in sys.argv[4:]:
+            name, value = arg.split('=')
+            ranks[name] = float(value) if '.' in value else int(value)
+        factored = factorize_model(model, ranks)
+        factored.save(sys.argv[3])
+        print("ranks:", ranks_of(factored), "bytes:", model_bytes(model), "->", model_bytes(factored))
+    elif sys.argv[1] == 'sweep':
+        ranks = [int(rank) for rank in sys.argv[5:]] or [32, 64, 128, 256]
+        match_files = pair_files(sys.argv[3])
+        match_images = np.array(list(load_images(match_files)))
+        mismatch_images = np.array(list(load_images(pair_files(sys.argv[4], len(match_files) // 2))))
+        print_sweep(rank_sweep(model, ranks, match_images, mismatch_images))
@@ -1,27 +1,69 @@
 import numpy as np
-from skimage import io, transform
 import glob
-import pickle
+import hashlib
+import copy
 import time
 import logging
-import os
 
 from forward_layers import *
 from backward_layers import *
-from utils import traindata_loader
+from utils import build_traindata_cache, traindata_cache_loader, traindata_class_count, prefetch_batches, load_images, PREPROCESS_VERSION
+import optimizer as optim
+from evaluation import best_threshold
+from graph import lightcnn9_graph, sample_classes
+from model_format import load_weights, save_weights
+from checkpoint import CHECKPOINT_DIR, Checkpointer, latest_checkpoint, load_checkpoint
+from embedding_cache import EmbeddingCache, EMBEDDING_CACHE_DIR, content_hash, invalidate_embedding_cache
+from pairs import PairScorer
 
 image_width = 128
 image_height = 128
+NUM_CLASSES = 3095   # identities of the original training set, the default head size
 
 
 class LightCNN_9(object):
-    def __init__(self, path=None):
+    param_names = ['conv1_kernel', 'conv1_bias', 'conv2a_kernel', 'conv2a_bias', 'conv2_kernel', 'conv2_bias',
+                   'conv3a_kernel', 'conv3a_bias', 'conv3_kernel', 'conv3_bias', 'conv4a_kernel', 'conv4a_bias',
+                   'conv4_kernel', 'conv4_bias', 'conv5a_kernel', 'conv5a_bias', 'conv5_kernel', 'conv5_bias',
+                   'fc_weights', 'fc_bias', 'fcout_weights', 'fcout_bias']
+    fc_weight_names = ['fc_weights', 'fcout_weights']
+
+    @classmethod
+    def factored_param_names(cls, factored):
+        '''
+        param_names with the weights of each fc layer in factored replaced by its low-rank factors
+        <weights>_u, <weights>_v (see lowrank.py)
+        '''
+        names = []
+        for name in cls.param_names:
+            names += [name + '_u', name + '_v'] if name in factored else [name]
+        return names
+
+    def __init__(self, path=None, dtype=None, mmap_mode='c', num_classes=None):
+        '''
+        path: weight file written by save (see model_format.py). The weights are views on an
+            np.memmap of the file: 'c' copy-on-write (default, they can be trained in place) or 'r' read-only.
+        dtype: floating point type of weights and activations, e.g. np.float32.
+        Defaults to the dtype stored in the model file, or np.double for a new model.
+        num_classes: identities of the output layer (fcout), NUM_CLASSES for a new model by default.
+            A loaded model keeps its own, or grows its output layer to num_classes if that is more
+            (new classes get freshly initialized weights), e.g. to train on added identities.
+        '''
+        self.sim_thr = -0.0926   # Pearson similarity threshold of test/TA_test
         if path != None:    # Load existing model
-            file = open(path, 'rb')
-            data = file.read()
-            file.close()
-            self.__dict__ = pickle.loads(data)
+            tensors, attributes = load_weights(path, mmap_mode)
+            factored = [name for name in self.fc_weight_names if name + '_u' in tensors]
+            if len(factored) > 0:
+                self.param_names = self.factored_param_names(factored)
+            for name in self.param_names:
+                setattr(self, name, tensors[name])
+            self.sim_thr = attributes.get('sim_thr', self.sim_thr)
+            if dtype == None:
+                dtype = self.conv1_kernel.dtype
+            if num_classes != None and num_classes > self.num_classes:
+                self.grow_classes(num_classes)
         else:   # Initialize
+            num_classes = NUM_CLASSES if num_classes == None else num_classes
             self.conv1_kernel = np.random.randn(5, 5, 1, 96)*np.sqrt(1/(5*5*1))
             self.conv1_bias = np.zeros((96), dtype=np.double)
             self.conv2a_kernel = np.random.randn(1, 1, 48, 96)*np.sqrt(1/(1*1*48))
@@ -40,279 +82,309 @@ class LightCNN_9(object):
             self.conv5a_bias = np.zeros((256), dtype=np.double)
             self.conv5_kernel = np.random.randn(3, 3, 128, 256)*np.sqrt(1/(3*3*128))
             self.conv5_bias =np.zeros((256), dtype=np.double)
-            self.fc_weights = np.random.randn(8*8*128, 512)*np.sqrt(2/(8*8*128+3095))
+            self.fc_weights = np.random.randn(8*8*128, 512)*np.sqrt(2/(8*8*128+num_classes))
             self.fc_bias = np.zeros((512), dtype=np.double)
-            self.fcout_weights = np.random.randn(256, 3095)*np.sqrt(2/(256+3095))
-            self.fcout_bias = np.zeros((3095), dtype=np.double)
+            self.fcout_weights = np.random.randn(256, num_classes)*np.sqrt(2/(256+num_classes))
+            self.fcout_bias = np.zeros((num_classes), dtype=np.double)
+
+        if dtype == None:
+            dtype = np.double
+        self.dtype = np.dtype(dtype)
+        for name in self.param_names:
+            setattr(self, name, getattr(self, name).astype(self.dtype, copy=False))
+        self.build_param_lists()
+        return
 
+    def build_param_lists(self):
         self.conv_kernel = [self.conv1_kernel,self.conv2a_kernel,self.conv2_kernel,self.conv3a_kernel, \
-                                self.conv3_kernel,self.conv4a_kernel,self.conv4_kernel]  
+                                self.conv3_kernel,self.conv4a_kernel,self.conv4_kernel,self.conv5a_kernel,self.conv5_kernel]  
         self.conv_bias = [self.conv1_bias,self.conv2a_bias,self.conv2_bias,self.conv3a_bias,\
-                        self.conv3_bias,self.conv4a_bias,self.conv4_bias]
-        self.fc_w = [self.fc_weights,self.fcout_weights]
+                        self.conv3_bias,self.conv4a_bias,self.conv4_bias,self.conv5a_bias,self.conv5_bias]
+        self.fc_w = [getattr(self, name) for name in self.param_names[18:] if not name.endswith('_bias')]
         self.fc_b = [self.fc_bias,self.fcout_bias]
         return
-    def save(self):
-        file = open('LightCNN9_model.bin', 'wb')
-        file.write(pickle.dumps(self.__dict__))
-        file.close()
-        return
-    def forward(self, data):
-        '''
-        Forward propagation and output the feature of image
-        (image_width, image_height) -> (256)
-        ''' 
-        pad1 = padding(data, 2)
-        conv_input = np.zeros((pad1.shape[0], pad1.shape[1], 1), dtype=np.double)
-        conv_input[:,:,0] = pad1
-
-        conv1 = conv(conv_input, self.conv1_kernel, self.conv1_bias)
-        mfm1, mfm1_location = mfm(conv1)
 
-        pool1, pool1_location = pool(mfm1)
+    @property
+    def factored(self):
+        '''
+        The fc weights stored as low-rank factors
+        '''
+        return [name for name in self.fc_weight_names if name + '_u' in self.param_names]
 
-        conv2a = conv(pool1, self.conv2a_kernel, self.conv2a_bias)
-        mfm2a, mfm2a_location = mfm(conv2a)
-        conv2 = conv(padding( mfm2a,1), self.conv2_kernel, self.conv2_bias)
-        mfm2, mfm2_location = mfm(conv2)
+    @property
+    def num_classes(self):
+        '''
+        Identities of the output layer
+        '''
+        return len(self.fcout_bias)
 
-        pool2, pool2_location = pool(mfm2)
+    def grow_classes(self, num_classes):
+        '''
+        Extend the output layer to num_classes, the new columns initialized like a new model's
+        '''
+        added = num_classes - self.num_classes
+        assert added >= 0, f'the model already has {self.num_classes} classes'
+        name = 'fcout_weights_v' if 'fcout_weights' in self.factored else 'fcout_weights'
+        weights = getattr(self, name)
+        new_weights = np.random.randn(weights.shape[0], added)*np.sqrt(2/(256+num_classes))
+        setattr(self, name, np.concatenate([weights, new_weights.astype(weights.dtype)], axis=1))
+        self.fcout_bias = np.concatenate([self.fcout_bias, np.zeros(added, dtype=self.fcout_bias.dtype)])
+        self.build_param_lists()
+        return
 
-        conv3a = conv(pool2, self.conv3a_kernel, self.conv3a_bias)
-        mfm3a, mfm3a_location = mfm(conv3a)
+    @property
+    def graph(self):
+        '''
+        The layer graph (graph.py) of this model, with its factored fc layers split in two
+        '''
+        return lightcnn9_graph(self.factored)
 
-        conv3 = conv(padding(mfm3a, 1), self.conv3_kernel, self.conv3_bias)
-        mfm3, mfm3_location = mfm(conv3)
+    def parameters(self):
+        '''
+        (name, array) of every weight, in the order of param_names
+        '''
+        return [(name, getattr(self, name)) for name in self.param_names]
 
-        pool3, pool3_location = pool(mfm3)
+    def astype(self, dtype):
+        '''
+        Return a copy of the model with weights cast to dtype
+        '''
+        model = copy.copy(self)
+        model.dtype = np.dtype(dtype)
+        for name in self.param_names:
+            setattr(model, name, getattr(self, name).astype(model.dtype))
+        model.build_param_lists()
+        return model
+
+    def weights_hash(self):
+        '''
+        Hash of all weights, identifies the model in the embedding cache
+        '''
+        digest = hashlib.sha1()
+        for name in self.param_names:
+            digest.update(np.ascontiguousarray(getattr(self, name)).data)
+        return digest.hexdigest()
 
-        conv4a = conv(pool3, self.conv4a_kernel, self.conv4a_bias)
-        mfm4a, mfm4a_location = mfm(conv4a)
+    def save(self, path='LightCNN9_model.bin'):
+        '''
+        Write the weights and sim_thr as a weight file (see model_format.py), atomically
+        '''
+        save_weights(path, self.parameters(), {'sim_thr': float(self.sim_thr), 'num_classes': self.num_classes})
+        invalidate_embedding_cache(self.weights_hash())
+        return
+    def forward(self, data):
+        '''
+        Forward propagation and output the feature of image
+        (image_width, image_height) -> (256)
+        ''' 
+        return self.forward_batch(np.asarray(data)[None], 1)[0]
 
-        conv4 = conv(padding(mfm4a, 1), self.conv4_kernel, self.conv4_bias)
-        mfm4, mfm4_location = mfm(conv4)
+    def forward_batch(self, images, batch_size=64):
+        '''
+        Forward propagation over many images, batch_size images at a time
+        (N, image_width, image_height) -> (N, 256)
+        Runs the inference pass of the model's graph (graph.py), which uses the inference kernels
+        (no switches for backprop) and writes activations into a preallocated arena
+        '''
+        features = np.zeros((len(images), 256), dtype=self.dtype)
+        for k in range(0, len(images), batch_size):
+            features[k:k+batch_size] = self.graph.forward(self, np.asarray(images[k:k+batch_size]))
+        return features
 
-        conv5a = conv(mfm4, self.conv5a_kernel, self.conv5a_bias)
-        mfm5a, mfm5a_location = mfm(conv5a)
+    def backprob(self, batch_data, batch_label, sampled=None):
+        '''
+        Backpropagation over a whole mini-batch at once, with the model's graph (graph.py)
+        (N, image_width, image_height), (N,) integer labels or (N, num_classes) one-hot -> gradients and loss summed over the batch
+        g_fc_w holds both factors of a factored fc layer
+        sampled: (classes, log correction) from graph.sample_classes to train with a sampled softmax
+        '''
+        gradients, loss = self.param_gradients(batch_data, batch_label, sampled)
 
-        conv5 = conv(padding(mfm5a,1), self.conv5_kernel, self.conv5_bias)
-        mfm5, mfm5_location = mfm(conv5)
-            
-        pool4, pool4_location = pool(mfm5)
+        g_conv_w = gradients[0:18:2]
+        g_conv_b = gradients[1:18:2]
+        g_fc_w = [g for name, g in zip(self.param_names[18:], gradients[18:]) if not name.endswith('_bias')]
+        g_fc_b = [g for name, g in zip(self.param_names[18:], gradients[18:]) if name.endswith('_bias')]
 
-        fc1 = fc(pool4, self.fc_weights, self.fc_bias)
-        mfm_fc1, mfm_fc1_location = mfm_fc(fc1)
+        return g_conv_w, g_conv_b, g_fc_w, g_fc_b, loss
 
-        return mfm_fc1
+    def param_gradients(self, batch_data, batch_label, sampled=None):
+        '''
+        backprob with the gradients listed in the order of param_names -> (gradients, loss)
+        '''
+        batch_label = np.asarray(batch_label)
+        if not np.issubdtype(batch_label.dtype, np.integer):   # one-hot
+            batch_label = batch_label.astype(self.dtype, copy=False)
+        gradients, loss = self.graph.backprob(self, np.asarray(batch_data), batch_label, sampled)
+        return [gradients[name] for name in self.param_names], loss
 
-    def train(self, data, label, epoch, min_batch_size, eta):
+    def update_batch(self, batch_data, batch_label, optimizer, trainer=None, num_sampled=None):
+        '''
+        One optimizer step on a mini-batch -> average loss
+        trainer: a parallel.DataParallelTrainer computing the gradients, or None for this process
+        num_sampled: train the output layer with a sampled softmax over the batch's classes and
+            num_sampled other classes (integer labels), or None for the full softmax
+        '''
+        sampled = None
+        if num_sampled != None:
+            sampled = sample_classes(batch_label, self.num_classes, num_sampled)
+        if trainer != None:
+            total_loss = trainer.compute_gradients(batch_data, batch_label, optimizer, sampled)
+        else:
+            gradients, total_loss = self.param_gradients(batch_data, batch_label, sampled)
+            optimizer.zero_grad()
+            optimizer.accumulate(gradients)
+        optimizer.step(1 / len(batch_data))
+        return total_loss / len(batch_data)
+
+    def train(self, data, label, epoch, min_batch_size, eta, seed=0, optimizer=None, workers=None,
+              resume=False, checkpoint_dir=CHECKPOINT_DIR, checkpoint_every=None, keep=3, profiler=None,
+              num_sampled=None, save_path='LightCNN9_model.bin'):
         '''
         Train the model with backpropagation
+        data: (N, image_width, image_height) array or memmap, read batch by batch
+        label: (N,) integer label ids below self.num_classes or (N, num_classes) one-hot labels (batches get integer ids)
+        seed: seeds the per-epoch shuffle of the training data
+        optimizer: an optim.Optimizer over self.parameters(), plain SGD with learning rate eta by default
+        workers: compute the gradients of each mini-batch in this many processes
+            (parallel.DataParallelTrainer), the weights are shared with them through shared memory
+        A checkpoint (weights, optimizer state, RNG state, epoch and batch; see checkpoint.py) is written
+        to checkpoint_dir by a background thread after each epoch and every checkpoint_every batches,
+        keeping the newest `keep`. The final weights are saved with self.save(save_path).
+        resume: True to continue from the latest checkpoint in checkpoint_dir, or a checkpoint path.
+            Training continues at the exact epoch and batch, with the same shuffle order.
+        profiler: a profiler.Profiler, enabled during training; its events are tagged with the epoch
+            and the slowest layers of each epoch are printed
+        num_sampled: train with a sampled softmax, the output layer of each batch only runs over
+            the batch's classes and num_sampled uniformly drawn others (see update_batch)
         '''
+        label_count = label.shape[1] if len(label.shape) == 2 else int(np.max(label)) + 1
+        if label_count > self.num_classes:
+            raise ValueError(f"the labels have {label_count} classes, the model {self.num_classes}; "
+                             f"create or load it with num_classes={label_count}")
+        if optimizer == None:
+            optimizer = optim.SGD(self.parameters(), lr=eta)
+        optimizer.rebind(self.parameters())
+        start_epoch, start_batch, start_loss = 0, 0, 0.0
+        if resume:
+            path = latest_checkpoint(checkpoint_dir) if resume == True else resume
+            if path != None:
+                state = load_checkpoint(path, self, optimizer)
+                start_epoch, start_batch, start_loss = state['epoch'], state['batch'], state['loss_sum']
+                print("resume from", path)
+        checkpointer = Checkpointer(self, optimizer, checkpoint_dir, keep)
+        trainer = None
+        if workers != None and workers > 1:
+            from parallel import DataParallelTrainer
+            trainer = DataParallelTrainer(self, workers, max_batch_size=min_batch_size)
+            optimizer.rebind(self.parameters())   # the weights moved to shared memory
         
         def SGD(train_image, train_label, test_image, test_label, epochs, batch_size, eta):
             '''Stochastic gradiend descent'''
             
-            batch_num = 0
-            for j in range(epochs):
+            for j in range(start_epoch, epochs):
+                optimizer.set_epoch(j)
+                if profiler != None:
+                    profiler.set_epoch(j)
                 time1 = time.time()
-                batch_total_loss = 0.0
-                batch_data = [train_image[k:k+batch_size] for k in range(0, len(train_image), batch_size)]
-                batch_label = [train_label[k:k+batch_size] for k in range(0, len(train_label), batch_size)]
+                batch_num = start_batch if j == start_epoch else 0
+                batch_total_loss = start_loss if j == start_epoch else 0.0
                 
-                for mini_batch_image, mini_batch_label in zip(batch_data, batch_label):
+                for mini_batch_image, mini_batch_label in prefetch_batches(train_image, train_label, batch_size, epoch=j, seed=seed, start_batch=batch_num):
                     batch_num += 1
                     batch_total_loss += update_batch(mini_batch_image, mini_batch_label, batch_size, eta)
+                    if checkpoint_every != None and batch_num % checkpoint_every == 0:
+                        checkpointer.save(j, batch_num, batch_total_loss)
                     
-                print(f"=============epoch{j}: average loss={batch_total_loss / batch_num}==========")
-                self.save()
-                batch_num = 0
+                print(f"=============epoch{j}: average loss={batch_total_loss / max(batch_num, 1)}==========")
+                checkpointer.save(j + 1, 0)
+                if profiler != None:
+                    profiler.print_summary(j)
                 time2 = time.time()
                 print("epoch time:", time2-time1)
 
         def update_batch(batch_data,batch_label,batch_size, eta):
-            total_conv_w = []
-            total_conv_b = []
-            total_fc_w = []
-            total_fc_b = []
-            total_loss = 0.0
-            for data, label in zip(batch_data, batch_label):
-                g_conv_w, g_conv_b, g_fc_w, g_fc_b, loss = backprob(data,label)
-                total_loss += loss
-                if len(total_conv_w) == 0:
-                    total_conv_w = g_conv_w.copy()
-                    total_conv_b = g_conv_b.copy()
-                    total_fc_w = g_fc_w.copy()
-                    total_fc_b = g_fc_b.copy()
-                else:
-                    total_conv_w = [ w1 + dw for w1, dw in zip(total_conv_w, g_conv_w)]
-                    total_conv_b = [ b1 + db for b1, db in zip(total_conv_b, g_conv_b)]
-                    total_fc_w = [ w1 + dw for w1, dw in zip(total_fc_w, g_fc_w)]
-                    total_fc_b = [ b1 + db for b1, db in zip(total_fc_b, g_fc_b)]
-
-            for w, g_w in zip(self.conv_kernel,total_conv_w):
-                w -= eta* g_w / batch_size
-            for b, g_b in zip(self.conv_bias,total_conv_b):
-                b -= eta* g_b / batch_size
-
-            for w, g_w in zip(self.fc_w,total_fc_w):
-                w -= eta* g_w / batch_size
-            for b, g_b in zip(self.fc_b,total_fc_b):
-                b -= eta* g_b[:,0] / batch_size
-
-            total_loss /= batch_size
+            total_loss = self.update_batch(batch_data, batch_label, optimizer, trainer, num_sampled)
             print("====================")
             print("loss:",total_loss)
             return total_loss
-                
-        def backprob(data, label):
-            
-            # Forward propagation
-
-            pad1 = padding(data, 2)
-            conv_input = np.zeros((pad1.shape[0], pad1.shape[1], 1), dtype=np.double)
-            conv_input[:,:,0] = pad1
-
-            conv1 = conv(conv_input, self.conv1_kernel, self.conv1_bias)
-            mfm1, mfm1_location = mfm(conv1)
-
-            pool1, pool1_location = pool(mfm1)
-
-            conv2a = conv(pool1, self.conv2a_kernel, self.conv2a_bias)
-            mfm2a, mfm2a_location = mfm(conv2a)
-
-            conv2 = conv(padding( mfm2a,1), self.conv2_kernel, self.conv2_bias)
-            mfm2, mfm2_location = mfm(conv2)
-
-            pool2, pool2_location = pool(mfm2)
-
-            conv3a = conv(pool2, self.conv3a_kernel, self.conv3a_bias)
-            mfm3a, mfm3a_location = mfm(conv3a)
-
-            conv3 = conv(padding(mfm3a, 1), self.conv3_kernel, self.conv3_bias)
-            mfm3, mfm3_location = mfm(conv3)
-
-            pool3, pool3_location = pool(mfm3)
-
-            conv4a = conv(pool3, self.conv4a_kernel, self.conv4a_bias)
-            mfm4a, mfm4a_location = mfm(conv4a)
-
-            conv4 = conv(padding(mfm4a, 1), self.conv4_kernel, self.conv4_bias)
-            mfm4, mfm4_location = mfm(conv4)
-
-            conv5a = conv(mfm4, self.conv5a_kernel, self.conv5a_bias)
-            mfm5a, mfm5a_location = mfm(conv5a)
-
-            conv5 = conv(padding(mfm5a,1), self.conv5_kernel, self.conv5_bias)
-            mfm5, mfm5_location = mfm(conv5)
-                
-            pool4, pool4_location = pool(mfm5)
-
-            fc1 = fc(pool4, self.fc_weights, self.fc_bias)
-            mfm_fc1, mfm_fc1_location = mfm_fc(fc1)
-
-            fc2 = fc(mfm_fc1, self.fcout_weights, self.fcout_bias)
-
-            softmax_output = softmax(fc2)
-            loss = cross_entropy(softmax_output,label)
-            
-            g_softmax = get_derivative_softmax(softmax_output,label)
-
-            # Backward propagation
         
-            g_fc2_w, g_fc2_b, g_fc2_x = get_derivative_fcout(mfm_fc1,self.fcout_weights,self.fcout_bias,g_softmax)
-
-            g_mfm_fc1 = get_derivate_mfm_fc1(mfm_fc1_location, g_fc2_x)
-            g_fc1_w, g_fc1_b, g_fc1_x = get_derivative_fc(pool4.flatten(), self.fc_weights, self.fc_bias, g_mfm_fc1)
-
-            g_pool4 = get_derivative_pool(pool4_location, g_fc1_x, pool4)
-            
-            g_mfm5 = get_derivative_mfm( mfm5_location, g_pool4)
-            g_conv5_w, g_conv5_b, g_conv5_x = get_derivative_conv(padding(mfm5a,1),self.conv5_kernel, self.conv5_bias, g_mfm5,conv5)
-            
-            g_mfm5a = get_derivative_mfm( mfm5a_location, g_conv5_x)
-            g_conv5a_w, g_conv5a_b, g_conv5a_x = get_derivative_conv(mfm4,self.conv5a_kernel, self.conv5a_bias, g_mfm5a,conv5a)
-
-            g_mfm4 = get_derivative_mfm( mfm4_location, g_conv5a_x)
-            g_conv4_w, g_conv4_b, g_conv4_x = get_derivative_conv(padding(mfm4a,1),self.conv4_kernel, self.conv4_bias, g_mfm4,conv4)
-
-            g_mfm4a = get_derivative_mfm( mfm4a_location, g_conv4_x)
-            g_conv4a_w, g_conv4a_b, g_conv4a_x = get_derivative_conv(pool3,self.conv4a_kernel, self.conv4a_bias, g_mfm4a,conv4a)
+        if profiler != None:
+            profiler.enable()
+        try:
+            SGD(data, label, None, None, epoch, min_batch_size, eta)
+        finally:
+            if profiler != None:
+                profiler.disable()
+            if trainer != None:
+                trainer.close()
+                optimizer.rebind(self.parameters())
+            checkpointer.close()
+            self.graph.clear()   # the training arenas are not needed for inference
+        self.save(save_path)
         
-            g_pool3 = get_derivative_pool(pool3_location, g_conv4a_x,pool3)
-            
-            g_mfm3 = get_derivative_mfm( mfm3_location, g_pool3)
-            g_conv3_w, g_conv3_b, g_conv3_x = get_derivative_conv(padding(mfm3a,1),self.conv3_kernel, self.conv3_bias, g_mfm3,conv3)
-            
-            g_mfm3a = get_derivative_mfm( mfm3a_location, g_conv3_x)
-            g_conv3a_w, g_conv3a_b, g_conv3a_x = get_derivative_conv(pool2,self.conv3a_kernel, self.conv3a_bias, g_mfm3a,conv3a)
-            
-            g_pool2 = get_derivative_pool(pool2_location, g_conv3a_x,pool2)
-
-            g_mfm2 = get_derivative_mfm( mfm2_location, g_pool2)
-            g_conv2_w, g_conv2_b, g_conv2_x = get_derivative_conv(padding(mfm2a,1),self.conv2_kernel, self.conv2_bias, g_mfm2,conv2)
-            g_mfm2a = get_derivative_mfm( mfm2a_location, g_conv2_x)
-            g_conv2a_w, g_conv2a_b, g_conv2a_x = get_derivative_conv(pool1,self.conv2a_kernel, self.conv2a_bias, g_mfm2a,conv2a)
-        
-            g_pool1 = get_derivative_pool(pool1_location, g_conv2a_x,pool1)
-
-            g_mfm1 = get_derivative_mfm( mfm1_location, g_pool1)
-            g_conv1_w, g_conv1_b= get_derivative_conv1(padding(data, 2),self.conv1_kernel, self.conv1_bias, g_mfm1,conv1)
-            
-            g_conv_w = [ g_conv1_w,g_conv2a_w, g_conv2_w, g_conv3a_w, g_conv3_w, g_conv4a_w, g_conv4_w, g_conv5a_w, g_conv5_w ]
-            g_conv_b = [ g_conv1_b,g_conv2a_b, g_conv2_b, g_conv3a_b, g_conv3_b, g_conv4a_b, g_conv4_b, g_conv5a_b, g_conv5_b ]
-            
-            g_fc_w = [g_fc1_w, g_fc2_w]
-            g_fc_b = [g_fc1_b, g_fc2_b]
-
-            return g_conv_w, g_conv_b, g_fc_w, g_fc_b, loss
-        
-        SGD(data, label, None, None, epoch, min_batch_size, eta)
-        
-    def test(self, path_match, path_mismatch):
-        FP = 0
-        FN = 0
-        TP = 0
-        TN = 0
-        sim_thr = -0.0926
-        allsim1 = 0
-        allsim2 = 0
-
-        dir1 = os.listdir(path_match)
-        for dir in dir1: # Test match pairs
-            files = os.listdir(os.path.join(path_match,dir))
-            image1 = io.imread(os.path.join(path_match,dir,files[0]), as_gray=True)
-            image1 = transform.resize(image1[25:-25][25:-25], (image_width, image_height))
-            image1 = (image1-np.amin(image1))/(np.amax(image1)-np.amin(image1))
-            predict1 = self.forward(image1)
-            image2 = io.imread(os.path.join(path_match,dir,files[1]), as_gray=True)
-            image2 = transform.resize(image2[25:-25][25:-25], (image_width, image_height))
-            image2 = (image2-np.amin(image2))/(np.amax(image2)-np.amin(image2))
-            predict2 = self.forward(image2)            
-            similarity = np.corrcoef(predict1, predict2)[0,1]
-            allsim1 += similarity
-            if similarity >= sim_thr:
-                TP += 1
-            else:
-                FN += 1
-
-        dir2 = os.listdir(path_mismatch)
-        for dir in dir2[:len(dir1)]: # Test mismatch pairs
-            files = os.listdir(os.path.join(path_mismatch,dir))
-            image1 = io.imread(os.path.join(path_mismatch,dir,files[0]), as_gray=True)
-            image1 = transform.resize(image1[25:-25][25:-25], (image_width, image_height))
-            image1 = (image1-np.amin(image1))/(np.amax(image1)-np.amin(image1))
-            predict1 = self.forward(image1)
-            image2 = io.imread(os.path.join(path_mismatch,dir,files[1]), as_gray=True)
-            image2 = transform.resize(image2[25:-25][25:-25], (image_width, image_height))
-            image2 = (image2-np.amin(image2))/(np.amax(image2)-np.amin(image2))
-            predict2 = self.forward(image2)
-            similarity = np.corrcoef(predict1, predict2)[0,1]
-            allsim2 += similarity
-            if similarity >= sim_thr:
-                FP += 1
+    def embed_files(self, paths, cache_dir=EMBEDDING_CACHE_DIR, batch_size=64, workers=None):
+        '''
+        Output the features of image files, (n paths) -> (n, 256).
+        Features of images already embedded with the same weights and preprocessing are read from
+        the embedding cache in cache_dir; only new images are decoded (by `workers` processes)
+        and run through the model.
+        '''
+        if cache_dir == None:
+            return self.forward_batch(list(load_images(paths, workers)), batch_size)
+
+        cache = EmbeddingCache(cache_dir)
+        weights_hash = self.weights_hash()
+        features = np.zeros((len(paths), 256), dtype=np.double)
+        keys = []
+        missing = []
+        for i, path in enumerate(paths):
+            file = open(path, 'rb')
+            key = (content_hash(file.read()), weights_hash, PREPROCESS_VERSION)
+            file.close()
+            keys.append(key)
+            feature = cache.get(key)
+            if feature is None:
+                missing.append(i)
             else:
-                TN += 1
+                features[i] = feature
+        if len(missing) > 0:
+            features[missing] = self.forward_batch(list(load_images([paths[i] for i in missing], workers)), batch_size)
+            for i in missing:
+                cache.put(keys[i], features[i])
+            cache.flush()
+        return features
+
+    def pair_scores(self, path_match, path_mismatch, cache_dir=EMBEDDING_CACHE_DIR, workers=None):
+        '''
+        Pearson similarity of every match pair and of as many mismatch pairs
+        path_match, path_mismatch: directories of pair directories or CSV manifests (see pairs.py)
+        Images in several pairs are embedded once
+        '''
+        with PairScorer(self, cache_dir, workers=workers) as scorer:
+            match_similarity = scorer.scores(path_match)
+            mismatch_similarity = scorer.scores(path_mismatch, len(match_similarity))
+        return match_similarity, mismatch_similarity
+
+    def calibrate_threshold(self, path_match, path_mismatch, cache_dir=EMBEDDING_CACHE_DIR, workers=None):
+        '''
+        Set sim_thr to the threshold with the best F1 score on the given pairs.
+        test and TA_test use it, and it is saved with the model.
+        '''
+        match_similarity, mismatch_similarity = self.pair_scores(path_match, path_mismatch, cache_dir, workers)
+        self.sim_thr, F1 = best_threshold(match_similarity, mismatch_similarity)
+        print("sim_thr:", self.sim_thr, "F1:", F1)
+        return self.sim_thr, F1
+
+    def test(self, path_match, path_mismatch, cache_dir=EMBEDDING_CACHE_DIR, workers=None, sim_thr=None):
+        if sim_thr == None:
+            sim_thr = self.sim_thr
+        match_similarity, mismatch_similarity = self.pair_scores(path_match, path_mismatch, cache_dir, workers)
+        TP = np.count_nonzero(match_similarity >= sim_thr)
+        FN = len(match_similarity) - TP
+        FP = np.count_nonzero(mismatch_similarity >= sim_thr)
+        allsim1 = np.sum(match_similarity)
+        allsim2 = np.sum(mismatch_similarity)
+        pair_num = len(match_similarity)
 
         precision = TP / (TP + FP) 
         recall = TP / (TP + FN) 
@@ -320,41 +392,36 @@ class LightCNN_9(object):
         print("precision:", precision)
         print("recall:", recall)
         print("F1:", F1)
-        print("sim1:",allsim1/len(dir1),"sim2:",allsim2/len(dir1),"delta:",allsim1/len(dir1)-allsim2/len(dir1))
+        print("sim1:",allsim1/pair_num,"sim2:",allsim2/pair_num,"delta:",allsim1/pair_num-allsim2/pair_num)
+        return match_similarity, mismatch_similarity
     
-    def TA_test(self, path):
-        dirs = os.listdir(path)
-        sim_thr = -0.0926
-        result = open("result.txt","w")
-        for dir in dirs:
-            files = os.listdir(os.path.join(path,dir))
-            image1 = io.imread(os.path.join(path,dir,files[0]), as_gray=True)
-            image1 = transform.resize(image1[25:-25][25:-25], (image_width, image_height))
-            image1 = (image1-np.amin(image1))/(np.amax(image1)-np.amin(image1))
-            predict1 = self.forward(image1)
-            image2 = io.imread(os.path.join(path,dir,files[1]), as_gray=True)
-            image2 = transform.resize(image2[25:-25][25:-25], (image_width, image_height))
-            image2 = (image2-np.amin(image2))/(np.amax(image2)-np.amin(image2))
-            predict2 = self.forward(image2)
-            similarity = np.corrcoef(predict1, predict2)[0,1]
-            if similarity >= sim_thr:
-                result.write(str(1)+'\n')
-            else:
-                result.write(str(0)+'\n')
-        result.close()
+    def TA_test(self, path, cache_dir=EMBEDDING_CACHE_DIR, workers=None, sim_thr=None):
+        '''
+        Write the decision (1 match, 0 mismatch) of every pair of path to result.txt, streamed
+        by pairs.PairScorer; path is a directory of pair directories or a CSV manifest
+        '''
+        if sim_thr == None:
+            sim_thr = self.sim_thr
+        with PairScorer(self, cache_dir, workers=workers) as scorer:
+            scorer.run(path, "result.txt", sim_thr)
         return
 
 if __name__ == "__main__":
+    from conv_autotune import enable_conv_autotuning
+    # conv picks img2col/direct1x1/winograd/fft per shape, timed once and cached in conv_autotune.json
+    enable_conv_autotuning()
 
     # Data loading
     path = './train_image/*/*/*.jpg'
     time1= time.time()
-    train_data, train_label = traindata_loader(path)
+    build_traindata_cache(path)
+    train_data, train_label = traindata_cache_loader()
+    num_classes = traindata_class_count()
     time2= time.time()
     print(f"Data loading finished.{time2 - time1}")
 
     # Training
-    model = LightCNN_9()
+    model = LightCNN_9(num_classes=num_classes)
     model.train(train_data, train_label, epoch=20, min_batch_size=64, eta=0.0005)
     
     # Testing
@@ -0,0 +1,99 @@
+import numpy as np
+import json
+import os
+import pickle
+import struct
+import sys
+
+'''
+Weight file layout (version 1), all integers little endian:
+  magic        8 bytes  b'LCNN9WT\0'
+  version      uint32
+  header size  uint32
+  header       JSON: {"tensors": [{"name", "dtype", "shape", "offset"}], "attributes": {...}}
+  tensors      raw C-order data, each starting at a multiple of ALIGN bytes from the file start
+Loading maps the file once with np.memmap and returns views on it, so nothing is deserialized and
+every process loading the same file shares one page-cache copy of the weights.
+'''
+MAGIC = b'LCNN9WT\0'
+FORMAT_VERSION = 1
+ALIGN = 64
+
+
+def save_weights(path, tensors, attributes=None):
+    '''
+    tensors: list of (name, array), attributes: JSON-serializable dict
+    The file is written to path.tmp and renamed, so readers never see a partial file.
+    '''
+    entries = []
+    offset = 0
+    for name, tensor in tensors:
+        entries.append({'name': name, 'dtype': tensor.dtype.str, 'shape': list(tensor.shape), 'offset': offset})
+        offset += (tensor.nbytes + ALIGN - 1) // ALIGN * ALIGN
+    # The header holds absolute offsets, so grow the space reserved for it until it fits
+    data_start = 0
+    while True:
+        tensor_entries = [dict(entry, offset=entry['offset'] + data_start) for entry in entries]
+        header = json.dumps({'tensors': tensor_entries, 'attributes': attributes or {}}).encode('utf-8')
+        header_end = (len(MAGIC) + 8 + len(header) + ALIGN - 1) // ALIGN * ALIGN
+        if header_end <= data_start:
+            break
+        data_start = header_end
+    entries = tensor_entries
+
+    tmp_path = path + '.tmp'
+    file = open(tmp_path, 'wb')
+    file.write(MAGIC)
+    file.write(struct.pack('<II', FORMAT_VERSION, len(header)))
+    file.write(header)
+    for entry, (name, tensor) in zip(entries, tensors):
+        file.write(b'\0' * (entry['offset'] - file.tell()))
+        file.write(memoryview(np.ascontiguousarray(tensor)).cast('B'))
+    file.close()
+    os.replace(tmp_path, path)
+    return
+
+def load_weights(path, mode='c'):
+    '''
+    -> ({name: array}, attributes); the arrays are views on one np.memmap of the file.
+    mode: 'r' read-only, 'c' copy-on-write (arrays can be updated in place, the file is not changed)
+    '''
+    file = open(path, 'rb')
+    magic = file.read(len(MAGIC))
+    if magic != MAGIC:
+        file.close()
+        raise ValueError(f"{path} is not a LightCNN-9 weight file; convert pickled models with "
+                         f"'python model_format.py {path} <new path>'")
+    version, header_size = struct.unpack('<II', file.read(8))
+    if version > FORMAT_VERSION:
+        file.close()
+        raise ValueError(f"{path} has weight format version {version}, newer than {FORMAT_VERSION}")
+    header = json.loads(file.read(header_size).decode('utf-8'))
+    file.close()
+
+    data = np.memmap(path, dtype=np.uint8, mode=mode)
+    tensors = {}
+    for entry in header['tensors']:
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape']))
+        tensors[entry['name']] = data[entry['offset']:entry['offset'] + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+    return tensors, header['attributes']
+
+def convert_pickle_model(src, dst):
+    '''
+    Convert a model pickled by the old LightCNN_9.save (a pickled __dict__) into a weight file.
+    Unpickling can run arbitrary code: only convert files you trust.
+    '''
+    from main import LightCNN_9
+    file = open(src, 'rb')
+    state = pickle.loads(file.read())
+    file.close()
+    tensors = [(name, np.asarray(state[name])) for name in LightCNN_9.param_names]
+    attributes = {'sim_thr': float(state.get('sim_thr', -0.0926))}
+    save_weights(dst, tensors, attributes)
+    return
+
+
+if __name__ == "__main__":
+    # python model_format.py old_pickled_model.bin new_model.bin
+    convert_pickle_model(sys.argv[1], sys.argv[2])
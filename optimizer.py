@@ -0,0 +1,213 @@
+import numpy as np
+import collections
+import math
+import pickle
+
+# Gradient that is zero except in some columns (last axis) of its parameter, e.g. the output layer
+# trained with a sampled softmax: param[..., columns] has gradient values
+ColumnGradient = collections.namedtuple('ColumnGradient', ['columns', 'values'])
+
+
+def step_lr(lr, step_size, gamma=0.1):
+    '''
+    learning rate schedule: lr * gamma every step_size epochs
+    '''
+    return lambda epoch: lr * gamma ** (epoch // step_size)
+
+def cosine_lr(lr, epochs, min_lr=0.0):
+    '''
+    learning rate schedule: cosine decay from lr to min_lr over epochs
+    '''
+    return lambda epoch: min_lr + (lr - min_lr) * (1 + math.cos(math.pi * min(epoch, epochs) / epochs)) / 2
+
+
+class Optimizer(object):
+    '''
+    Updates a model's parameters in place.
+    params: list of (name, array) as returned by LightCNN_9.parameters(), the arrays are updated in place
+    Every parameter gets a preallocated gradient buffer (and the state buffers of the method), so
+    zero_grad/accumulate/step allocate nothing for dense gradients.
+    A parameter whose gradients since zero_grad were all ColumnGradient is only touched in those
+    columns: zero_grad, accumulate and step (its state and weight decay included) cost O(columns),
+    so the columns not sampled keep their optimizer state until they are (a lazy update, as sparse
+    optimizers do; with plain SGD it is the same as the dense step).
+    Weight decay is decoupled: param *= 1 - lr*weight_decay before the gradient step.
+    schedule: optional function epoch -> learning rate, applied by set_epoch
+    '''
+    def __init__(self, params, lr, weight_decay=0.0, schedule=None):
+        self.names = [name for name, param in params]
+        self.params = [param for name, param in params]
+        self.grads = [np.zeros_like(param) for param in self.params]
+        # columns of each buffer that may be nonzero (None: any), see accumulate
+        self.grad_columns = [np.zeros(0, dtype=np.intp) for param in self.params]
+        self.lr = lr
+        self.weight_decay = weight_decay
+        self.schedule = schedule
+        self.epoch = 0
+        self.step_num = 0
+        return
+
+    def rebind(self, params):
+        '''
+        Point the optimizer at new parameter arrays, e.g. after the model's weights moved to shared memory
+        '''
+        assert [name for name, param in params] == self.names
+        self.params = [param for name, param in params]
+        return
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if self.schedule != None:
+            self.lr = self.schedule(epoch)
+        return
+
+    def zero_grad(self):
+        for i, grad in enumerate(self.grads):
+            if self.grad_columns[i] is None:
+                grad.fill(0)
+            else:
+                grad[..., self.grad_columns[i]] = 0
+            self.grad_columns[i] = np.zeros(0, dtype=np.intp)
+        return
+
+    def accumulate(self, grads):
+        '''
+        Add gradients, given in the order of params, to the gradient buffers
+        grads: arrays, or ColumnGradient for gradients that are zero outside some columns
+        '''
+        assert len(grads) == len(self.grads)
+        for i, (buffer, grad) in enumerate(zip(self.grads, grads)):
+            if isinstance(grad, ColumnGradient):
+                columns = np.asarray(grad.columns)
+                index = (Ellipsis, columns)
+                buffer[index] += grad.values.reshape(buffer[index].shape)
+                if self.grad_columns[i] is not None:
+                    self.grad_columns[i] = np.union1d(self.grad_columns[i], columns)
+            else:
+                np.add(buffer, grad.reshape(buffer.shape), out=buffer)
+                self.grad_columns[i] = None
+        return
+
+    def step(self, scale=1.0):
+        '''
+        Update every parameter from its accumulated gradient times scale (e.g. 1/batch_size).
+        The gradient buffers are used as scratch space: call zero_grad before accumulating again.
+        '''
+        self.step_num += 1
+        for i, (param, grad) in enumerate(zip(self.params, self.grads)):
+            if self.grad_columns[i] is None:
+                grad *= scale
+                if self.weight_decay != 0:
+                    param *= 1 - self.lr * self.weight_decay
+                self.update(i, param, grad)
+            elif len(self.grad_columns[i]) > 0:
+                # the columns' copies go through update, then are written back
+                index = (Ellipsis, self.grad_columns[i])
+                columns_grad = grad[index] * scale
+                columns_param = param[index]
+                if self.weight_decay != 0:
+                    columns_param *= 1 - self.lr * self.weight_decay
+                self.update(i, columns_param, columns_grad, index)
+                param[index] = columns_param
+        return
+
+    def update(self, i, param, grad, index=None):
+        '''
+        Update param (parameter i, or its columns `index` of it) in place from grad, which may be overwritten
+        '''
+        raise NotImplementedError
+
+    def state_dict(self):
+        state = {'names': self.names, 'lr': self.lr, 'epoch': self.epoch, 'step_num': self.step_num}
+        for key in self.state_buffers():
+            state[key] = [np.array(buffer) for buffer in getattr(self, key)]
+        return state
+
+    def load_state_dict(self, state):
+        assert state['names'] == self.names
+        self.lr = state['lr']
+        self.epoch = state['epoch']
+        self.step_num = state['step_num']
+        for key in self.state_buffers():
+            for buffer, saved in zip(getattr(self, key), state[key]):
+                buffer[...] = saved
+        return
+
+    def state_buffers(self):
+        return []
+
+    def save(self, path):
+        file = open(path, 'wb')
+        file.write(pickle.dumps(self.state_dict()))
+        file.close()
+        return
+
+    def load(self, path):
+        file = open(path, 'rb')
+        self.load_state_dict(pickle.loads(file.read()))
+        file.close()
+        return
+
+class SGD(Optimizer):
+    '''
+    SGD with optional momentum: v = momentum*v + g, param -= lr*v
+    '''
+    def __init__(self, params, lr, momentum=0.0, weight_decay=0.0, schedule=None):
+        Optimizer.__init__(self, params, lr, weight_decay, schedule)
+        self.momentum = momentum
+        self.velocity = [np.zeros_like(param) for param in self.params] if momentum != 0 else []
+        return
+
+    def update(self, i, param, grad, index=None):
+        if self.momentum != 0:
+            velocity = self.velocity[i] if index == None else self.velocity[i][index]
+            velocity *= self.momentum
+            velocity += grad
+            if index != None:
+                self.velocity[i][index] = velocity
+            np.multiply(velocity, self.lr, out=grad)
+        else:
+            grad *= self.lr
+        param -= grad
+        return
+
+    def state_buffers(self):
+        return ['velocity'] if self.momentum != 0 else []
+
+class Adam(Optimizer):
+    '''
+    Adam: m = b1*m + (1-b1)*g, v = b2*v + (1-b2)*g^2, param -= lr_t * m / (sqrt(v) + eps)
+    with the bias correction folded into lr_t
+    '''
+    def __init__(self, params, lr, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.0, schedule=None):
+        Optimizer.__init__(self, params, lr, weight_decay, schedule)
+        self.beta1, self.beta2 = betas
+        self.eps = eps
+        self.m = [np.zeros_like(param) for param in self.params]
+        self.v = [np.zeros_like(param) for param in self.params]
+        return
+
+    def update(self, i, param, grad, index=None):
+        m = self.m[i] if index == None else self.m[i][index]
+        v = self.v[i] if index == None else self.v[i][index]
+        # m = b1*(m - g) + g, v = b2*(v - g^2) + g^2, in place
+        m -= grad
+        m *= self.beta1
+        m += grad
+        grad *= grad
+        v -= grad
+        v *= self.beta2
+        v += grad
+        lr_t = self.lr * math.sqrt(1 - self.beta2 ** self.step_num) / (1 - self.beta1 ** self.step_num)
+        np.sqrt(v, out=grad)
+        grad += self.eps
+        np.divide(m, grad, out=grad)
+        grad *= lr_t
+        param -= grad
+        if index != None:
+            self.m[i][index] = m
+            self.v[i][index] = v
+        return
+
+    def state_buffers(self):
+        return ['m', 'v']
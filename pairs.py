@@ -0,0 +1,200 @@
+import numpy as np
+import csv
+import os
+import sys
+import tempfile
+
+from evaluation import normalize_features
+from embedding_cache import EMBEDDING_CACHE_DIR
+from utils import load_images
+
+'''
+Scoring of verification protocols: lists of image pairs, given as a directory of pair directories
+(each holding the two images of one pair) or as a CSV manifest with lines image1,image2[,label]
+(label 1 for a match, 0 for a mismatch; relative paths are relative to the manifest).
+'''
+PAIR_CHUNK_SIZE = 65536
+
+
+def pair_files(path, limit=None):
+    '''
+    The two image files of every pair directory in path (of the first limit directories),
+    [pair0 image0, pair0 image1, pair1 image0, ...]
+    '''
+    files = []
+    for dir in os.listdir(path)[:limit]:
+        images = os.listdir(os.path.join(path,dir))
+        files += [os.path.join(path,dir,images[0]), os.path.join(path,dir,images[1])]
+    return files
+
+def manifest_pairs(path, limit=None):
+    '''
+    Yield (image1, image2, label or None) for each line of a CSV manifest, a header line is skipped
+    '''
+    root = os.path.dirname(path)
+    file = open(path, newline='')
+    try:
+        count = 0
+        for row in csv.reader(file):
+            if len(row) == 0 or row[0].strip().lower() in ('image1', 'path1', 'image'):
+                continue
+            if limit != None and count >= limit:
+                break
+            image1, image2 = (os.path.join(root, image.strip()) for image in row[:2])
+            label = int(row[2]) if len(row) > 2 and row[2].strip() != '' else None
+            count += 1
+            yield image1, image2, label
+    finally:
+        file.close()
+
+def read_pairs(source, limit=None, label=None):
+    '''
+    Yield (image1, image2, label) from a directory of pair directories or a CSV manifest
+    label: the label of every pair of a directory (e.g. 1 for match_pairs), None if unknown
+    '''
+    if os.path.isdir(source):
+        files = pair_files(source, limit)
+        for k in range(0, len(files), 2):
+            yield files[k], files[k+1], label
+    else:
+        yield from manifest_pairs(source, limit)
+
+
+class PairScorer(object):
+    '''
+    Scores pair lists with a model, embedding each distinct image once however many pairs it is in.
+    First pass over the pairs: each distinct image path gets a row; the images are embedded
+    `embed_block` at a time (with model.embed_files if it has one, so the embedding cache is used too), centered and
+    normalized, and stored in a memory-mapped temporary file.
+    Second pass: the pairs are read again `chunk_size` at a time and all Pearson scores of a chunk are
+    one row-wise dot product of the normalized embeddings. Only the path -> row index and one
+    chunk are in memory, so protocol files of any length can be scored.
+    '''
+    def __init__(self, model, cache_dir=EMBEDDING_CACHE_DIR, batch_size=64, workers=None,
+                 chunk_size=PAIR_CHUNK_SIZE, embed_block=4096):
+        self.model = model
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.embed_block = embed_block
+        self.rows = {}
+        self.features = None
+        self.file = None
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def row(self, path):
+        return self.rows.setdefault(os.path.normpath(path), len(self.rows))
+
+    def embed(self, sources):
+        '''
+        Embed every distinct image of the pairs of sources (list of (source, limit, label)) not embedded yet
+        '''
+        start = len(self.rows)
+        for source, limit, label in sources:
+            for image1, image2, pair_label in read_pairs(source, limit, label):
+                self.row(image1)
+                self.row(image2)
+        if len(self.rows) == start:
+            return
+        file = tempfile.TemporaryFile()
+        features = np.memmap(file, dtype=np.double, mode='w+', shape=(len(self.rows), 256))
+        if self.features is not None:
+            features[:start] = self.features
+            self.close()
+        self.file, self.features = file, features
+        paths = list(self.rows)[start:]
+        for k in range(0, len(paths), self.embed_block):
+            block = paths[k:k+self.embed_block]
+            if hasattr(self.model, 'embed_files'):
+                embeddings = self.model.embed_files(block, self.cache_dir, self.batch_size, self.workers)
+            else:   # e.g. quantize.QuantizedLightCNN9, no embedding cache
+                embeddings = self.model.forward_batch(list(load_images(block, self.workers)), self.batch_size)
+            self.features[start+k:start+k+len(block)] = normalize_features(embeddings)
+        return
+
+    def score_chunks(self, source, limit=None, label=None):
+        '''
+        Yield (scores, labels) of the pairs of source, chunk_size pairs at a time
+        labels: array of the pairs' labels, -1 where unknown
+        '''
+        self.embed([(source, limit, label)])
+        rows1, rows2, labels = [], [], []
+        for image1, image2, pair_label in read_pairs(source, limit, label):
+            rows1.append(self.row(image1))
+            rows2.append(self.row(image2))
+            labels.append(-1 if pair_label == None else pair_label)
+            if len(rows1) == self.chunk_size:
+                yield self.score_rows(rows1, rows2), np.array(labels)
+                rows1, rows2, labels = [], [], []
+        if len(rows1) > 0:
+            yield self.score_rows(rows1, rows2), np.array(labels)
+
+    def score_rows(self, rows1, rows2):
+        return np.einsum('ij,ij->i', self.features[rows1], self.features[rows2])
+
+    def scores(self, source, limit=None):
+        '''
+        Pearson score of every pair of source -> (n)
+        '''
+        chunks = [scores for scores, labels in self.score_chunks(source, limit)]
+        return np.concatenate(chunks) if chunks else np.zeros(0)
+
+    def run(self, source, out_path, sim_thr, limit=None, label=None, with_scores=False):
+        '''
+        Write the decision of every pair of source (1 if its score >= sim_thr, else 0) to out_path,
+        one line per pair ("decision,score" with with_scores), a chunk at a time
+        -> counts: pairs, accepted, and if the pairs have labels TP, FP, FN, TN, precision, recall, F1
+        '''
+        counts = {'pairs': 0, 'accepted': 0, 'TP': 0, 'FP': 0, 'FN': 0, 'TN': 0}
+        labeled = 0
+        file = open(out_path, 'w')
+        try:
+            for scores, labels in self.score_chunks(source, limit, label):
+                decisions = scores >= sim_thr
+                if with_scores:
+                    lines = [f'{int(decision)},{score:.6f}' for decision, score in zip(decisions, scores)]
+                else:
+                    lines = [str(int(decision)) for decision in decisions]
+                file.write('\n'.join(lines) + '\n')
+                counts['pairs'] += len(scores)
+                counts['accepted'] += int(np.count_nonzero(decisions))
+                labeled += int(np.count_nonzero(labels >= 0))
+                counts['TP'] += int(np.count_nonzero(decisions & (labels == 1)))
+                counts['FP'] += int(np.count_nonzero(decisions & (labels == 0)))
+                counts['FN'] += int(np.count_nonzero(~decisions & (labels == 1)))
+                counts['TN'] += int(np.count_nonzero(~decisions & (labels == 0)))
+        finally:
+            file.close()
+        if labeled == 0:
+            for key in ('TP', 'FP', 'FN', 'TN'):
+                del counts[key]
+            return counts
+        TP, FP, FN = counts['TP'], counts['FP'], counts['FN']
+        counts['precision'] = TP / (TP + FP) if TP + FP > 0 else 0.0
+        counts['recall'] = TP / (TP + FN) if TP + FN > 0 else 0.0
+        counts['F1'] = 2 * TP / (2 * TP + FP + FN) if TP > 0 else 0.0
+        return counts
+
+    def close(self):
+        if self.file != None:
+            del self.features
+            self.features = None
+            self.file.close()
+            self.file = None
+        return
+
+
+if __name__ == "__main__":
+    # python pairs.py LightCNN9_model.bin pairs.csv result.txt [sim_thr]
+    from quantize import load_model
+    model = load_model(sys.argv[1])
+    sim_thr = float(sys.argv[4]) if len(sys.argv) > 4 else model.sim_thr
+    with PairScorer(model) as scorer:
+        print(scorer.run(sys.argv[2], sys.argv[3], sim_thr, with_scores=True))
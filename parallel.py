@@ -0,0 +1,170 @@
+import numpy as np
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+from main import LightCNN_9, image_width, image_height
+from optimizer import ColumnGradient
+from utils import label_ids
+
+
+def shared_layout(model, align=64):
+    '''
+    (name, shape, offset) of every parameter packed into one buffer, offsets aligned to align bytes
+    -> layout, total bytes
+    '''
+    layout = []
+    offset = 0
+    for name, param in model.parameters():
+        layout.append((name, param.shape, offset))
+        offset += (param.nbytes + align - 1) // align * align
+    return layout, max(offset, align)
+
+def shared_views(buffer, layout, dtype):
+    return [np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset) for name, shape, offset in layout]
+
+def worker_loop(param_name, grad_name, input_name, layout, dtype, max_batch_size, conn):
+    '''
+    Worker process: computes the gradients of its shard of each mini-batch with LightCNN_9.backprob
+    on the shared weights and writes them to its own shared gradient buffer.
+    A ColumnGradient (sampled softmax head) only writes its columns -> sends (loss, {param index: columns})
+    '''
+    param_memory = shared_memory.SharedMemory(name=param_name)
+    grad_memory = shared_memory.SharedMemory(name=grad_name)
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    model = LightCNN_9.__new__(LightCNN_9)
+    model.dtype = np.dtype(dtype)
+    model.param_names = [name for name, shape, offset in layout]   # may hold low-rank factors
+    for (name, shape, offset), view in zip(layout, shared_views(param_memory.buf, layout, dtype)):
+        setattr(model, name, view)
+    model.build_param_lists()
+    grads = shared_views(grad_memory.buf, layout, dtype)
+    images, labels = input_views(input_memory.buf, dtype, max_batch_size)
+
+    while True:
+        task = conn.recv()
+        if task == None:
+            break
+        start, stop, sampled = task
+        try:
+            gradients, loss = model.param_gradients(images[start:stop], labels[start:stop], sampled)
+            columns = {}
+            for i, (view, gradient) in enumerate(zip(grads, gradients)):
+                if isinstance(gradient, ColumnGradient):
+                    index = (Ellipsis, gradient.columns)
+                    view[index] = gradient.values.reshape(view[index].shape)
+                    columns[i] = gradient.columns
+                else:
+                    view[...] = gradient.reshape(view.shape)
+            conn.send((float(loss), columns))
+        except Exception as e:
+            conn.send(e)
+    del model, grads, images, labels
+    param_memory.close()
+    grad_memory.close()
+    input_memory.close()
+    conn.close()
+
+def input_views(buffer, dtype, max_batch_size):
+    '''
+    images (max_batch_size, image_height, image_width) and integer labels (max_batch_size,)
+    '''
+    dtype = np.dtype(dtype)
+    images = np.ndarray((max_batch_size, image_height, image_width), dtype=dtype, buffer=buffer)
+    labels = np.ndarray((max_batch_size,), dtype=np.intp, buffer=buffer, offset=images.nbytes)
+    return images, labels
+
+
+class DataParallelTrainer(object):
+    '''
+    Data-parallel gradients on one machine.
+    The model's weights are moved into multiprocessing.shared_memory (the model attributes become
+    views on it), so the in-place optimizer step in this process is seen by every worker without
+    copying. Each of the `workers` long-lived processes computes the gradients of one shard of the
+    mini-batch with backprob into its own shared buffer; compute_gradients sums them into the
+    optimizer's buffers. close() copies the weights back into private arrays.
+    '''
+    def __init__(self, model, workers=None, max_batch_size=64):
+        self.model = model
+        self.workers = os.cpu_count() if workers == None else workers
+        self.max_batch_size = max_batch_size
+        dtype = model.dtype
+        self.layout, size = shared_layout(model)
+
+        self.param_memory = shared_memory.SharedMemory(create=True, size=size)
+        for (name, shape, offset), view in zip(self.layout, shared_views(self.param_memory.buf, self.layout, dtype)):
+            view[...] = getattr(model, name)
+            setattr(model, name, view)
+        model.build_param_lists()
+
+        self.grad_memory = [shared_memory.SharedMemory(create=True, size=size) for i in range(self.workers)]
+        self.grads = [shared_views(memory.buf, self.layout, dtype) for memory in self.grad_memory]
+        input_size = max_batch_size * (image_height * image_width * dtype.itemsize + np.dtype(np.intp).itemsize)
+        self.input_memory = shared_memory.SharedMemory(create=True, size=input_size)
+        self.images, self.labels = input_views(self.input_memory.buf, dtype, max_batch_size)
+
+        self.connections = []
+        self.processes = []
+        for i in range(self.workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=worker_loop, daemon=True,
+                args=(self.param_memory.name, self.grad_memory[i].name, self.input_memory.name,
+                      self.layout, dtype.str, max_batch_size, child_conn))
+            process.start()
+            child_conn.close()
+            self.connections.append(parent_conn)
+            self.processes.append(process)
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def compute_gradients(self, batch_data, batch_label, optimizer, sampled=None):
+        '''
+        Sum of the gradients over the mini-batch into optimizer's buffers -> summed loss
+        batch_label: integer label ids or one-hot labels, shared with the workers as ids
+        sampled: the sampled softmax classes of the batch (graph.sample_classes), the same for every shard
+        '''
+        batch_num = len(batch_data)
+        assert batch_num <= self.max_batch_size
+        self.images[:batch_num] = batch_data
+        self.labels[:batch_num] = label_ids(batch_label)
+        bounds = np.linspace(0, batch_num, self.workers + 1).astype(int)
+        active = []
+        for i in range(self.workers):
+            if bounds[i+1] > bounds[i]:
+                self.connections[i].send((bounds[i], bounds[i+1], sampled))
+                active.append(i)
+
+        optimizer.zero_grad()
+        total_loss = 0.0
+        for i in active:   # Reduce: sum the shards' gradients
+            result = self.connections[i].recv()
+            if isinstance(result, Exception):
+                raise result
+            loss, columns = result
+            total_loss += loss
+            optimizer.accumulate([ColumnGradient(columns[k], grad[..., columns[k]]) if k in columns else grad
+                                  for k, grad in enumerate(self.grads[i])])
+        return total_loss
+
+    def close(self):
+        for conn in self.connections:
+            conn.send(None)
+        for process in self.processes:
+            process.join()
+        for conn in self.connections:
+            conn.close()
+        for name, param in self.model.parameters():
+            setattr(self.model, name, np.array(param))
+        self.model.build_param_lists()
+        self.grads = self.images = self.labels = None
+        for memory in [self.param_memory, self.input_memory] + self.grad_memory:
+            memory.close()
+            memory.unlink()
+        self.connections = []
+        self.processes = []
+        return
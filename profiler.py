@@ -0,0 +1,213 @@
+import numpy as np
+import json
+import threading
+import time
+import tracemalloc
+
+import backward_layers
+import graph
+import optimizer as optim
+
+# Layer functions wrapped by the profiler, in the modules that look them up as globals
+LAYER_FUNCTIONS = ['conv', 'mfm', 'mfm_inference', 'pool', 'pool_inference', 'padding', 'fc', 'mfm_fc',
+                   'softmax', 'cross_entropy',
+                   'get_derivative_softmax', 'get_derivative_fcout', 'get_derivate_mfm_fc1', 'get_derivative_fc',
+                   'get_derivative_fc_nobias',
+                   'get_derivative_conv', 'get_derivative_conv2pool', 'get_derivative_conv_batch_w',
+                   'get_derivative_conv1', 'get_derivative_pool', 'get_derivative_mfm']
+# Methods recorded as enclosing spans; a new pass of the layer chain starts at each outermost one
+MODEL_METHODS = ['forward', 'forward_batch', 'backprob', 'update_batch']
+
+
+def patch_layer_functions(wrap, names=LAYER_FUNCTIONS):
+    '''
+    Replace each layer function by wrap(name, func) where graph and backward_layers look it up
+    -> a function undoing the patch
+    '''
+    saved = []
+    for module in (graph, backward_layers):
+        for name in names:
+            if name in module.__dict__:
+                saved.append((module, name, module.__dict__[name]))
+                setattr(module, name, wrap(name, module.__dict__[name]))
+
+    def restore():
+        for module, name, func in reversed(saved):
+            setattr(module, name, func)
+    return restore
+
+def output_info(output):
+    '''
+    (shapes, bytes) of the arrays a layer returned
+    '''
+    if isinstance(output, np.ndarray):
+        return [list(output.shape)], output.nbytes
+    if isinstance(output, (tuple, list)):
+        shapes = []
+        nbytes = 0
+        for item in output:
+            item_shapes, item_bytes = output_info(item)
+            shapes += item_shapes
+            nbytes += item_bytes
+        return shapes, nbytes
+    return [], 0
+
+
+class Profiler(object):
+    '''
+    Opt-in per-layer profiling of LightCNN_9's forward and backward chains.
+    While enabled, every layer function (LAYER_FUNCTIONS) and model method (MODEL_METHODS, plus
+    Optimizer.step) is wrapped to record one event per call: wall time, output shapes and bytes,
+    and with memory=True the peak bytes allocated during the call (tracemalloc, much slower).
+    When disabled the original functions are back in place, so there is no cost at all.
+    Layer calls are named 'name#k', the k-th call of name in the current forward/backprob pass.
+    Usage:
+        with Profiler() as profiler:
+            model.backprob(images, labels)
+        profiler.summary(); profiler.export_chrome_trace('trace.json')
+    '''
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.events = []
+        self.epoch = 0
+        self.local = threading.local()
+        self.restore = None
+        self.origin = time.perf_counter()
+        return
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *args):
+        self.disable()
+
+    def enable(self):
+        if self.restore != None:
+            return
+        from main import LightCNN_9
+        restore_layers = patch_layer_functions(lambda name, func: self.wrap(name, func, layer=True))
+        saved = [(LightCNN_9, name, LightCNN_9.__dict__[name]) for name in MODEL_METHODS]
+        saved.append((optim.Optimizer, 'step', optim.Optimizer.__dict__['step']))
+        for cls, name, func in saved:
+            setattr(cls, name, self.wrap(f'{cls.__name__}.{name}', func, layer=False))
+        started_tracing = self.memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+
+        def restore():
+            restore_layers()
+            for cls, name, func in saved:
+                setattr(cls, name, func)
+            if started_tracing:
+                tracemalloc.stop()
+        self.restore = restore
+        return
+
+    def disable(self):
+        if self.restore != None:
+            self.restore()
+            self.restore = None
+        return
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        return
+
+    def wrap(self, name, func, layer):
+        profiler = self
+
+        def profiled(*args, **kwargs):
+            local = profiler.local
+            if not hasattr(local, 'stack'):
+                local.stack = []
+                local.counts = {}
+            if len(local.stack) == 0:   # Outermost call: a new pass of the layer chain
+                local.counts = {}
+            if layer:
+                count = local.counts.get(name, 0)
+                local.counts[name] = count + 1
+                event_name = f'{name}#{count}'
+            else:
+                event_name = name
+            frame = {'peak': 0}
+            if profiler.memory:
+                frame['current'] = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            local.stack.append(frame)
+            start = time.perf_counter()
+            try:
+                output = func(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                local.stack.pop()
+            shapes, nbytes = output_info(output)
+            event = {
+                'name': event_name,
+                'function': name,
+                'layer': layer,
+                'epoch': profiler.epoch,
+                'start': start - profiler.origin,
+                'duration': end - start,
+                'shapes': shapes,
+                'bytes': nbytes,
+                'thread': threading.get_ident(),
+                'depth': len(local.stack),
+            }
+            if profiler.memory:
+                peak = max(tracemalloc.get_traced_memory()[1], frame['peak'])
+                event['peak_bytes'] = peak - frame['current']
+                if len(local.stack) > 0:   # reset_peak in this call hid the parent's peak so far
+                    local.stack[-1]['peak'] = max(local.stack[-1]['peak'], peak)
+            profiler.events.append(event)
+            return output
+        profiled.__wrapped__ = func
+        return profiled
+
+    def summary(self, epoch=None):
+        '''
+        Totals per layer call site (over the events of epoch, or all) ->
+        {name: {'calls', 'seconds', 'bytes'(, 'peak_bytes')}}, slowest first
+        '''
+        totals = {}
+        for event in self.events:
+            if epoch != None and event['epoch'] != epoch:
+                continue
+            total = totals.setdefault(event['name'], {'calls': 0, 'seconds': 0.0, 'bytes': 0})
+            total['calls'] += 1
+            total['seconds'] += event['duration']
+            total['bytes'] += event['bytes']
+            if 'peak_bytes' in event:
+                total['peak_bytes'] = max(total.get('peak_bytes', 0), event['peak_bytes'])
+        return dict(sorted(totals.items(), key=lambda item: -item[1]['seconds']))
+
+    def epoch_summaries(self):
+        return {epoch: self.summary(epoch) for epoch in sorted(set(event['epoch'] for event in self.events))}
+
+    def print_summary(self, epoch=None, top=20):
+        for name, total in list(self.summary(epoch).items())[:top]:
+            print(f"{name:40s} {total['calls']:6d} calls {total['seconds']*1e3:10.2f}ms {total['bytes']/2**20:10.2f}MB")
+        return
+
+    def export_chrome_trace(self, path):
+        '''
+        Write the events as a Chrome trace (chrome://tracing, Perfetto): one complete event per call
+        '''
+        trace = [{
+            'name': event['name'],
+            'cat': 'layer' if event['layer'] else 'model',
+            'ph': 'X',
+            'ts': event['start'] * 1e6,
+            'dur': event['duration'] * 1e6,
+            'pid': 0,
+            'tid': event['thread'],
+            'args': {key: event[key] for key in ('epoch', 'shapes', 'bytes', 'peak_bytes') if key in event},
+        } for event in self.events]
+        file = open(path, 'w')
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, file)
+        file.close()
+        return
+
+    def clear(self):
+        self.events = []
+        return
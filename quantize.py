@@ -0,0 +1,230 @@
+import numpy as np
+import glob
+import sys
+import threading
+import time
+
+from forward_layers import conv, mfm_inference, pool_inference
+from graph import lightcnn9_graph
+from model_format import save_weights, load_weights
+from evaluation import pearson_scores, evaluate
+
+'''
+Weight-only int8 quantization of the embedding path of LightCNN-9 (forward up to mfm_fc1).
+Weights: symmetric int8 per output channel, w ~ w_scale[k] * q_w, and they stay int8 in memory.
+Each conv/fc layer dequantizes its weights into one float32 scratch buffer shared by all layers
+(fc layers block by block of FC_BLOCK_ROWS input rows, so the scratch stays small) and runs the
+float32 kernels: activations are not quantized, convolutions use the same algorithms as the float
+model (conv_autotune.py), activations live in the graph's plan arena.
+Resident weights are about 3x smaller than the float32 model's (int8 plus the scratch), at the cost
+of dequantizing every layer's weights once per batch; it is a memory saving, not a speed-up.
+'''
+QMAX = 127
+FC_BLOCK_ROWS = 1024
+
+
+def quantize_weights(weights):
+    '''
+    Symmetric per-channel (last axis) int8 quantization -> (int8 weights, float32 scale per channel)
+    '''
+    flat = weights.reshape(-1, weights.shape[-1])
+    scale = np.max(np.abs(flat), axis=0) / QMAX
+    scale = np.where(scale > 0, scale, 1).astype(np.float32)
+    q = np.clip(np.rint(weights / scale), -QMAX, QMAX).astype(np.int8)
+    return q, scale
+
+
+class QuantizedLightCNN9(object):
+    '''
+    LightCNN-9 with int8 weights for embedding extraction: forward/forward_batch like LightCNN_9
+    (float32 features), built from a float model with from_model, saved in the weight file format
+    (the int8 weights are memory-mapped when loaded). fcout is dropped, it is not part of the embedding.
+    The low-rank fc layers of a factored model (lowrank.py) are quantized factor by factor.
+    The int8 weights are the model's attributes under the float model's names, so the graph plans
+    its arena as for a float32 LightCNN_9 (and shares the plans of one on the same thread).
+    '''
+    def __init__(self, factored, tensors, sim_thr):
+        self.factored = list(factored)
+        self.graph = lightcnn9_graph(self.factored)
+        self.layers = self.graph.inference_layers
+        self.tensors = tensors   # <layer>.weight (int8), <layer>.weight_scale, <layer>.bias (float32, if any)
+        self.sim_thr = sim_thr
+        self.dtype = np.dtype(np.float32)
+        scratch_size = 0
+        for layer in self.layers:
+            if layer.op in ('conv', 'fc'):
+                weights = tensors[layer.name + '.weight']
+                setattr(self, layer.params[0], weights)
+                if len(layer.params) > 1:
+                    setattr(self, layer.params[1], tensors[layer.name + '.bias'])
+                rows = min(len(weights), FC_BLOCK_ROWS) if layer.op == 'fc' else len(weights)
+                scratch_size = max(scratch_size, weights.size // len(weights) * rows)
+        self.scratch_size = scratch_size
+        self.local = threading.local()   # scratch buffer of each thread
+        return
+
+    @classmethod
+    def from_model(cls, model):
+        tensors = {}
+        for layer in model.graph.inference_layers:
+            if layer.op in ('conv', 'fc'):
+                q, scale = quantize_weights(np.asarray(getattr(model, layer.params[0])))
+                tensors[layer.name + '.weight'] = q
+                tensors[layer.name + '.weight_scale'] = scale
+                if len(layer.params) > 1:
+                    tensors[layer.name + '.bias'] = np.asarray(getattr(model, layer.params[1]), dtype=np.float32)
+        return cls(model.factored, tensors, float(model.sim_thr))
+
+    def save(self, path):
+        save_weights(path, sorted(self.tensors.items()),
+                     {'quantized': 'int8', 'sim_thr': self.sim_thr, 'factored': self.factored})
+        return
+
+    @classmethod
+    def load(cls, path):
+        tensors, attributes = load_weights(path, 'r')
+        assert attributes.get('quantized') == 'int8', f'{path} is not an int8 model'
+        return cls(attributes.get('factored', []), tensors, attributes['sim_thr'])
+
+    def weight_bytes(self):
+        '''
+        Bytes of the saved (int8) weights
+        '''
+        return sum(tensor.nbytes for tensor in self.tensors.values())
+
+    def resident_bytes(self):
+        '''
+        Bytes of weights in memory while running: the int8 weights and one scratch buffer
+        '''
+        return self.weight_bytes() + self.scratch_size * 4
+
+    def dequantize(self, name, start=0, stop=None):
+        '''
+        float32 weights of layer name (rows start:stop) in the thread's scratch buffer, valid until the next call
+        '''
+        if not hasattr(self.local, 'scratch'):
+            self.local.scratch = np.empty(self.scratch_size, dtype=np.float32)
+        weights = self.tensors[name + '.weight'][start:stop]
+        out = self.local.scratch[:weights.size].reshape(weights.shape)
+        np.multiply(weights, self.tensors[name + '.weight_scale'], out=out)
+        return out
+
+    def forward(self, data):
+        return self.forward_batch(np.asarray(data)[None], 1)[0]
+
+    def forward_batch(self, images, batch_size=64):
+        '''
+        (N, image_width, image_height) -> (N, 256) float32 features
+        '''
+        features = np.zeros((len(images), 256), dtype=np.float32)
+        for k in range(0, len(images), batch_size):
+            features[k:k+batch_size] = self.run(np.asarray(images[k:k+batch_size], dtype=np.float32))
+        return features
+
+    def run(self, images):
+        '''
+        The inference pass of LayerGraph.run_forward with each conv/fc's weights dequantized when it runs
+        -> the feature tensor, a view on the plan's arena
+        '''
+        plan = self.graph.plan(self, images.shape, train=False)
+        tensors = plan.tensors
+        plan.clear_border('input')
+        tensors['input'][..., 0] = images
+        for layer in plan.layers:
+            plan.clear_border(layer.name)
+            data = tensors[layer.input]
+            out = tensors[layer.name]
+            if layer.op == 'conv':
+                conv(plan.conv_input(layer), self.dequantize(layer.name), getattr(self, layer.params[1]), out=out)
+            elif layer.op == 'fc':
+                data = data.reshape(len(data), -1)
+                for k in range(0, data.shape[1], FC_BLOCK_ROWS):
+                    weights = self.dequantize(layer.name, k, k + FC_BLOCK_ROWS)
+                    if k == 0:
+                        np.matmul(data[:, :FC_BLOCK_ROWS], weights, out=out)
+                    else:
+                        out += np.matmul(data[:, k:k+FC_BLOCK_ROWS], weights)
+                if len(layer.params) > 1:
+                    out += getattr(self, layer.params[1])
+            elif layer.op == 'mfm':
+                mfm_inference(data, out=out)
+            elif layer.op == 'pool':
+                pool_inference(data, out=out)
+        return tensors[self.graph.feature]
+
+
+def is_quantized_model(path):
+    return load_weights(path, 'r')[1].get('quantized') == 'int8'
+
+def load_model(path):
+    '''
+    LightCNN_9 or QuantizedLightCNN9, whichever the weight file at path holds
+    '''
+    if is_quantized_model(path):
+        return QuantizedLightCNN9.load(path)
+    from main import LightCNN_9
+    return LightCNN_9(path)
+
+def images_per_second(model, images, batch_size=64, repeat=3):
+    best = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        model.forward_batch(images, batch_size)
+        best = min(best, time.perf_counter() - start)
+    return len(images) / best
+
+def quantization_report(model, qmodel, images, match_images=None, mismatch_images=None, batch_size=64):
+    '''
+    Compare the int8 model with its float model:
+    embedding drift on images (Pearson similarity and relative L2 error of each embedding),
+    model size (saved, and in memory with the scratch buffer), images/s, and if pair images are given ([pair0 image0, pair0 image1, ...]) the F1 of both
+    at the float model's sim_thr and at their best thresholds
+    '''
+    float_features = model.forward_batch(images, batch_size).astype(np.double)
+    int8_features = qmodel.forward_batch(images, batch_size).astype(np.double)
+    similarity = pearson_scores(float_features, int8_features)
+    error = np.linalg.norm(int8_features - float_features, axis=1) / np.maximum(np.linalg.norm(float_features, axis=1), 1e-30)
+    float_bytes = sum(getattr(model, name).nbytes for layer in qmodel.layers if layer.op in ('conv', 'fc') for name in layer.params)
+    report = {
+        'mean_similarity': float(np.mean(similarity)),
+        'min_similarity': float(np.min(similarity)),
+        'mean_relative_error': float(np.mean(error)),
+        'max_relative_error': float(np.max(error)),
+        'float_bytes': float_bytes,
+        'int8_bytes': qmodel.weight_bytes(),
+        'compression': float_bytes / qmodel.weight_bytes(),
+        'int8_resident_bytes': qmodel.resident_bytes(),
+        'resident_compression': float_bytes / qmodel.resident_bytes(),
+        'float_images_per_second': images_per_second(model, images, batch_size),
+        'int8_images_per_second': images_per_second(qmodel, images, batch_size),
+    }
+    if match_images is not None:
+        for name, net in (('float', model), ('int8', qmodel)):
+            match = net.forward_batch(match_images, batch_size)
+            mismatch = net.forward_batch(mismatch_images, batch_size)
+            result = evaluate(pearson_scores(match[0::2], match[1::2]), pearson_scores(mismatch[0::2], mismatch[1::2]), model.sim_thr)
+            report[f'{name}_F1'] = result['F1']
+            report[f'{name}_best_F1'] = result['best_F1']
+        report['F1_change'] = report['int8_F1'] - report['float_F1']
+    return report
+
+
+if __name__ == "__main__":
+    # python quantize.py LightCNN9_model.bin LightCNN9_int8.bin './train_image/*/*/*.jpg' [path_match path_mismatch]
+    # (the images are only used by the report)
+    from main import LightCNN_9
+    from pairs import pair_files
+    from utils import load_images
+    model = LightCNN_9(sys.argv[1], dtype=np.float32)
+    paths = sorted(glob.glob(sys.argv[3]))
+    sample = np.random.default_rng(0).choice(len(paths), min(256, len(paths)), replace=False)
+    images = np.array(list(load_images([paths[i] for i in sample])))
+    qmodel = QuantizedLightCNN9.from_model(model)
+    qmodel.save(sys.argv[2])
+    match_images = mismatch_images = None
+    if len(sys.argv) > 5:
+        match_files = pair_files(sys.argv[4])
+        match_images = np.array(list(load_images(match_files)))
+        mismatch_images = np.array(list(load_images(pair_files(sys.argv[5], len(match_files) // 2))))
+    for key, value in quantization_report(model, qmodel, images, match_images, mismatch_images).items():
+        print(key, value)
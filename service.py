@@ -0,0 +1,246 @@
+import numpy as np
+import asyncio
+import collections
+import concurrent.futures
+import glob
+import json
+import sys
+import time
+
+from main import image_width, image_height
+from utils import load_image
+from evaluation import pearson_scores
+from quantize import load_model
+from conv_autotune import enable_conv_autotuning, batch_bucket
+
+'''
+Local face verification service.
+Protocol: newline-delimited JSON over TCP (or a unix socket), one request per line, replies in order:
+  {"op": "verify", "image1": path, "image2": path}            -> {"score", "match", "sim_thr"}
+  {"op": "verify", "embedding1": [...], "embedding2": [...]}  -> {"score", "match", "sim_thr"}
+  {"op": "embed", "image": path}                              -> {"embedding": [...]}
+  {"op": "stats"}                                             -> latency percentiles, throughput, batch size
+An optional "id" is echoed back; failures reply {"error": message}.
+Images from concurrent requests are coalesced into micro-batches for forward_batch: a batch runs when
+it has max_batch_size images or max_latency seconds after its first image arrived.
+'''
+DEFAULT_PORT = 8765
+
+
+class MicroBatcher(object):
+    '''
+    Coalesces images submitted by concurrent requests into batches for model.forward_batch,
+    which runs on one worker thread so the event loop keeps accepting requests meanwhile
+    '''
+    def __init__(self, model, max_batch_size=32, max_latency=0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = asyncio.Queue()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.batch_sizes = collections.deque(maxlen=10000)
+        self.task = None
+        return
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        return
+
+    async def embed(self, image):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            images = np.stack([image for image, future in batch])
+            self.batch_sizes.append(len(batch))
+            try:
+                features = await loop.run_in_executor(self.executor, self.model.forward_batch, images, self.max_batch_size)
+                for (image, future), feature in zip(batch, features):
+                    if not future.cancelled():
+                        future.set_result(feature)
+            except Exception as e:
+                for image, future in batch:
+                    if not future.cancelled():
+                        future.set_exception(e)
+
+    def close(self):
+        if self.task != None:
+            self.task.cancel()
+        self.executor.shutdown()
+        return
+
+
+class VerificationService(object):
+    '''
+    Serves a warm-loaded LightCNN_9 or QuantizedLightCNN9 (weight-only int8, less memory at the same speed; see the protocol above).
+    Image files are decoded on a thread pool, features come from the MicroBatcher and pairs are
+    scored with the Pearson correlation against model.sim_thr.
+    Per-request latencies of the last `window` requests are kept for stats().
+    '''
+    def __init__(self, model, max_batch_size=32, max_latency=0.005, decode_threads=4, window=10000):
+        self.model = model
+        self.batcher = MicroBatcher(model, max_batch_size, max_latency)
+        self.decoder = concurrent.futures.ThreadPoolExecutor(max_workers=decode_threads)
+        self.latencies = collections.deque(maxlen=window)
+        self.finish_times = collections.deque(maxlen=window)
+        self.warm_up(max_batch_size)
+        return
+
+    def warm_up(self, max_batch_size):
+        '''
+        Page in the weights and run every micro-batch shape once before the first request: one batch
+        per conv autotuning bucket (conv_autotune.batch_bucket), largest first so the plan's arena is
+        allocated once at max_batch_size and every smaller batch runs on its leading rows.
+        The batches run on the batcher's worker thread, which owns the plans used while serving
+        (LayerGraph keeps plans per thread).
+        '''
+        sizes = {min(batch_bucket(size), max_batch_size) for size in range(1, max_batch_size + 1)}
+        for size in sorted(sizes, reverse=True):
+            images = np.zeros((size, image_height, image_width), dtype=self.model.dtype)
+            self.batcher.executor.submit(self.model.forward_batch, images, max_batch_size).result()
+        return
+
+    async def start(self, host='127.0.0.1', port=DEFAULT_PORT, unix_path=None):
+        self.batcher.start()
+        if unix_path != None:
+            self.server = await asyncio.start_unix_server(self.handle_connection, unix_path)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                start = time.perf_counter()
+                try:
+                    request = json.loads(line)
+                    reply = await self.handle(request)
+                    if 'id' in request:
+                        reply['id'] = request['id']
+                except Exception as e:
+                    reply = {'error': f'{type(e).__name__}: {e}'}
+                writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+                await writer.drain()
+                if 'error' not in reply and request.get('op') != 'stats':
+                    self.latencies.append(time.perf_counter() - start)
+                    self.finish_times.append(time.perf_counter())
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def handle(self, request):
+        op = request.get('op', 'verify')
+        if op == 'verify':
+            if 'embedding1' in request:
+                feature1 = np.asarray(request['embedding1'], dtype=np.double)
+                feature2 = np.asarray(request['embedding2'], dtype=np.double)
+            else:
+                feature1, feature2 = await asyncio.gather(self.embed_file(request['image1']), self.embed_file(request['image2']))
+            score = float(pearson_scores(feature1[None], feature2[None])[0])
+            return {'score': score, 'match': score >= self.model.sim_thr, 'sim_thr': float(self.model.sim_thr)}
+        if op == 'embed':
+            return {'embedding': (await self.embed_file(request['image'])).tolist()}
+        if op == 'stats':
+            return self.stats()
+        raise ValueError(f'unknown op {op}')
+
+    async def embed_file(self, path):
+        image = await asyncio.get_running_loop().run_in_executor(self.decoder, load_image, path)
+        return await self.batcher.embed(image.astype(self.model.dtype, copy=False))
+
+    def stats(self):
+        '''
+        p50/p99 latency (ms), throughput (requests/s) over the recent window and the mean micro-batch size
+        '''
+        latencies = np.array(self.latencies) * 1000
+        finish_times = np.array(self.finish_times)
+        batch_sizes = np.array(self.batcher.batch_sizes)
+        return {
+            'requests': len(latencies),
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'throughput': float((len(finish_times) - 1) / (finish_times[-1] - finish_times[0])) if len(finish_times) > 1 and finish_times[-1] > finish_times[0] else None,
+            'mean_batch_size': float(np.mean(batch_sizes)) if len(batch_sizes) else None,
+        }
+
+    def close(self):
+        self.server.close()
+        self.batcher.close()
+        self.decoder.shutdown()
+        return
+
+
+async def load_generator(image_paths, host='127.0.0.1', port=DEFAULT_PORT, concurrency=16, requests=1000, seed=0):
+    '''
+    Send `requests` verify requests for random pairs of image_paths over `concurrency` connections,
+    each with one request in flight -> client-side latency percentiles (ms) and throughput
+    '''
+    rng = np.random.default_rng(seed)
+    pairs = rng.integers(0, len(image_paths), size=(requests, 2))
+    latencies = []
+    errors = []
+
+    async def client(worker):
+        reader, writer = await asyncio.open_connection(host, port)
+        for i in range(worker, requests, concurrency):
+            request = {'op': 'verify', 'id': i, 'image1': image_paths[pairs[i, 0]], 'image2': image_paths[pairs[i, 1]]}
+            start = time.perf_counter()
+            writer.write(json.dumps(request).encode('utf-8') + b'\n')
+            await writer.drain()
+            reply = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - start)
+            if 'error' in reply:
+                errors.append(reply['error'])
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(worker) for worker in range(min(concurrency, requests))])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': requests,
+        'errors': len(errors),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'throughput': requests / elapsed,
+    }
+
+async def serve(model_path, port=DEFAULT_PORT, max_batch_size=32, max_latency=0.005):
+    enable_conv_autotuning()
+    service = VerificationService(load_model(model_path), max_batch_size, max_latency)
+    server = await service.start(port=port)
+    print(f"serving on 127.0.0.1:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    # python service.py serve LightCNN9_model.bin [port]
+    # python service.py loadgen './test_dataset/*/*/*.jpg' [port] [concurrency] [requests]
+    if sys.argv[1] == 'serve':
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_PORT
+        asyncio.run(serve(sys.argv[2], port))
+    elif sys.argv[1] == 'loadgen':
+        paths = sorted(glob.glob(sys.argv[2]))
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_PORT
+        concurrency = int(sys.argv[4]) if len(sys.argv) > 4 else 16
+        requests = int(sys.argv[5]) if len(sys.argv) > 5 else 1000
+        for key, value in asyncio.run(load_generator(paths, port=port, concurrency=concurrency, requests=requests)).items():
+            print(key, value)
@@ -1,29 +1,200 @@
 import numpy as np
-import pandas as pd
-from skimage import io, transform
 import glob
+import multiprocessing
+import os
+import pickle
+import queue
 import re
+import threading
 image_width = 128
 image_height = 128
+# Bump whenever load_image changes, so cached embeddings of old preprocessing are not reused
+PREPROCESS_VERSION = 1
+TRAINDATA_CACHE_DIR = 'train_cache'
+# scikit-image and pandas take most of the start-up time, they are imported by the functions using them
 
-def traindata_loader(path):
+def load_image(path):
     '''
-    Load data and label from train dataset
+    Read an image as gray scale, crop it, resize to (image_width, image_height) and min-max normalize
     '''
+    from skimage import io, transform
+    raw_image = io.imread(path, as_gray=True)
+    image = transform.resize(raw_image[25:-25][25:-25], (image_width, image_height))
+    image = (image-np.amin(image))/(np.amax(image)-np.amin(image))
+    return image
+
+def load_images(paths, workers=None, chunksize=16):
+    '''
+    load_image over many files with a pool of worker processes.
+    Yields the images in the order of paths; each worker handles chunksize files at a time.
+    workers: number of processes, None for all cores, 1 to load in this process
+    '''
+    if workers == None:
+        workers = os.cpu_count()
+    if workers <= 1 or len(paths) <= chunksize:
+        for path in paths:
+            yield load_image(path)
+        return
+    pool = multiprocessing.Pool(min(workers, (len(paths)+chunksize-1)//chunksize))
+    try:
+        for image in pool.imap(load_image, paths, chunksize):
+            yield image
+    finally:
+        pool.terminate()
+
+def people_name(image):
+    '''
+    Extract people's name from the path of a training image
+    '''
+    name = re.search(r'(?<=\\)[a-zA-Z_-]+', image[20:])
+    return name.group(0)[:-1]
+
+def traindata_loader(path, workers=None):
+    '''
+    Load data and label from train dataset -> images, (N,) integer label ids (people names in sorted order)
+    '''
+    import pandas as pd
     imlist = glob.glob(path)
     rawImageArray = np.zeros((len(imlist), image_height, image_width), dtype=np.double)
     people_names = []
-    for i in range(len(imlist)):
-        image = imlist[i]
-        raw_image = io.imread(image, as_gray=True)
-        # Preprocessing
-        rawImageArray[i] = transform.resize(raw_image[25:-25][25:-25], (image_width, image_height))
-        rawImageArray[i] = (rawImageArray[i]-np.amin(rawImageArray[i]))/(np.amax(rawImageArray[i])-np.amin(rawImageArray[i]))
-        people_name = re.search(r'(?<=\\)[a-zA-Z_-]+', image[20:]) # Extract people's name
-        people_names.append(people_name.group(0)[:-1])  
+    for i, image in enumerate(load_images(imlist, workers)):
+        rawImageArray[i] = image
+        people_names.append(people_name(imlist[i]))
     
-    # One-hot encode
-    data_label = pd.get_dummies(people_names).to_numpy() 
-    data_label_expand = np.zeros((data_label.shape[0], 3095))
-    data_label_expand[:, :data_label.shape[1]] = data_label
-    return rawImageArray, data_label_expand
\ No newline at end of file
+    # Integer ids in the column order of pd.get_dummies, the one-hot matrix is never built
+    label_ids = pd.factorize(np.array(people_names), sort=True)[0].astype(np.int32)
+    return rawImageArray, label_ids
+
+def build_traindata_cache(path, cache_dir=TRAINDATA_CACHE_DIR, dtype=np.float32, workers=None):
+    '''
+    Preprocess the train dataset once into cache_dir:
+      images.bin: raw (N, image_height, image_width) array, appended to by later builds
+      labels.bin: raw (N,) int32 label ids
+      manifest.pkl: image files, label id of each people name, N, dtype and PREPROCESS_VERSION
+    Only images not in the manifest are preprocessed, so adding identity folders is incremental.
+    Images are decoded by `workers` processes (see load_images).
+    Existing people keep their label ids, new people get the next free ids.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest_path = os.path.join(cache_dir, 'manifest.pkl')
+    images_path = os.path.join(cache_dir, 'images.bin')
+    labels_path = os.path.join(cache_dir, 'labels.bin')
+    manifest = None
+    if os.path.exists(manifest_path):
+        file = open(manifest_path, 'rb')
+        manifest = pickle.loads(file.read())
+        file.close()
+        if manifest['version'] != PREPROCESS_VERSION or manifest['dtype'] != np.dtype(dtype):
+            manifest = None
+    if manifest == None:
+        manifest = {'version': PREPROCESS_VERSION, 'dtype': np.dtype(dtype), 'files': [], 'label_ids': {}, 'count': 0}
+
+    known = set(manifest['files'])
+    imlist = [image for image in sorted(glob.glob(path)) if image not in known]
+    if len(imlist) == 0:
+        return manifest
+
+    # Drop anything written after the last complete build
+    image_bytes = manifest['count'] * image_height * image_width * manifest['dtype'].itemsize
+    for file_path, size in ((images_path, image_bytes), (labels_path, manifest['count'] * 4)):
+        file = open(file_path, 'ab')
+        file.truncate(size)
+        file.close()
+
+    images_file = open(images_path, 'ab')
+    labels_file = open(labels_path, 'ab')
+    for image, data in zip(imlist, load_images(imlist, workers)):
+        name = people_name(image)
+        if name not in manifest['label_ids']:
+            manifest['label_ids'][name] = len(manifest['label_ids'])
+        images_file.write(data.astype(manifest['dtype']).tobytes())
+        labels_file.write(np.int32(manifest['label_ids'][name]).tobytes())
+    images_file.close()
+    labels_file.close()
+
+    manifest['files'] += imlist
+    manifest['count'] = len(manifest['files'])
+    tmp_path = manifest_path + '.tmp'
+    file = open(tmp_path, 'wb')
+    file.write(pickle.dumps(manifest))
+    file.close()
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+def traindata_cache_loader(cache_dir=TRAINDATA_CACHE_DIR):
+    '''
+    Open the train dataset written by build_traindata_cache.
+    Images are memory-mapped and paged in when used, labels are integer ids.
+    '''
+    file = open(os.path.join(cache_dir, 'manifest.pkl'), 'rb')
+    manifest = pickle.loads(file.read())
+    file.close()
+    count = manifest['count']
+    images = np.memmap(os.path.join(cache_dir, 'images.bin'), dtype=manifest['dtype'], mode='r', shape=(count, image_height, image_width))
+    labels = np.fromfile(os.path.join(cache_dir, 'labels.bin'), dtype=np.int32, count=count)
+    return images, labels
+
+def traindata_class_count(cache_dir=TRAINDATA_CACHE_DIR):
+    '''
+    Number of identities (label ids) in the train dataset written by build_traindata_cache
+    '''
+    file = open(os.path.join(cache_dir, 'manifest.pkl'), 'rb')
+    manifest = pickle.loads(file.read())
+    file.close()
+    return len(manifest['label_ids'])
+
+def label_ids(labels):
+    '''
+    (N, class_num) one-hot labels or (N,) label ids -> (N,) integer label ids
+    '''
+    labels = np.asarray(labels)
+    if len(labels.shape) == 2:
+        return np.argmax(labels, axis=1)
+    return labels.astype(np.intp, copy=False)
+
+def prefetch_batches(images, labels, batch_size, epoch=0, seed=0, prefetch=2, start_batch=0):
+    '''
+    Yield shuffled (batch_images, batch_labels) mini-batches of one epoch.
+    images can be the memmap from traindata_cache_loader: only the rows of the next `prefetch`
+    batches are read, by a background thread while the current batch trains.
+    The order is a permutation seeded by (seed, epoch), so a run is reproducible.
+    Batch labels are integer label ids, (N, class_num) one-hot labels are converted.
+    start_batch: skip the first start_batch batches of the epoch (resuming from a checkpoint)
+    '''
+    order = np.random.default_rng([seed, epoch]).permutation(len(images))
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        # never block for good: the consumer may have stopped reading (error or Ctrl-C in the training loop)
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_batches():
+        try:
+            for k in range(start_batch * batch_size, len(order), batch_size):
+                index = np.sort(order[k:k+batch_size])  # sorted rows read the file sequentially
+                if not put((np.asarray(images[index]), label_ids(labels[index]))):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    reader = threading.Thread(target=read_batches, daemon=True)
+    reader.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        stop.set()
+        reader.join()